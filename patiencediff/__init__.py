@@ -15,22 +15,105 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import asyncio
+import concurrent.futures
+import contextlib
 import difflib
+import functools
+import hashlib
+import itertools
+import mmap
 import os
 import sys
 import time
-from typing import Iterator, List, Optional, Sequence, Type, Union
+import zlib
+from collections import deque
+from typing import (
+    Any,
+    AnyStr,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+    cast,
+    overload,
+)
+
+from ._patiencediff_py import (
+    BytesLike,
+    Cancellable,
+    DiffStats,
+    LineKey,
+    MatchArray,
+    Opcode,
+    OpcodeArray,
+    set_stats_hook,
+)
+from .cache import DiffCache
+from .index import LineIndex
+from .merge3 import Merge3
 
 __all__ = [
+    "CancellationToken",
+    "DiffCache",
+    "DiffStats",
+    "LineIndex",
+    "LineKey",
+    "Merge3",
+    "MatchArray",
+    "OpcodeArray",
     "PatienceSequenceMatcher",
+    "adiff",
+    "diff_stats",
+    "diff_stats_dirs",
+    "diff_stats_files",
+    "aunified_diff_files",
+    "aunified_diff_files_bytes",
+    "aunified_diff_hunks",
+    "diff_many",
+    "render_unified",
+    "set_stats_hook",
+    "split_lines",
     "unified_diff",
+    "unified_diff_bytes",
+    "unified_diff_dirs",
+    "unified_diff_dirs_bytes",
     "unified_diff_files",
+    "unified_diff_files_bytes",
+    "unified_diff_windowed",
     "recurse_matches",
+    "refine_opcodes",
     "unique_lcs",
 ]
 
 __version__ = (0, 2, 18)
 
+_T = TypeVar("_T")
+_R = TypeVar("_R")
+
+# Block size used when comparing file contents
+_BLOCK_SIZE = 1 << 16
+
+# Number of lines of each side held at once by unified_diff_windowed()
+_WINDOW = 1 << 16
+
+# One in this many lines is remembered by _LineSketch
+_SAMPLE = 8
+
+# How many windows of lines unified_diff_windowed() reads at most to find
+# an anchor after a large change, and remembers in its sketches
+_HORIZON = 16
+
 
 # This is a version of unified_diff which only adds a factory parameter
 # so that you can override the default SequenceMatcher
@@ -45,6 +128,8 @@ def unified_diff(
     n: int = 3,
     lineterm: str = "\n",
     sequencematcher: Optional[Type[difflib.SequenceMatcher]] = None,
+    key: Optional[Callable[[str], Hashable]] = None,
+    ignore_blank_lines: bool = False,
 ) -> Iterator[str]:
     r"""Compare two sequences of lines; generate the delta as a unified diff.
 
@@ -66,6 +151,11 @@ def unified_diff(
     'fromfile', 'tofile', 'fromfiledate', and 'tofiledate'.  The modification
     times are normally expressed in the format returned by time.ctime().
 
+    Lines are matched by the result of calling 'key' on them if it is given,
+    such as a LineKey that ignores whitespace or case, and hunks whose
+    changed lines are all blank are left out if 'ignore_blank_lines' is
+    true; the hunks always show the original lines.
+
     Example:
     >>> for line in unified_diff('one two three four'.split(),
     ...             'zero one tree four'.split(), 'Original', 'Current',
@@ -85,13 +175,101 @@ def unified_diff(
     if sequencematcher is None:
         sequencematcher = difflib.SequenceMatcher
 
+    groups = _grouped_opcodes(_keyed_matcher(sequencematcher, a, b, key), n)
+    if ignore_blank_lines:
+        groups = _drop_blank_groups(groups, a, b)
+    yield from _unified_diff_groups(
+        groups,
+        a,
+        b,
+        fromfile,
+        tofile,
+        fromfiledate,
+        tofiledate,
+        lineterm,
+    )
+
+
+def _keyed_matcher(
+    sequencematcher: Type[difflib.SequenceMatcher],
+    a: Sequence[_T],
+    b: Sequence[_T],
+    key: Optional[Callable[[_T], Hashable]],
+) -> difflib.SequenceMatcher:
+    """Create a matcher for a and b that matches items by key.
+
+    difflib.SequenceMatcher does not take a key, so it is given the keys of
+    the items instead; other matchers are passed key.
+    """
+    if key is None:
+        return sequencematcher(None, a, b)
+    if sequencematcher is difflib.SequenceMatcher:
+        return sequencematcher(None, [key(x) for x in a], [key(x) for x in b])
+    factory = cast(Callable[..., difflib.SequenceMatcher], sequencematcher)
+    return factory(None, a, b, key=key)
+
+
+def _is_blank_change(
+    group: List[Opcode],
+    a: Sequence[AnyStr],
+    b: Sequence[AnyStr],
+    a_offset: int = 0,
+    b_offset: int = 0,
+) -> bool:
+    """Check whether all lines changed by a group are blank."""
+    for tag, i1, i2, j1, j2 in group:
+        if tag == "equal":
+            continue
+        changed = itertools.chain(
+            a[i1 - a_offset : i2 - a_offset], b[j1 - b_offset : j2 - b_offset]
+        )
+        if any(line.strip() for line in changed):
+            return False
+    return True
+
+
+def _drop_blank_groups(
+    groups: Iterable[List[Opcode]], a: Sequence[AnyStr], b: Sequence[AnyStr]
+) -> Iterator[List[Opcode]]:
+    """Leave out the groups which only change blank lines, like diff -B."""
+    return (group for group in groups if not _is_blank_change(group, a, b))
+
+
+def _grouped_opcodes(
+    matcher: difflib.SequenceMatcher, n: int
+) -> Iterable[List[Opcode]]:
+    """Return the grouped opcodes of a matcher, lazily if it can."""
+    iter_grouped_opcodes = getattr(matcher, "iter_grouped_opcodes", None)
+    if iter_grouped_opcodes is None:
+        return matcher.get_grouped_opcodes(n)
+    groups: Iterable[List[Opcode]] = iter_grouped_opcodes(n)
+    return groups
+
+
+def _unified_diff_groups(
+    groups: Iterable[List[Opcode]],
+    a: Sequence[str],
+    b: Sequence[str],
+    fromfile: str,
+    tofile: str,
+    fromfiledate: Union[str, float],
+    tofiledate: Union[str, float],
+    lineterm: str,
+    a_offset: int = 0,
+    b_offset: int = 0,
+) -> Iterator[str]:
+    """Render grouped opcodes as a unified diff.
+
+    a and b hold the lines of both sides starting at line a_offset and
+    b_offset respectively; the opcodes use line numbers in the whole file.
+    """
     if fromfiledate:
         fromfiledate = "\t" + str(fromfiledate)
     if tofiledate:
         tofiledate = "\t" + str(tofiledate)
 
     started = False
-    for group in sequencematcher(None, a, b).get_grouped_opcodes(n):
+    for group in groups:
         if not started:
             yield f"--- {fromfile}{fromfiledate}{lineterm}"
             yield f"+++ {tofile}{tofiledate}{lineterm}"
@@ -99,6 +277,10 @@ def unified_diff(
         i1, i2, j1, j2 = group[0][1], group[-1][2], group[0][3], group[-1][4]
         yield f"@@ -{i1 + 1},{i2 - i1} +{j1 + 1},{j2 - j1} @@{lineterm}"
         for tag, i1, i2, j1, j2 in group:
+            i1 -= a_offset
+            i2 -= a_offset
+            j1 -= b_offset
+            j2 -= b_offset
             if tag == "equal":
                 for line in a[i1:i2]:
                     yield " " + line
@@ -111,15 +293,348 @@ def unified_diff(
                     yield "+" + line
 
 
+def _count_lines(data: bytes, start: int, end: int) -> int:
+    """Return the number of lines in data[start:end]."""
+    count = data.count(b"\n", start, end)
+    if end > start and data[end - 1 : end] != b"\n":
+        count += 1
+    return count
+
+
+def _change_tag(len_a: int, len_b: int) -> str:
+    """Return the tag of an opcode replacing len_a lines with len_b lines."""
+    if len_a and len_b:
+        return "replace"
+    return "delete" if len_a else "insert"
+
+
+def _line_hash(line: str) -> int:
+    """Hash a line the same way in every process, unlike hash()."""
+    return zlib.crc32(line.encode("utf-8", "surrogatepass"))
+
+
+class _LineSketch:
+    """A sample of the hashes of the lines last consumed from one side.
+
+    Only lines whose hash is a multiple of _SAMPLE are remembered, so the
+    sketch covers many more lines than a window holds; since the same
+    lines are sampled on both sides, the sketches can still be compared.
+    Hashes are kept in two generations of size lines each, the older of
+    which is dropped whenever the newer one is full.
+    """
+
+    def __init__(self, size: int) -> None:
+        """Create a sketch of the last size to 2 * size lines."""
+        self._size = size
+        self._count = 0
+        self._current: Set[int] = set()
+        self._previous: Set[int] = set()
+
+    def add(self, lines: Sequence[str]) -> None:
+        """Record lines, forgetting the oldest generation once needed."""
+        self._current.update(
+            h for h in map(_line_hash, lines) if not h % _SAMPLE
+        )
+        self._count += len(lines)
+        if self._count >= self._size:
+            self._previous = self._current
+            self._current = set()
+            self._count = 0
+
+    def has_most(self, lines: Iterable[str]) -> bool:
+        """Check whether most of the sampled lines were seen recently."""
+        hashes = {h for h in map(_line_hash, lines) if not h % _SAMPLE}
+        seen = sum(
+            1 for h in hashes if h in self._current or h in self._previous
+        )
+        return bool(hashes) and 2 * seen >= len(hashes)
+
+
+def _windowed_opcodes(
+    a: Iterable[str],
+    b: Iterable[str],
+    window: int,
+    sequencematcher: Type[difflib.SequenceMatcher],
+    key: Optional[Callable[[str], Hashable]] = None,
+) -> Iterator[Tuple[str, List[str], List[str]]]:
+    """Match two streams of lines, holding about window lines of each.
+
+    Every window is matched as a whole, but only the part up to the last
+    match clear of its end is committed; the rest is matched again along
+    with the next lines. Where a window has no matches at all, it is
+    doubled until it finds some, up to _HORIZON times its size, so that a
+    change larger than the window is matched like one inside it. Past
+    that, the side whose lines were recently consumed from the other one
+    is assumed to lag behind and is advanced on its own, so that the diff
+    can still catch up.
+
+    :return: An iterator over (tag, lines_a, lines_b) for the opcodes of
+        the whole diff, in order
+    """
+    iter_a = iter(a)
+    iter_b = iter(b)
+    buf_a: List[str] = []
+    buf_b: List[str] = []
+    seen_a = _LineSketch(_HORIZON * window)
+    seen_b = _LineSketch(_HORIZON * window)
+    margin = window // 4
+    size = window
+    while True:
+        buf_a.extend(itertools.islice(iter_a, max(size - len(buf_a), 0)))
+        buf_b.extend(itertools.islice(iter_b, max(size - len(buf_b), 0)))
+        done_a = len(buf_a) < size
+        done_b = len(buf_b) < size
+        opcodes: List[Opcode] = list(
+            _keyed_matcher(sequencematcher, buf_a, buf_b, key).get_opcodes()
+        )
+        if done_a and done_b:
+            for tag, i1, i2, j1, j2 in opcodes:
+                yield tag, buf_a[i1:i2], buf_b[j1:j2]
+            return
+        # Matches near the end of a window could still change once more
+        # lines are read
+        limit_a = len(buf_a) if done_a else len(buf_a) - margin
+        limit_b = len(buf_b) if done_b else len(buf_b) - margin
+        equal = [opcode for opcode in opcodes if opcode[0] == "equal"]
+        settled = [
+            opcode
+            for opcode in equal
+            if opcode[1] < limit_a and opcode[3] < limit_b
+        ]
+        if settled:
+            _, i1, i2, j1, _ = settled[-1]
+            length = min(i2 - i1, limit_a - i1, limit_b - j1)
+            cut_a, cut_b = i1 + length, j1 + length
+        elif equal:
+            cut_a, cut_b = equal[0][1], equal[0][3]
+        elif size < _HORIZON * window:
+            # Look further ahead on both sides for an anchor
+            size *= 2
+            continue
+        else:
+            if done_a or seen_a.has_most(buf_b):
+                cut_a, cut_b = 0, limit_b
+            elif done_b or seen_b.has_most(buf_a):
+                cut_a, cut_b = limit_a, 0
+            else:
+                cut_a, cut_b = limit_a, limit_b
+            opcodes = [(_change_tag(cut_a, cut_b), 0, cut_a, 0, cut_b)]
+        size = window
+        for tag, i1, i2, j1, j2 in opcodes:
+            if i1 >= cut_a and j1 >= cut_b:
+                break
+            yield tag, buf_a[i1 : min(i2, cut_a)], buf_b[j1 : min(j2, cut_b)]
+        seen_a.add(buf_a[:cut_a])
+        seen_b.add(buf_b[:cut_b])
+        del buf_a[:cut_a]
+        del buf_b[:cut_b]
+
+
+def _windowed_hunks(
+    chunks: Iterable[Tuple[str, List[str], List[str]]], n: int, limit: int
+) -> Iterator[Tuple[List[Opcode], List[str], List[str]]]:
+    """Group a stream of opcodes carrying their lines into hunks.
+
+    The hunks are those of _group_opcodes(), except that a hunk is also
+    ended before the next change once it holds more than limit lines, so
+    that the lines kept at once stay bounded however long a run of changes
+    is; the change then starts an adjacent hunk.
+
+    :return: An iterator over (group, lines_a, lines_b), where lines_a and
+        lines_b hold the lines of both sides from the start of the group
+    """
+    i = j = 0
+    group: List[Opcode] = []
+    lines_a: List[str] = []
+    lines_b: List[str] = []
+    # The run of equal lines since the last change: its length, its first
+    # n lines and the last n lines after those
+    equal = 0
+    head: List[str] = []
+    tail: Deque[str] = deque(maxlen=n)
+    for tag, chunk_a, chunk_b in chunks:
+        if tag == "equal":
+            taken = min(len(chunk_a), n - len(head))
+            head.extend(chunk_a[:taken])
+            rest = chunk_a[taken:]
+            tail.extend(rest[max(len(rest) - n, 0) :])
+            equal += len(chunk_a)
+            i += len(chunk_a)
+            j += len(chunk_a)
+            continue
+        if group and equal > n + n:
+            group.append(
+                ("equal", i - equal, i - equal + n, j - equal, j - equal + n)
+            )
+            lines_a.extend(head)
+            lines_b.extend(head)
+            yield group, lines_a, lines_b
+            group, lines_a, lines_b = [], [], []
+        if group:
+            if equal:
+                group.append(("equal", i - equal, i, j - equal, j))
+                lines_a.extend(head)
+                lines_a.extend(tail)
+                lines_b.extend(head)
+                lines_b.extend(tail)
+            if len(lines_a) + len(lines_b) > limit:
+                # Continue in an adjacent hunk, which needs no context
+                yield group, lines_a, lines_b
+                group, lines_a, lines_b = [], [], []
+        elif n:
+            context = (head + list(tail))[-n:]
+            if context:
+                group.append(
+                    ("equal", i - len(context), i, j - len(context), j)
+                )
+            lines_a = list(context)
+            lines_b = list(context)
+        equal = 0
+        head = []
+        tail.clear()
+        if group and group[-1][0] != "equal":
+            # Join changes that were matched in separate windows
+            i1, j1 = group[-1][1], group[-1][3]
+            del group[-1]
+        else:
+            i1, j1 = i, j
+        i += len(chunk_a)
+        j += len(chunk_b)
+        group.append((_change_tag(i - i1, j - j1), i1, i, j1, j))
+        lines_a.extend(chunk_a)
+        lines_b.extend(chunk_b)
+    if group:
+        if equal:
+            group.append(
+                (
+                    "equal",
+                    i - equal,
+                    i - equal + min(equal, n),
+                    j - equal,
+                    j - equal + min(equal, n),
+                )
+            )
+            lines_a.extend(head)
+            lines_b.extend(head)
+        yield group, lines_a, lines_b
+
+
+def unified_diff_windowed(
+    a: Iterable[str],
+    b: Iterable[str],
+    fromfile: str = "",
+    tofile: str = "",
+    fromfiledate: Union[str, float] = "",
+    tofiledate: Union[str, float] = "",
+    n: int = 3,
+    lineterm: str = "\n",
+    sequencematcher: Optional[Type[difflib.SequenceMatcher]] = None,
+    window: int = _WINDOW,
+    key: Optional[Callable[[str], Hashable]] = None,
+    ignore_blank_lines: bool = False,
+) -> Iterator[str]:
+    """Compare two streams of lines, holding only a window of each at once.
+
+    This generates a unified diff like unified_diff(), but a and b can be
+    any iterables of lines, such as open files, and are read window lines
+    at a time; every hunk is generated as soon as the windows it is in
+    have been matched. Memory use depends on window rather than on the
+    length of the inputs, which need not fit in memory.
+
+    Within a window, the anchors are the lines that are unique on both
+    sides, as found by the matcher. A window without any anchor is grown
+    to up to 16 * window lines to find the next one, so a change is
+    matched as well as by unified_diff() if it fits in that many lines;
+    larger changes come out as coarser replacements, after which the diff
+    catches up with the help of a sketch of the hashes of the last
+    16 * window lines of both sides. Long runs of changes are split into
+    adjacent hunks of about window lines.
+
+    :param sequencematcher: The matcher to match every window with,
+        defaults to PatienceSequenceMatcher
+    :param window: The number of lines of each side to match at once
+    :param key: If given, match lines by the result of calling key on
+        them, as unified_diff() does
+    :param ignore_blank_lines: Leave out the hunks whose changed lines are
+        all blank
+    """
+    if window < 1:
+        raise ValueError("window must be positive")
+    if sequencematcher is None:
+        sequencematcher = PatienceSequenceMatcher
+    started = False
+    chunks = _windowed_opcodes(a, b, window, sequencematcher, key)
+    for group, lines_a, lines_b in _windowed_hunks(chunks, n, window):
+        if ignore_blank_lines and _is_blank_change(
+            group, lines_a, lines_b, group[0][1], group[0][3]
+        ):
+            continue
+        lines = list(
+            _unified_diff_groups(
+                [group],
+                lines_a,
+                lines_b,
+                fromfile,
+                tofile,
+                fromfiledate,
+                tofiledate,
+                lineterm,
+                group[0][1],
+                group[0][3],
+            )
+        )
+        if started:
+            # Only the first hunk carries the file header
+            del lines[:2]
+        started = True
+        yield from lines
+
+
 def unified_diff_files(
     a: str,
     b: str,
     sequencematcher: Optional[Type[difflib.SequenceMatcher]] = None,
+    window: Optional[int] = None,
+    key: Optional[Callable[[str], Hashable]] = None,
+    ignore_blank_lines: bool = False,
 ) -> List[str]:
-    """Generate the diff for two files."""
+    """Generate the diff for two files.
+
+    Files with identical contents are detected by their size and digest,
+    without reading them into memory or decoding them.
+
+    :param window: If given, read the files window lines at a time with
+        unified_diff_windowed() rather than all at once
+    :param key: If given, match lines by the result of calling key on
+        them, as unified_diff() does
+    :param ignore_blank_lines: Leave out the hunks whose changed lines are
+        all blank
+    """
     # Should this actually be an error?
     if a == b:
         return []
+    if window is not None:
+        with contextlib.ExitStack() as stack:
+            file_a = sys.stdin if a == "-" else stack.enter_context(open(a))
+            file_b = sys.stdin if b == "-" else stack.enter_context(open(b))
+            return list(
+                unified_diff_windowed(
+                    file_a,
+                    file_b,
+                    fromfile=a,
+                    tofile=b,
+                    sequencematcher=sequencematcher,
+                    window=window,
+                    key=key,
+                    ignore_blank_lines=ignore_blank_lines,
+                )
+            )
+    # The common leading and trailing lines are not trimmed off before
+    # matching: they change which lines are unique, and so which lines the
+    # patience matcher pairs up
+    if a != "-" and b != "-" and _same_contents(a, b):
+        return []
+
     if a == "-":
         lines_a = sys.stdin.readlines()
         time_a = time.time()
@@ -144,26 +659,665 @@ def unified_diff_files(
             fromfile=a,
             tofile=b,
             sequencematcher=sequencematcher,
+            key=key,
+            ignore_blank_lines=ignore_blank_lines,
         )
     )
 
 
+def unified_diff_bytes(
+    a: Sequence[bytes],
+    b: Sequence[bytes],
+    fromfile: bytes = b"",
+    tofile: bytes = b"",
+    fromfiledate: Union[bytes, str, float] = b"",
+    tofiledate: Union[bytes, str, float] = b"",
+    n: int = 3,
+    lineterm: bytes = b"\n",
+    sequencematcher: Optional[Type[difflib.SequenceMatcher]] = None,
+    key: Optional[Callable[[bytes], Hashable]] = None,
+    ignore_blank_lines: bool = False,
+) -> Iterator[bytes]:
+    """Compare two sequences of byte lines; generate the delta as bytes.
+
+    This is the bytes equivalent of unified_diff(); no line is ever
+    decoded. The sequences can be any sequence of bytes, such as the result
+    of split_lines(), which only materializes the lines that end up in
+    the output. key and ignore_blank_lines are as for unified_diff(); a
+    LineKey normalizes the lines of split_lines() without creating them.
+    """
+    if sequencematcher is None:
+        sequencematcher = difflib.SequenceMatcher
+
+    if not isinstance(fromfiledate, bytes):
+        fromfiledate = str(fromfiledate).encode()
+    if not isinstance(tofiledate, bytes):
+        tofiledate = str(tofiledate).encode()
+    if fromfiledate:
+        fromfiledate = b"\t" + fromfiledate
+    if tofiledate:
+        tofiledate = b"\t" + tofiledate
+
+    groups = _grouped_opcodes(_keyed_matcher(sequencematcher, a, b, key), n)
+    if ignore_blank_lines:
+        groups = _drop_blank_groups(groups, a, b)
+    started = False
+    for group in groups:
+        if not started:
+            yield b"--- " + fromfile + fromfiledate + lineterm
+            yield b"+++ " + tofile + tofiledate + lineterm
+            started = True
+        i1, i2, j1, j2 = group[0][1], group[-1][2], group[0][3], group[-1][4]
+        yield b"@@ -%d,%d +%d,%d @@%s" % (
+            i1 + 1,
+            i2 - i1,
+            j1 + 1,
+            j2 - j1,
+            lineterm,
+        )
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                for line in a[i1:i2]:
+                    yield b" " + line
+                continue
+            if tag == "replace" or tag == "delete":
+                for line in a[i1:i2]:
+                    yield b"-" + line
+            if tag == "replace" or tag == "insert":
+                for line in b[j1:j2]:
+                    yield b"+" + line
+
+
+def _read_bytes(path: str) -> BytesLike:
+    """Return the contents of a file, memory-mapped where possible."""
+    if path == "-":
+        return sys.stdin.buffer.read()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files can not be mapped
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def unified_diff_files_bytes(
+    a: str,
+    b: str,
+    sequencematcher: Optional[Type[difflib.SequenceMatcher]] = None,
+    key: Optional[Callable[[bytes], Hashable]] = None,
+    ignore_blank_lines: bool = False,
+) -> List[bytes]:
+    """Generate the diff for two files, without decoding their contents.
+
+    Both files are memory-mapped and split into lines with split_lines(),
+    so only the lines that appear in the diff are copied out.
+
+    :param key: If given, match lines by the result of calling key on
+        them, as unified_diff_bytes() does
+    :param ignore_blank_lines: Leave out the hunks whose changed lines are
+        all blank
+    """
+    if a == b:
+        return []
+    lines_a = split_lines(_read_bytes(a))
+    lines_b = split_lines(_read_bytes(b))
+    return list(
+        unified_diff_bytes(
+            lines_a,
+            lines_b,
+            fromfile=os.fsencode(a),
+            tofile=os.fsencode(b),
+            sequencematcher=sequencematcher,
+            key=key,
+            ignore_blank_lines=ignore_blank_lines,
+        )
+    )
+
+
+def _file_digest(path: str) -> bytes:
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_BLOCK_SIZE), b""):
+            h.update(block)
+    return h.digest()
+
+
+def _same_contents(a: str, b: str) -> bool:
+    """Check whether two files are identical, by stat and then by digest."""
+    stat_a = os.stat(a)
+    stat_b = os.stat(b)
+    if os.path.samestat(stat_a, stat_b):
+        return True
+    if stat_a.st_size != stat_b.st_size:
+        return False
+    return _file_digest(a) == _file_digest(b)
+
+
+def _tree_files(path: str) -> Iterator[str]:
+    """Generate the paths of all files below a directory, in sorted order."""
+    for name in sorted(os.listdir(path)):
+        child = os.path.join(path, name)
+        if os.path.isdir(child):
+            yield from _tree_files(child)
+        else:
+            yield child
+
+
+def _dir_pairs(
+    a: str, b: str, expand: bool = False
+) -> Iterator[Tuple[str, str]]:
+    """Generate the paths of the entries of two trees, in sorted order.
+
+    Entries that only exist on one side are generated with an empty path
+    on the other side; directories that exist on both sides are entered.
+
+    :param expand: Whether to also enter directories that only exist on one
+        side, so that only files are generated
+    """
+    names_a = set(os.listdir(a))
+    names_b = set(os.listdir(b))
+    for name in sorted(names_a | names_b):
+        path_a = os.path.join(a, name) if name in names_a else ""
+        path_b = os.path.join(b, name) if name in names_b else ""
+        dir_a = bool(path_a) and os.path.isdir(path_a)
+        dir_b = bool(path_b) and os.path.isdir(path_b)
+        if dir_a and dir_b:
+            yield from _dir_pairs(path_a, path_b, expand)
+        elif not expand or not (dir_a or dir_b):
+            yield path_a, path_b
+        elif dir_a:
+            if path_b:
+                yield "", path_b
+            for path in _tree_files(path_a):
+                yield path, ""
+        else:
+            if path_a:
+                yield path_a, ""
+            for path in _tree_files(path_b):
+                yield "", path
+
+
+def _map_ordered(
+    func: Callable[[_T], _R], items: Iterable[_T], jobs: Optional[int]
+) -> Iterator[_R]:
+    """Apply func to items on a pool of jobs worker processes.
+
+    The results are generated in the order of items, with at most 4 * jobs
+    of them pending at once.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+    executor = concurrent.futures.ProcessPoolExecutor(jobs)
+    pending: Deque[concurrent.futures.Future[_R]] = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            while len(pending) >= jobs * 4 or pending[0].done():
+                yield pending.popleft().result()
+                if not pending:
+                    break
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def _diff_dir_pair(
+    diff: Callable[..., List[AnyStr]],
+    encode: Callable[[str], AnyStr],
+    sequencematcher: Optional[Type[difflib.SequenceMatcher]],
+    key: Optional[Callable[[AnyStr], Hashable]],
+    ignore_blank_lines: bool,
+    pair: Tuple[str, str],
+) -> List[AnyStr]:
+    path_a, path_b = pair
+    if not path_a or not path_b:
+        path = path_a or path_b
+        return [
+            encode(
+                f"Only in {os.path.dirname(path)}: {os.path.basename(path)}\n"
+            )
+        ]
+    if os.path.isdir(path_a) or os.path.isdir(path_b):
+        kind_a, kind_b = (
+            "directory" if os.path.isdir(path) else "regular file"
+            for path in pair
+        )
+        return [
+            encode(
+                f"File {path_a} is a {kind_a} while file {path_b} is a "
+                f"{kind_b}\n"
+            )
+        ]
+    if _same_contents(path_a, path_b):
+        return []
+    return diff(
+        path_a,
+        path_b,
+        sequencematcher=sequencematcher,
+        key=key,
+        ignore_blank_lines=ignore_blank_lines,
+    )
+
+
+def unified_diff_dirs(
+    a: str,
+    b: str,
+    jobs: Optional[int] = None,
+    sequencematcher: Optional[Type[difflib.SequenceMatcher]] = None,
+    key: Optional[Callable[[str], Hashable]] = None,
+    ignore_blank_lines: bool = False,
+) -> Iterator[List[str]]:
+    """Generate the diffs for all files in two directory trees.
+
+    Files are paired up by their path relative to a and b, and visited in
+    sorted order. Files with the same size are compared by digest before
+    they are diffed, and identical files produce no output. Files that only
+    exist on one side produce an "Only in" line, like diff -r.
+
+    :param jobs: The number of worker processes to diff with, defaults to
+        the number of CPUs
+    :param key: If given, match lines by the result of calling key on
+        them, as unified_diff() does; it must be picklable
+    :param ignore_blank_lines: Leave out the hunks whose changed lines are
+        all blank
+    :return: An iterator over the output for each pair of files, in a
+        stable order. Only a bounded number of results is held at once.
+    """
+    return _map_ordered(
+        functools.partial(
+            _diff_dir_pair,
+            unified_diff_files,
+            str,
+            sequencematcher,
+            key,
+            ignore_blank_lines,
+        ),
+        _dir_pairs(a, b),
+        jobs,
+    )
+
+
+def unified_diff_dirs_bytes(
+    a: str,
+    b: str,
+    jobs: Optional[int] = None,
+    sequencematcher: Optional[Type[difflib.SequenceMatcher]] = None,
+    key: Optional[Callable[[bytes], Hashable]] = None,
+    ignore_blank_lines: bool = False,
+) -> Iterator[List[bytes]]:
+    """Generate the diffs for all files in two trees, without decoding.
+
+    This is unified_diff_dirs() using unified_diff_files_bytes().
+    """
+    return _map_ordered(
+        functools.partial(
+            _diff_dir_pair,
+            unified_diff_files_bytes,
+            os.fsencode,
+            sequencematcher,
+            key,
+            ignore_blank_lines,
+        ),
+        _dir_pairs(a, b),
+        jobs,
+    )
+
+
+def diff_stats(
+    a: Sequence,
+    b: Sequence,
+    sequencematcher: Optional[Type[difflib.SequenceMatcher]] = None,
+    key: Optional[Callable[[Any], Hashable]] = None,
+    ignore_blank_lines: bool = False,
+) -> Tuple[int, int]:
+    """Count the lines added and removed to turn a into b.
+
+    The counts are computed from the matching blocks, without generating
+    any opcodes or output lines.
+
+    :param sequencematcher: The matcher to use, defaults to
+        PatienceSequenceMatcher
+    :param key: If given, match lines by the result of calling key on
+        them, as unified_diff() does
+    :param ignore_blank_lines: Leave out the changes of the hunks of a
+        unified diff whose changed lines are all blank
+    :return: A tuple with the number of added and removed lines
+    """
+    if sequencematcher is None:
+        sequencematcher = PatienceSequenceMatcher
+    matcher = _keyed_matcher(sequencematcher, a, b, key)
+    if ignore_blank_lines:
+        groups = _drop_blank_groups(_grouped_opcodes(matcher, 3), a, b)
+        opcodes = [opcode for group in groups for opcode in group]
+        return (
+            sum(j2 - j1 for tag, _, _, j1, j2 in opcodes if tag != "equal"),
+            sum(i2 - i1 for tag, i1, i2, _, _ in opcodes if tag != "equal"),
+        )
+    matched = sum(block[2] for block in matcher.get_matching_blocks())
+    return len(b) - matched, len(a) - matched
+
+
+def _read_data(path: str) -> bytes:
+    if path == "-":
+        return sys.stdin.buffer.read()
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def diff_stats_files(
+    a: str,
+    b: str,
+    sequencematcher: Optional[Type[difflib.SequenceMatcher]] = None,
+    key: Optional[Callable[[bytes], Hashable]] = None,
+    ignore_blank_lines: bool = False,
+) -> Tuple[int, int]:
+    """Count the lines added and removed between two files.
+
+    The files are compared as bytes, and split into lines with
+    split_lines(). key and ignore_blank_lines are as for diff_stats().
+
+    :param sequencematcher: The matcher to use, defaults to
+        PatienceSequenceMatcher
+    :return: A tuple with the number of added and removed lines
+    """
+    if a == b:
+        return 0, 0
+    data_a = _read_data(a)
+    data_b = _read_data(b)
+    if data_a == data_b:
+        return 0, 0
+    # The common leading and trailing lines are not trimmed off: they
+    # change which lines the matcher pairs up, and so the counts
+    return diff_stats(
+        split_lines(data_a),
+        split_lines(data_b),
+        sequencematcher,
+        key,
+        ignore_blank_lines,
+    )
+
+
+def _diff_stats_dir_pair(
+    sequencematcher: Optional[Type[difflib.SequenceMatcher]],
+    key: Optional[Callable[[bytes], Hashable]],
+    ignore_blank_lines: bool,
+    pair: Tuple[str, str],
+) -> Tuple[str, str, int, int]:
+    path_a, path_b = pair
+    if not path_b:
+        data = _read_data(path_a)
+        return path_a, path_b, 0, _count_lines(data, 0, len(data))
+    if not path_a:
+        data = _read_data(path_b)
+        return path_a, path_b, _count_lines(data, 0, len(data)), 0
+    if _same_contents(path_a, path_b):
+        return path_a, path_b, 0, 0
+    return (path_a, path_b) + diff_stats_files(
+        path_a, path_b, sequencematcher, key, ignore_blank_lines
+    )
+
+
+def diff_stats_dirs(
+    a: str,
+    b: str,
+    jobs: Optional[int] = None,
+    sequencematcher: Optional[Type[difflib.SequenceMatcher]] = None,
+    key: Optional[Callable[[bytes], Hashable]] = None,
+    ignore_blank_lines: bool = False,
+) -> Iterator[Tuple[str, str, int, int]]:
+    """Count the lines added and removed for all files in two trees.
+
+    Files are paired up and compared like unified_diff_dirs() does, and
+    are counted like diff_stats_files() does, with key and
+    ignore_blank_lines as for diff_stats(); key must be picklable.
+
+    :param jobs: The number of worker processes to use, defaults to the
+        number of CPUs
+    :return: An iterator over (path_a, path_b, added, removed) tuples for
+        every file that differs, in sorted order. For files that only exist
+        on one side the other path is empty, and all their lines are
+        counted as added or removed.
+    """
+    for path_a, path_b, added, removed in _map_ordered(
+        functools.partial(
+            _diff_stats_dir_pair, sequencematcher, key, ignore_blank_lines
+        ),
+        _dir_pairs(a, b, expand=True),
+        jobs,
+    ):
+        if added or removed or not path_a or not path_b:
+            yield path_a, path_b, added, removed
+
+
+@overload
+def render_unified(
+    a: Sequence[str],
+    b: Sequence[str],
+    fromfile: Optional[str] = None,
+    tofile: Optional[str] = None,
+    fromfiledate: Union[str, float, None] = None,
+    tofiledate: Union[str, float, None] = None,
+    n: int = 3,
+    lineterm: str = "\n",
+) -> str: ...
+
+
+@overload
+def render_unified(
+    a: Sequence[bytes],
+    b: Sequence[bytes],
+    fromfile: Optional[bytes] = None,
+    tofile: Optional[bytes] = None,
+    fromfiledate: Union[bytes, str, float, None] = None,
+    tofiledate: Union[bytes, str, float, None] = None,
+    n: int = 3,
+    *,
+    lineterm: bytes,
+) -> bytes: ...
+
+
+def render_unified(
+    a: Union[Sequence[str], Sequence[bytes]],
+    b: Union[Sequence[str], Sequence[bytes]],
+    fromfile: Union[str, bytes, None] = None,
+    tofile: Union[str, bytes, None] = None,
+    fromfiledate: Union[str, bytes, float, None] = None,
+    tofiledate: Union[str, bytes, float, None] = None,
+    n: int = 3,
+    lineterm: Union[str, bytes] = "\n",
+) -> Union[str, bytes]:
+    """Render a unified diff of a and b as a single string.
+
+    The result is identical to joining the lines generated by
+    unified_diff() with the patience matcher, or by unified_diff_bytes()
+    if lineterm is bytes. With the Rust extension the output is built
+    natively, without creating a Python object for every line.
+    """
+    if _render_unified is not None:
+        try:
+            return _render_unified(
+                a, b, fromfile, tofile, fromfiledate, tofiledate, n, lineterm
+            )
+        except UnicodeEncodeError:
+            # Lone surrogates can not be encoded natively
+            pass
+    if isinstance(lineterm, bytes):
+        return b"".join(
+            unified_diff_bytes(
+                a,  # type: ignore[arg-type]
+                b,  # type: ignore[arg-type]
+                b"" if fromfile is None else fromfile,  # type: ignore[arg-type]
+                b"" if tofile is None else tofile,  # type: ignore[arg-type]
+                b"" if fromfiledate is None else fromfiledate,
+                b"" if tofiledate is None else tofiledate,
+                n,
+                lineterm,
+                sequencematcher=PatienceSequenceMatcher,
+            )
+        )
+    return "".join(
+        unified_diff(
+            a,  # type: ignore[arg-type]
+            b,  # type: ignore[arg-type]
+            "" if fromfile is None else fromfile,  # type: ignore[arg-type]
+            "" if tofile is None else tofile,  # type: ignore[arg-type]
+            "" if fromfiledate is None else fromfiledate,  # type: ignore[arg-type]
+            "" if tofiledate is None else tofiledate,  # type: ignore[arg-type]
+            n,
+            lineterm,
+            sequencematcher=PatienceSequenceMatcher,
+        )
+    )
+
+
+def _get_opcodes(
+    sequencematcher: Type[difflib.SequenceMatcher], a: Sequence, b: Sequence
+) -> List[Opcode]:
+    opcodes: List[Opcode] = list(sequencematcher(None, a, b).get_opcodes())
+    return opcodes
+
+
+async def adiff(
+    a: Sequence,
+    b: Sequence,
+    sequencematcher: Optional[Type[difflib.SequenceMatcher]] = None,
+    executor: Optional[concurrent.futures.Executor] = None,
+) -> List[Opcode]:
+    """Compute the opcodes to turn a into b without blocking the event loop.
+
+    The matching runs on executor (by default, the loop's default
+    executor). The Rust matcher releases the GIL while matching, so
+    several diffs can run in parallel on a thread pool.
+
+    If the awaiting task is cancelled, the result of the diff is discarded
+    as soon as it is done.
+
+    :param sequencematcher: The matcher to use, defaults to
+        PatienceSequenceMatcher
+    :param executor: The concurrent.futures.Executor to match on
+    """
+    if sequencematcher is None:
+        sequencematcher = PatienceSequenceMatcher
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, _get_opcodes, sequencematcher, a, b
+    )
+
+
+async def aunified_diff_hunks(
+    a: Sequence[str],
+    b: Sequence[str],
+    fromfile: str = "",
+    tofile: str = "",
+    n: int = 3,
+    lineterm: str = "\n",
+    sequencematcher: Optional[Type[difflib.SequenceMatcher]] = None,
+    executor: Optional[concurrent.futures.Executor] = None,
+) -> AsyncIterator[List[str]]:
+    """Generate the hunks of a unified diff without blocking the event loop.
+
+    Each item is the list of lines of one hunk, as generated by
+    unified_diff(); the first hunk starts with the --- and +++ lines. The
+    matching and the grouping of every hunk run on executor, so a consumer
+    that stops iterating, or whose task is cancelled, does no further work.
+
+    :param sequencematcher: The matcher to use, defaults to
+        PatienceSequenceMatcher
+    :param executor: The concurrent.futures.Executor to match on
+    """
+    if sequencematcher is None:
+        sequencematcher = PatienceSequenceMatcher
+    loop = asyncio.get_running_loop()
+    matcher = await loop.run_in_executor(executor, sequencematcher, None, a, b)
+    groups = iter(_grouped_opcodes(matcher, n))
+    started = False
+    while True:
+        group = await loop.run_in_executor(executor, next, groups, None)
+        if group is None:
+            return
+        lines = list(
+            _unified_diff_groups(
+                [group], a, b, fromfile, tofile, "", "", lineterm
+            )
+        )
+        if started:
+            # Only the first hunk carries the file header
+            del lines[:2]
+        started = True
+        yield lines
+
+
+async def aunified_diff_files(
+    a: str,
+    b: str,
+    sequencematcher: Optional[Type[difflib.SequenceMatcher]] = None,
+    executor: Optional[concurrent.futures.Executor] = None,
+) -> List[str]:
+    """Generate the diff for two files without blocking the event loop.
+
+    This is unified_diff_files() with both reading the files and matching
+    them run on executor.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, unified_diff_files, a, b, sequencematcher
+    )
+
+
+async def aunified_diff_files_bytes(
+    a: str,
+    b: str,
+    sequencematcher: Optional[Type[difflib.SequenceMatcher]] = None,
+    executor: Optional[concurrent.futures.Executor] = None,
+) -> List[bytes]:
+    """Generate the diff for two files as bytes, without blocking.
+
+    This is unified_diff_files_bytes() run on executor.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, unified_diff_files_bytes, a, b, sequencematcher
+    )
+
+
 PatienceSequenceMatcher: Type[difflib.SequenceMatcher]
+CancellationToken: Callable[[], Cancellable]
+split_lines: Callable[[BytesLike], Sequence[bytes]]
+_render_unified: Optional[Callable[..., Union[str, bytes]]]
 
 
 # Try to import the Rust implementation first
 try:
+    from ._patiencediff_rs import (
+        CancellationToken_rs as CancellationToken,
+    )
     from ._patiencediff_rs import (
         PatienceSequenceMatcher_rs as PatienceSequenceMatcher,
     )
+    from ._patiencediff_rs import diff_many_rs as diff_many
     from ._patiencediff_rs import recurse_matches_rs as recurse_matches
+    from ._patiencediff_rs import refine_opcodes_rs as refine_opcodes
+    from ._patiencediff_rs import render_unified_rs as _render_unified
+    from ._patiencediff_rs import split_lines_rs as split_lines
     from ._patiencediff_rs import unique_lcs_rs as unique_lcs
 except ImportError:
     # Fall back to the Python implementation if Rust is not available
+    from ._patiencediff_py import (
+        CancellationToken_py as CancellationToken,
+    )
     from ._patiencediff_py import (
         PatienceSequenceMatcher_py as PatienceSequenceMatcher,
     )
+    from ._patiencediff_py import diff_many_py as diff_many
     from ._patiencediff_py import (
         recurse_matches_py as recurse_matches,
     )
+    from ._patiencediff_py import refine_opcodes_py as refine_opcodes
+    from ._patiencediff_py import split_lines_py as split_lines
     from ._patiencediff_py import unique_lcs_py as unique_lcs
+
+    _render_unified = None
@@ -14,11 +14,52 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import contextlib
 import difflib
+import functools
+import os
 import sys
-from typing import List, Optional
+from typing import List, Optional, Tuple, Type, cast
 
-from . import PatienceSequenceMatcher, unified_diff_files
+from . import (
+    LineKey,
+    PatienceSequenceMatcher,
+    diff_stats_dirs,
+    diff_stats_files,
+    unified_diff_dirs,
+    unified_diff_dirs_bytes,
+    unified_diff_files,
+    unified_diff_files_bytes,
+    unified_diff_windowed,
+)
+
+
+def write_stat(stats: List[Tuple[str, int, int]], width: int = 50) -> None:
+    """Write a diffstat, with a histogram of at most width columns."""
+    if not stats:
+        return
+    name_width = max(len(name) for name, _, _ in stats)
+    most = max(added + removed for _, added, removed in stats)
+    count_width = len(str(most))
+    for name, added, removed in stats:
+        plus, minus = added, removed
+        if most > width:
+            plus = -(-added * width // most)
+            minus = -(-removed * width // most)
+        sys.stdout.write(
+            f" {name:<{name_width}} | {added + removed:>{count_width}} "
+            f"{'+' * plus}{'-' * minus}\n"
+        )
+    insertions = sum(added for _, added, _ in stats)
+    deletions = sum(removed for _, _, removed in stats)
+    summary = f" {len(stats)} file{'s' if len(stats) != 1 else ''} changed"
+    if insertions:
+        summary += (
+            f", {insertions} insertion{'s' if insertions != 1 else ''}(+)"
+        )
+    if deletions:
+        summary += f", {deletions} deletion{'s' if deletions != 1 else ''}(-)"
+    sys.stdout.write(summary + "\n")
 
 
 def main(argv: Optional[List[str]] = None) -> int:
@@ -26,6 +67,7 @@ def main(argv: Optional[List[str]] = None) -> int:
 
     p = optparse.OptionParser(
         usage="%prog [options] file_a file_b"
+        "\n       %prog -r [options] dir_a dir_b"
         '\nFiles can be "-" to read from stdin'
     )
     p.add_option(
@@ -44,10 +86,99 @@ def main(argv: Optional[List[str]] = None) -> int:
         default="patience",
         help="Use python's difflib algorithm",
     )
+    p.add_option(
+        "--histogram",
+        dest="matcher",
+        action="store_const",
+        const="histogram",
+        default="patience",
+        help="Use the patience algorithm, anchoring on the least frequent "
+        "lines where there are no unique ones",
+    )
+    p.add_option(
+        "--binary",
+        action="store_true",
+        default=False,
+        help="Compare the files as bytes, without decoding them",
+    )
+    p.add_option(
+        "-r",
+        "--recursive",
+        action="store_true",
+        default=False,
+        help="Recursively compare the files in two directories",
+    )
+    p.add_option(
+        "-j",
+        "--jobs",
+        type="int",
+        default=1,
+        help="Number of worker processes for recursive diffs",
+    )
+    p.add_option(
+        "--stat",
+        dest="stat",
+        action="store_const",
+        const="stat",
+        help="Only print a summary of the changed lines of every file",
+    )
+    p.add_option(
+        "--numstat",
+        dest="stat",
+        action="store_const",
+        const="numstat",
+        help="Only print the number of added and removed lines of every file",
+    )
+    p.add_option(
+        "--window",
+        type="int",
+        metavar="LINES",
+        help="Read the files LINES lines at a time and print every hunk as "
+        "soon as it is found, for files that do not fit in memory",
+    )
+
+    p.add_option(
+        "-w",
+        "--ignore-all-space",
+        action="store_true",
+        default=False,
+        help="Ignore all whitespace when matching lines",
+    )
+    p.add_option(
+        "-b",
+        "--ignore-space-change",
+        action="store_true",
+        default=False,
+        help="Ignore changes in the amount of whitespace",
+    )
+    p.add_option(
+        "-i",
+        "--ignore-case",
+        action="store_true",
+        default=False,
+        help="Ignore case differences",
+    )
+    p.add_option(
+        "--ignore-eol",
+        action="store_true",
+        default=False,
+        help="Ignore whether lines end in LF, CRLF or CR",
+    )
+    p.add_option(
+        "-B",
+        "--ignore-blank-lines",
+        action="store_true",
+        default=False,
+        help="Ignore changes whose lines are all blank",
+    )
 
     algorithms = {
         "patience": PatienceSequenceMatcher,
         "difflib": difflib.SequenceMatcher,
+        "histogram": cast(
+            Type[difflib.SequenceMatcher],
+            functools.partial(PatienceSequenceMatcher, histogram=True),
+        ),
     }
 
     (opts, args) = p.parse_args(argv)
@@ -57,9 +188,130 @@ def main(argv: Optional[List[str]] = None) -> int:
         print("You must supply 2 filenames to diff")
         return -1
 
-    for line in unified_diff_files(args[0], args[1], sequencematcher=matcher):
+    if opts.window is not None and (
+        opts.stat or opts.recursive or opts.binary
+    ):
+        p.error("--window can not be combined with --stat, -r or --binary")
+    if opts.window is not None and opts.window < 1:
+        p.error("--window must be positive")
+
+    key = None
+    if (
+        opts.ignore_all_space
+        or opts.ignore_space_change
+        or opts.ignore_case
+        or opts.ignore_eol
+    ):
+        key = LineKey(
+            ignore_all_space=opts.ignore_all_space,
+            ignore_space_change=opts.ignore_space_change,
+            ignore_case=opts.ignore_case,
+            ignore_eol=opts.ignore_eol,
+        )
+    if opts.stat:
+        if opts.recursive:
+            stats = [
+                (
+                    os.path.relpath(path_a, args[0])
+                    if path_a
+                    else os.path.relpath(path_b, args[1]),
+                    added,
+                    removed,
+                )
+                for path_a, path_b, added, removed in diff_stats_dirs(
+                    args[0],
+                    args[1],
+                    jobs=opts.jobs,
+                    sequencematcher=matcher,
+                    key=key,
+                    ignore_blank_lines=opts.ignore_blank_lines,
+                )
+            ]
+        else:
+            added, removed = diff_stats_files(
+                args[0],
+                args[1],
+                sequencematcher=matcher,
+                key=key,
+                ignore_blank_lines=opts.ignore_blank_lines,
+            )
+            name = args[0] if args[0] == args[1] else f"{args[0]} => {args[1]}"
+            stats = [(name, added, removed)] if added or removed else []
+        if opts.stat == "numstat":
+            for name, added, removed in stats:
+                sys.stdout.write(f"{added}\t{removed}\t{name}\n")
+        else:
+            write_stat(stats)
+        return 0
+
+    if opts.recursive:
+        if opts.binary:
+            sys.stdout.flush()
+            for blines in unified_diff_dirs_bytes(
+                args[0],
+                args[1],
+                jobs=opts.jobs,
+                sequencematcher=matcher,
+                key=key,
+                ignore_blank_lines=opts.ignore_blank_lines,
+            ):
+                sys.stdout.buffer.writelines(blines)
+            return 0
+        for lines in unified_diff_dirs(
+            args[0],
+            args[1],
+            jobs=opts.jobs,
+            sequencematcher=matcher,
+            key=key,
+            ignore_blank_lines=opts.ignore_blank_lines,
+        ):
+            sys.stdout.writelines(lines)
+        return 0
+
+    if opts.binary:
+        sys.stdout.flush()
+        for bline in unified_diff_files_bytes(
+            args[0],
+            args[1],
+            sequencematcher=matcher,
+            key=key,
+            ignore_blank_lines=opts.ignore_blank_lines,
+        ):
+            sys.stdout.buffer.write(bline)
+        return 0
+
+    if opts.window is not None:
+        if args[0] == args[1]:
+            return 0
+        with contextlib.ExitStack() as stack:
+            files = [
+                sys.stdin if arg == "-" else stack.enter_context(open(arg))
+                for arg in args
+            ]
+            sys.stdout.writelines(
+                unified_diff_windowed(
+                    files[0],
+                    files[1],
+                    fromfile=args[0],
+                    tofile=args[1],
+                    sequencematcher=matcher,
+                    window=opts.window,
+                    key=key,
+                    ignore_blank_lines=opts.ignore_blank_lines,
+                )
+            )
+        return 0
+
+    for line in unified_diff_files(
+        args[0],
+        args[1],
+        sequencematcher=matcher,
+        key=key,
+        ignore_blank_lines=opts.ignore_blank_lines,
+    ):
         sys.stdout.write(line)
     return 0
 
 
-sys.exit(main(sys.argv[1:]))
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
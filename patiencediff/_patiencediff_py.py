@@ -15,27 +15,304 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 import difflib
+import io
+import mmap
+import os
+import re
+import sys
+from array import array
 from bisect import bisect
+from collections import Counter
+from time import perf_counter
 from typing import (
     Callable,
     Dict,
     Generic,
     Hashable,
+    Iterable,
+    Iterator,
     List,
     Optional,
+    Protocol,
     Sequence,
     Tuple,
     TypeVar,
+    Union,
+    cast,
+    overload,
 )
 
 T = TypeVar("T", bound=Hashable)
 
+Opcode = Tuple[str, int, int, int, int]
+
+BytesLike = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+# A region of a and b, as (alo, blo, ahi, bhi)
+Region = Tuple[int, int, int, int]
+
+# The matches found in every top-level gap of a diff
+Outline = Dict[Region, List[Tuple[int, int]]]
+
+# The part of b that changed since an Outline was recorded, as
+# (lo, hi, shift): b[lo:hi] may have changed, and every line from hi
+# onwards was shift lines earlier
+Edit = Tuple[int, int, int]
+
 
 class MaxRecursionDepth(Exception):
     def __init__(self) -> None:
         super().__init__("max recursion depth reached")
 
 
+class Cancellable(Protocol):
+    """What matchers need of the token passed as their cancel argument."""
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether the diffs using this token should stop."""
+        ...
+
+    def cancel(self) -> None:
+        """Stop the diffs using this token."""
+        ...
+
+
+class CancellationToken_py:
+    """A flag that stops the diffs using it once it is cancelled.
+
+    Pass it as the cancel argument of a matcher, and call cancel() from
+    another thread (or a signal handler) to make get_matching_blocks()
+    return early, with the matcher flagged as degraded.
+    """
+
+    def __init__(self) -> None:
+        """Create a token which has not been cancelled."""
+        self._cancelled = False
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether cancel() has been called."""
+        return self._cancelled
+
+    def cancel(self) -> None:
+        """Stop the diffs using this token."""
+        self._cancelled = True
+
+
+_SPACE_RE = re.compile(r"[ \t\n\r\x0b\x0c]+")
+_SPACE_BYTES_RE = re.compile(rb"[ \t\n\r\x0b\x0c]+")
+
+
+class LineKey:
+    r"""Normalize lines, so that matchers ignore some of their differences.
+
+    Pass it as the key argument of a matcher or of unified_diff(): lines
+    are then matched by their normalized form, while the diff still shows
+    the original lines. Lines can be str or bytes; whitespace means ASCII
+    whitespace, and case is folded like str.lower() and bytes.lower() do.
+    The Rust matcher recognizes LineKey and normalizes lines natively,
+    without calling it.
+
+    >>> LineKey(ignore_space_change=True)("a  b \r\n")
+    'a b'
+    """
+
+    __slots__ = (
+        "ignore_all_space",
+        "ignore_space_change",
+        "ignore_case",
+        "ignore_eol",
+    )
+
+    def __init__(
+        self,
+        ignore_all_space: bool = False,
+        ignore_space_change: bool = False,
+        ignore_case: bool = False,
+        ignore_eol: bool = False,
+    ) -> None:
+        r"""Create a key.
+
+        :param ignore_all_space: Ignore all whitespace, like diff -w
+        :param ignore_space_change: Ignore changes in the amount of
+            whitespace and trailing whitespace, like diff -b
+        :param ignore_case: Ignore the case of letters, like diff -i
+        :param ignore_eol: Ignore whether lines end in "\n", "\r\n" or
+            "\r", or not at all
+        """
+        self.ignore_all_space = ignore_all_space
+        self.ignore_space_change = ignore_space_change
+        self.ignore_case = ignore_case
+        self.ignore_eol = ignore_eol
+
+    def __repr__(self) -> str:
+        flags = ", ".join(
+            f"{name}=True" for name in self.__slots__ if getattr(self, name)
+        )
+        return f"{type(self).__name__}({flags})"
+
+    @overload
+    def __call__(self, line: str) -> str: ...
+
+    @overload
+    def __call__(self, line: bytes) -> bytes: ...
+
+    def __call__(self, line: Union[str, bytes]) -> Union[str, bytes]:
+        """Return the normalized form of line."""
+        if isinstance(line, str):
+            if self.ignore_eol:
+                if line.endswith("\r\n"):
+                    line = line[:-2]
+                elif line.endswith(("\n", "\r")):
+                    line = line[:-1]
+            if self.ignore_all_space:
+                line = _SPACE_RE.sub("", line)
+            elif self.ignore_space_change:
+                line = _SPACE_RE.sub(" ", line).rstrip(" ")
+        elif isinstance(line, bytes):
+            if self.ignore_eol:
+                if line.endswith(b"\r\n"):
+                    line = line[:-2]
+                elif line.endswith((b"\n", b"\r")):
+                    line = line[:-1]
+            if self.ignore_all_space:
+                line = _SPACE_BYTES_RE.sub(b"", line)
+            elif self.ignore_space_change:
+                line = _SPACE_BYTES_RE.sub(b" ", line).rstrip(b" ")
+        else:
+            raise TypeError(
+                f"LineKey needs str or bytes lines, not {type(line).__name__}"
+            )
+        if self.ignore_case:
+            line = line.lower()
+        return line
+
+
+class _Deadline:
+    """When to stop matching: after a timeout, or once a token is cancelled.
+
+    :ivar expired: Whether a check() has found that matching should stop
+    """
+
+    def __init__(
+        self, timeout: Optional[float], cancel: Optional[Cancellable]
+    ) -> None:
+        """Start the timeout, if any, from now."""
+        self._end = None if timeout is None else perf_counter() + timeout
+        self._cancel = cancel
+        self.expired = False
+
+    def check(self) -> bool:
+        """Check whether matching should stop, remembering if it should."""
+        if not self.expired:
+            self.expired = (
+                self._end is not None and perf_counter() >= self._end
+            ) or (self._cancel is not None and self._cancel.cancelled)
+        return self.expired
+
+
+class DiffStats:
+    """Statistics about how a matcher found its matching blocks.
+
+    Matchers fill these in when created with collect_stats=True, or when
+    a hook has been installed with set_stats_hook(). Times are in
+    seconds; with the Rust matcher, unique_lcs_seconds adds up the time
+    spent on every thread, so it can exceed the wall clock time.
+    """
+
+    __slots__ = (
+        "lines_a",
+        "lines_b",
+        "tokenize_seconds",
+        "unique_lcs_seconds",
+        "recursion_seconds",
+        "conversion_seconds",
+        "unique_lcs_calls",
+        "max_depth",
+        "max_recursion",
+        "unique_lines",
+        "allocated_bytes",
+    )
+
+    def __init__(self, max_recursion: int = 10) -> None:
+        #: The number of items in a and b
+        self.lines_a = 0
+        self.lines_b = 0
+        #: Time spent turning items into tokens; the Python matcher
+        #: counts applying the key and indexing the unique lines
+        self.tokenize_seconds = 0.0
+        #: Time spent finding unique common lines, in unique_lcs calls
+        self.unique_lcs_seconds = 0.0
+        #: Time spent in recurse_matches, outside of unique_lcs
+        self.recursion_seconds = 0.0
+        #: Time spent converting the results to Python objects
+        self.conversion_seconds = 0.0
+        self.unique_lcs_calls = 0
+        #: The deepest recursion reached, out of max_recursion
+        self.max_depth = 0
+        self.max_recursion = max_recursion
+        #: The number of lines in a that occur exactly once in a and in b
+        self.unique_lines = 0
+        #: The approximate size of the tokens, matches and blocks
+        self.allocated_bytes = 0
+
+    @property
+    def unique_fraction(self) -> float:
+        """The fraction of all lines that can anchor the diff."""
+        total = self.lines_a + self.lines_b
+        return 2 * self.unique_lines / total if total else 0.0
+
+    def as_dict(self) -> Dict[str, Union[int, float]]:
+        """Return all statistics as a dict, for exporting as metrics."""
+        result: Dict[str, Union[int, float]] = {
+            name: getattr(self, name) for name in self.__slots__
+        }
+        result["unique_fraction"] = self.unique_fraction
+        return result
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{k}={v!r}" for k, v in self.as_dict().items())
+        return f"{type(self).__name__}({fields})"
+
+
+_stats_hook: Optional[Callable[[DiffStats], None]] = None
+
+
+def set_stats_hook(
+    hook: Optional[Callable[[DiffStats], None]],
+) -> Optional[Callable[[DiffStats], None]]:
+    """Install a function to call with the DiffStats of every diff.
+
+    While a hook is installed, every matcher collects statistics, whether
+    or not it was created with collect_stats=True. The hook is called
+    from the thread that computed the diff.
+
+    :param hook: The function to call, or None to remove the hook
+    :return: The previously installed hook, if any
+    """
+    global _stats_hook
+    previous = _stats_hook
+    _stats_hook = hook
+    return previous
+
+
+def _report_stats(stats: DiffStats) -> None:
+    hook = _stats_hook
+    if hook is not None:
+        hook(stats)
+
+
+def _count_unique_lines(a: Sequence[T], b: Sequence[T]) -> int:
+    """Return the number of lines that occur exactly once in a and in b."""
+    counts_b = Counter(b)
+    return sum(
+        1
+        for line, count in Counter(a).items()
+        if count == 1 and counts_b.get(line) == 1
+    )
+
+
 def unique_lcs_py(a: Sequence[T], b: Sequence[T]) -> List[Tuple[int, int]]:
     """Find the longest common subset for unique lines.
 
@@ -50,33 +327,69 @@ def unique_lcs_py(a: Sequence[T], b: Sequence[T]) -> List[Tuple[int, int]]:
     The longest common subset uses the Patience Sorting algorithm:
     http://en.wikipedia.org/wiki/Patience_sorting
     """
-    # set index[line in a] = position of line in a unless
-    # a is a duplicate, in which case it's set to None
-    index: Dict[T, Optional[int]] = {}
-    for i, line in enumerate(a):
-        if line in index:
-            index[line] = None
-        else:
-            index[line] = i
-    # make btoa[i] = position of line i in a, unless
+    return _unique_lcs_range(a, b, 0, 0, len(a), len(b))
+
+
+def _unique_lcs_range(
+    a: Sequence[T],
+    b: Sequence[T],
+    alo: int,
+    blo: int,
+    ahi: int,
+    bhi: int,
+    unique_a: Optional[Dict[T, int]] = None,
+    unique_b: Optional[Dict[T, int]] = None,
+) -> List[Tuple[int, int]]:
+    """Find the longest common subset for unique lines in two ranges.
+
+    This is unique_lcs_py() for a[alo:ahi] and b[blo:bhi]. It indexes the
+    original sequences rather than slicing them, so no copies are made at
+    every level of recurse_matches_py(). The returned positions are
+    relative to the start of a and b rather than to alo and blo.
+
+    :param unique_a: _unique_positions(a, alo, ahi), if already known
+    :param unique_b: _unique_positions(b, blo, bhi), if already known
+    """
+    # Gaps deep in the recursion are often a single line on one side, so
+    # that line is the only candidate
+    if ahi - alo == 1 and unique_b is None:
+        j = _unique_index(b, blo, bhi, a[alo])
+        return [] if j is None else [(alo, j)]
+    if bhi - blo == 1 and unique_a is None:
+        i = _unique_index(a, alo, ahi, b[blo])
+        return [] if i is None else [(i, blo)]
+    if unique_a is None:
+        unique_a = _unique_positions(a, alo, ahi)
+    if unique_b is None:
+        unique_b = _unique_positions(b, blo, bhi)
+    # make btoa[i] = position of line blo + i in a, unless
     # that line doesn't occur exactly once in both,
     # in which case it's set to None
-    btoa: List[Optional[int]] = [None] * len(b)
-    index2: Dict[T, int] = {}
-    for pos, line in enumerate(b):
-        next = index.get(line)
-        if next is not None:
-            if line in index2:
-                # unset the previous mapping, which we now know to
-                # be invalid because the line isn't unique
-                btoa[index2[line]] = None
-                del index[line]
-            else:
-                index2[line] = pos
-                btoa[pos] = next
+    btoa: List[Optional[int]] = [None] * (bhi - blo)
+    if len(unique_a) <= len(unique_b):
+        for line, i in unique_a.items():
+            j = unique_b.get(line)
+            if j is not None:
+                btoa[j - blo] = i
+    else:
+        for line, j in unique_b.items():
+            found = unique_a.get(line)
+            if found is not None:
+                btoa[j - blo] = found
+    return _patience_sort(btoa, blo)
+
+
+def _patience_sort(
+    btoa: List[Optional[int]], blo: int
+) -> List[Tuple[int, int]]:
+    """Find the longest increasing run of the positions in btoa.
+
+    btoa[i] is the position in a that line blo + i of b is paired with,
+    if any.
+    """
     # this is the Patience sorting algorithm
     # see http://en.wikipedia.org/wiki/Patience_sorting
-    backpointers: List[Optional[int]] = [None] * len(b)
+    backpointers: List[Optional[int]] = [None] * len(btoa)
     stacks: List[int] = []
     lasts: List[int] = []
     k: int = 0
@@ -110,12 +423,101 @@ def unique_lcs_py(a: Sequence[T], b: Sequence[T]) -> List[Tuple[int, int]]:
     result = []
     m: Optional[int] = lasts[-1]
     while m is not None:
-        result.append((btoa[m], m))
+        result.append((btoa[m], blo + m))
         m = backpointers[m]
     result.reverse()
     return result  # type: ignore
 
 
+def _low_occurrence_lcs(
+    a: Sequence[T], b: Sequence[T], alo: int, blo: int, ahi: int, bhi: int
+) -> List[Tuple[int, int]]:
+    """Find the longest common subset for the least frequent lines.
+
+    This is what histogram anchoring falls back to in regions without
+    unique lines: of the lines that occur equally often in a[alo:ahi] and
+    b[blo:bhi], those that occur least often are paired up in order, and
+    the longest increasing run of the pairs is chosen with patience
+    sorting.
+    """
+    counts_a = Counter(a[i] for i in range(alo, ahi))
+    counts_b = Counter(b[j] for j in range(blo, bhi))
+    best = min(
+        (count for line, count in counts_a.items() if counts_b[line] == count),
+        default=None,
+    )
+    if best is None:
+        return []
+    positions: Dict[T, List[int]] = {
+        line: []
+        for line, count in counts_a.items()
+        if count == best and counts_b[line] == best
+    }
+    for i in range(alo, ahi):
+        found = positions.get(a[i])
+        if found is not None:
+            found.append(i)
+    seen: Counter[T] = Counter()
+    btoa: List[Optional[int]] = [None] * (bhi - blo)
+    for j in range(blo, bhi):
+        line = b[j]
+        found = positions.get(line)
+        if found is not None:
+            btoa[j - blo] = found[seen[line]]
+            seen[line] += 1
+    return _patience_sort(btoa, blo)
+
+
+def _unique_positions(seq: Sequence[T], lo: int, hi: int) -> Dict[T, int]:
+    """Map the lines which occur exactly once in seq[lo:hi] to their position."""
+    positions: Dict[T, int] = {}
+    duplicates = set()
+    for i in range(lo, hi):
+        line = seq[i]
+        if line in positions:
+            duplicates.add(line)
+        else:
+            positions[line] = i
+    for line in duplicates:
+        del positions[line]
+    return positions
+
+
+def _unique_index(
+    seq: Sequence[T], lo: int, hi: int, line: T
+) -> Optional[int]:
+    """Return the position of line in seq[lo:hi], if it occurs exactly once."""
+    found = None
+    for i in range(lo, hi):
+        if seq[i] == line:
+            if found is not None:
+                return None
+            found = i
+    return found
+
+
+def _anchor_lcs(
+    a: Sequence[T],
+    b: Sequence[T],
+    alo: int,
+    blo: int,
+    ahi: int,
+    bhi: int,
+    unique_a: Optional[Dict[T, int]],
+    unique_b: Optional[Dict[T, int]],
+    histogram: bool,
+) -> List[Tuple[int, int]]:
+    """Find the anchors of a region.
+
+    These are its unique lines, or with histogram its least frequent lines
+    if it has no unique ones.
+    """
+    matches = _unique_lcs_range(a, b, alo, blo, ahi, bhi, unique_a, unique_b)
+    if not matches and histogram:
+        return _low_occurrence_lcs(a, b, alo, blo, ahi, bhi)
+    return matches
+
+
 def recurse_matches_py(
     a: Sequence[T],
     b: Sequence[T],
@@ -125,6 +527,12 @@ def recurse_matches_py(
     bhi: int,
     answer: List[Tuple[int, int]],
     maxrecursion: int,
+    stats: Optional[DiffStats] = None,
+    unique_a: Optional[Dict[T, int]] = None,
+    unique_b: Optional[Dict[T, int]] = None,
+    *,
+    histogram: bool = False,
+    deadline: Optional[_Deadline] = None,
 ) -> None:
     """Find all of the matching text in the lines of a and b.
 
@@ -138,75 +546,227 @@ def recurse_matches_py(
                    indicating [(line_in_a, line_in_b)]
     :param maxrecursion: The maximum depth to recurse.
                          Must be a positive integer.
+    :param stats: If given, a DiffStats to record the unique_lcs calls
+                  and the recursion depth in
+    :param unique_a: The lines which occur once in a[alo:ahi], as returned
+                     by _unique_positions(), if already known
+    :param unique_b: The same for b[blo:bhi]
+    :param histogram: Anchor regions without unique lines on their least
+                      frequent lines instead, like histogram diff does
+    :param deadline: If given, the regions which are left once it has
+                     expired are not matched, so answer only has the
+                     matches found so far
     :return: None, the return value is in the parameter answer, which
              should be a list
 
     """
-    if maxrecursion < 0:
-        # this will never happen normally, this check is to prevent DOS attacks
-        raise MaxRecursionDepth()
-    oldlength = len(answer)
-    if alo == ahi or blo == bhi:
-        return
-    last_a_pos = alo - 1
-    last_b_pos = blo - 1
-    for apos, bpos in unique_lcs_py(a[alo:ahi], b[blo:bhi]):
-        # recurse between lines which are unique in each file and match
-        apos += alo
-        bpos += blo
-        # Most of the time, you will have a sequence of similar entries
-        if last_a_pos + 1 != apos or last_b_pos + 1 != bpos:
-            recurse_matches_py(
-                a,
-                b,
-                last_a_pos + 1,
-                last_b_pos + 1,
-                apos,
-                bpos,
-                answer,
-                maxrecursion - 1,
+    # Rather than recursing, keep a stack of regions left to match, as
+    # (alo, blo, ahi, bhi, maxrecursion, preceding), where preceding are
+    # the matches to add to answer before those found in the region.
+    # Regions are pushed in reverse, so that answer is filled in order.
+    stack: List[
+        Tuple[int, int, int, int, int, Optional[List[Tuple[int, int]]]]
+    ] = [(alo, blo, ahi, bhi, maxrecursion, None)]
+    top = maxrecursion
+    while stack:
+        alo, blo, ahi, bhi, maxrecursion, preceding = stack.pop()
+        if preceding:
+            answer.extend(preceding)
+        if maxrecursion < 0:
+            # this will never happen normally, this check is to prevent
+            # DOS attacks
+            raise MaxRecursionDepth()
+        if alo == ahi or blo == bhi:
+            continue
+        if deadline is not None and deadline.check():
+            continue
+        if stats is None:
+            matches = _anchor_lcs(
+                a, b, alo, blo, ahi, bhi, unique_a, unique_b, histogram
             )
-        last_a_pos = apos
-        last_b_pos = bpos
-        answer.append((apos, bpos))
-    if len(answer) > oldlength:
-        # find matches between the last match and the end
+        else:
+            stats.max_depth = max(stats.max_depth, top - maxrecursion)
+            start = perf_counter()
+            matches = _anchor_lcs(
+                a, b, alo, blo, ahi, bhi, unique_a, unique_b, histogram
+            )
+            stats.unique_lcs_seconds += perf_counter() - start
+            stats.unique_lcs_calls += 1
+        # The known unique lines only apply to the initial region
+        unique_a = unique_b = None
+        if matches:
+            regions = []
+            last_a_pos = alo - 1
+            last_b_pos = blo - 1
+            start = 0
+            for i, (apos, bpos) in enumerate(matches):
+                # recurse between lines which are unique in each file and
+                # match. Most of the time, you will have a sequence of
+                # similar entries, and a region which is empty on either
+                # side has no matches either (unless it is too deep).
+                if last_a_pos + 1 != apos or last_b_pos + 1 != bpos:
+                    if (
+                        last_a_pos + 1 != apos and last_b_pos + 1 != bpos
+                    ) or maxrecursion < 1:
+                        regions.append(
+                            (
+                                last_a_pos + 1,
+                                last_b_pos + 1,
+                                apos,
+                                bpos,
+                                maxrecursion - 1,
+                                matches[start:i],
+                            )
+                        )
+                        start = i
+                last_a_pos = apos
+                last_b_pos = bpos
+            # find matches between the last match and the end
+            regions.append(
+                (
+                    last_a_pos + 1,
+                    last_b_pos + 1,
+                    ahi,
+                    bhi,
+                    maxrecursion - 1,
+                    matches[start:],
+                )
+            )
+            regions.reverse()
+            stack.extend(regions)
+        elif a[alo] == b[blo]:
+            # find matching lines at the very beginning
+            while alo < ahi and blo < bhi and a[alo] == b[blo]:
+                answer.append((alo, blo))
+                alo += 1
+                blo += 1
+            stack.append((alo, blo, ahi, bhi, maxrecursion - 1, None))
+        elif a[ahi - 1] == b[bhi - 1]:
+            # find matching lines at the very end
+            nahi = ahi - 1
+            nbhi = bhi - 1
+            while nahi > alo and nbhi > blo and a[nahi - 1] == b[nbhi - 1]:
+                nahi -= 1
+                nbhi -= 1
+            # add them once the rest has been matched, as part of an
+            # empty region
+            suffix = list(zip(range(nahi, ahi), range(nbhi, bhi)))
+            stack.append((ahi, bhi, ahi, bhi, maxrecursion, suffix))
+            stack.append((alo, blo, nahi, nbhi, maxrecursion - 1, None))
+
+
+def _replace_edit(
+    previous: Optional[Edit], start: int, end: int, length: int
+) -> Edit:
+    """Add the replacement of b[start:end] with length lines to an edit."""
+    change = length - (end - start)
+    if previous is None:
+        return (start, start + length, change)
+    lo, hi, shift = previous
+    return (min(lo, start), max(hi, end) + change, shift + change)
+
+
+def _outline_matches(
+    a: Sequence[T],
+    b: Sequence[T],
+    answer: List[Tuple[int, int]],
+    stats: Optional[DiffStats] = None,
+    unique_a: Optional[Dict[T, int]] = None,
+    unique_b: Optional[Dict[T, int]] = None,
+    previous: Optional[Tuple[Outline, Edit]] = None,
+    histogram: bool = False,
+    deadline: Optional[_Deadline] = None,
+) -> Optional[Outline]:
+    """Find all of the matching lines in a and b, keeping an outline.
+
+    This matches what recurse_matches_py() finds for all of a and b, but
+    the top-level gaps of a previous outline which were not touched by an
+    edit are reused; a gap's matches only depend on the lines inside it.
+
+    :return: The outline of this diff, or None if there were no anchors
+        or deadline expired
+    """
+    if not a or not b:
+        return None
+
+    def recurse_gap(alo: int, blo: int, ahi: int, bhi: int) -> None:
+        gap_stats = None if stats is None else DiffStats()
         recurse_matches_py(
             a,
             b,
-            last_a_pos + 1,
-            last_b_pos + 1,
+            alo,
+            blo,
             ahi,
             bhi,
             answer,
-            maxrecursion - 1,
-        )
-    elif a[alo] == b[blo]:
-        # find matching lines at the very beginning
-        while alo < ahi and blo < bhi and a[alo] == b[blo]:
-            answer.append((alo, blo))
-            alo += 1
-            blo += 1
-        recurse_matches_py(a, b, alo, blo, ahi, bhi, answer, maxrecursion - 1)
-    elif a[ahi - 1] == b[bhi - 1]:
-        # find matching lines at the very end
-        nahi = ahi - 1
-        nbhi = bhi - 1
-        while nahi > alo and nbhi > blo and a[nahi - 1] == b[nbhi - 1]:
-            nahi -= 1
-            nbhi -= 1
-        recurse_matches_py(
-            a,
-            b,
-            last_a_pos + 1,
-            last_b_pos + 1,
-            nahi,
-            nbhi,
-            answer,
-            maxrecursion - 1,
+            9,
+            gap_stats,
+            histogram=histogram,
+            deadline=deadline,
         )
-        for i in range(ahi - nahi):
-            answer.append((nahi + i, nbhi + i))
+        if stats is not None and gap_stats is not None:
+            stats.unique_lcs_calls += gap_stats.unique_lcs_calls
+            stats.unique_lcs_seconds += gap_stats.unique_lcs_seconds
+            if gap_stats.unique_lcs_calls:
+                stats.max_depth = max(stats.max_depth, gap_stats.max_depth + 1)
+
+    start = perf_counter()
+    anchors = _anchor_lcs(
+        a, b, 0, 0, len(a), len(b), unique_a, unique_b, histogram
+    )
+    if stats is not None:
+        stats.unique_lcs_seconds += perf_counter() - start
+        stats.unique_lcs_calls += 1
+    if not anchors:
+        if a[0] == b[0]:
+            # find matching lines at the very beginning
+            alo = blo = 0
+            while alo < len(a) and blo < len(b) and a[alo] == b[blo]:
+                answer.append((alo, blo))
+                alo += 1
+                blo += 1
+            recurse_gap(alo, blo, len(a), len(b))
+        elif a[-1] == b[-1]:
+            # find matching lines at the very end
+            nahi = len(a) - 1
+            nbhi = len(b) - 1
+            while nahi > 0 and nbhi > 0 and a[nahi - 1] == b[nbhi - 1]:
+                nahi -= 1
+                nbhi -= 1
+            recurse_gap(0, 0, nahi, nbhi)
+            answer.extend(zip(range(nahi, len(a)), range(nbhi, len(b))))
+        return None
+
+    outline: Outline = {}
+    last_a_pos = last_b_pos = -1
+    for apos, bpos in anchors + [(len(a), len(b))]:
+        # A gap which is empty on either side has no matches
+        if last_a_pos + 1 < apos and last_b_pos + 1 < bpos:
+            gap = (last_a_pos + 1, last_b_pos + 1, apos, bpos)
+            first = len(answer)
+            reused = None
+            if previous is not None:
+                old_outline, (lo, hi, shift) = previous
+                if bpos <= lo:
+                    reused = old_outline.get(gap)
+                elif gap[1] >= hi:
+                    reused = old_outline.get(
+                        (gap[0], gap[1] - shift, apos, bpos - shift)
+                    )
+                    if reused is not None:
+                        reused = [(i, j + shift) for i, j in reused]
+            if reused is not None:
+                answer.extend(reused)
+            else:
+                recurse_gap(*gap)
+            outline[gap] = answer[first:]
+        answer.append((apos, bpos))
+        last_a_pos, last_b_pos = apos, bpos
+    # Drop the sentinel anchor after the last gap
+    answer.pop()
+    if deadline is not None and deadline.expired:
+        return None
+    return outline
 
 
 def _collapse_sequences(
@@ -255,6 +815,196 @@ def _check_consistency(answer: List[Tuple[int, int, int]]) -> None:
         next_b = b + match_len
 
 
+def _iter_opcodes(blocks: Iterable[Tuple[int, int, int]]) -> Iterator[Opcode]:
+    """Generate the opcodes for a list of matching blocks.
+
+    This is difflib.SequenceMatcher.get_opcodes(), producing the opcodes
+    one at a time.
+    """
+    i = j = 0
+    for ai, bj, size in blocks:
+        # invariant:  we've pumped out correct diffs to change
+        # a[:i] into b[:j], and the next matching block is
+        # a[ai:ai+size] == b[bj:bj+size].  So we need to pump
+        # out a diff to change a[i:ai] into b[j:bj], pump out
+        # the matching block, and move (i,j) beyond the match
+        if i < ai and j < bj:
+            yield ("replace", i, ai, j, bj)
+        elif i < ai:
+            yield ("delete", i, ai, j, bj)
+        elif j < bj:
+            yield ("insert", i, ai, j, bj)
+        i, j = ai + size, bj + size
+        # the list of matching blocks is terminated by a
+        # sentinel with size 0
+        if size:
+            yield ("equal", ai, i, bj, j)
+
+
+def _group_opcodes(
+    codes: Iterable[Opcode], n: int = 3
+) -> Iterator[List[Opcode]]:
+    """Isolate change clusters by eliminating ranges with no changes.
+
+    This is difflib.SequenceMatcher.get_grouped_opcodes(), working on an
+    iterable of opcodes rather than on a matcher. Opcodes are consumed
+    lazily, so that every group is yielded as soon as it is complete.
+    """
+    it = iter(codes)
+    code: Optional[Opcode] = next(it, ("equal", 0, 1, 0, 1))
+    # Fixup leading and trailing groups if they show no changes.
+    if code is not None and code[0] == "equal":
+        tag, i1, i2, j1, j2 = code
+        code = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+
+    nn = n + n
+    group: List[Opcode] = []
+    while code is not None:
+        tag, i1, i2, j1, j2 = code
+        code = next(it, None)
+        if code is None and tag == "equal":
+            i2, j2 = min(i2, i1 + n), min(j2, j1 + n)
+        # End the current group and start a new one whenever
+        # there is a large range with no changes.
+        if tag == "equal" and i2 - i1 > nn:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+R = TypeVar("R")
+
+
+class _RecordArray(Sequence[R]):
+    """Fixed-width integer records, stored back to back in an array('q').
+
+    data supports the buffer protocol, so it can be read without copying,
+    for example with numpy.frombuffer(records.data, dtype=numpy.int64)
+    followed by reshape(-1, len(records.fields)). Records are only
+    converted to Python objects when they are accessed.
+    """
+
+    __slots__ = ("data",)
+
+    fields: Tuple[str, ...] = ()
+
+    def __init__(self, data: Optional["array[int]"] = None) -> None:
+        if data is None:
+            data = array("q")
+        elif data.typecode != "q" or len(data) % len(self.fields):
+            raise ValueError(
+                f"expected an array('q') of {len(self.fields)}-item records"
+            )
+        self.data = data
+
+    def _record(self, offset: int) -> R:
+        raise NotImplementedError(self._record)
+
+    def __len__(self) -> int:
+        return len(self.data) // len(self.fields)
+
+    @overload
+    def __getitem__(self, index: int) -> R: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[R]: ...
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[R, List[R]]:
+        width = len(self.fields)
+        if isinstance(index, slice):
+            return [
+                self._record(i * width)
+                for i in range(*index.indices(len(self)))
+            ]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("record index out of range")
+        return self._record(index * width)
+
+    def __iter__(self) -> Iterator[R]:
+        return map(self._record, range(0, len(self.data), len(self.fields)))
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, _RecordArray):
+            return type(self) is type(other) and self.data == other.data
+        if isinstance(other, list):
+            return self.tolist() == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.tolist()!r})"
+
+    def column(self, name: str) -> memoryview:
+        """Return a strided view of a single field of every record."""
+        width = len(self.fields)
+        return memoryview(self.data)[self.fields.index(name) :: width]
+
+    def tolist(self) -> List[R]:
+        """Convert all records to the equivalent difflib objects."""
+        return list(self)
+
+
+class MatchArray(_RecordArray[difflib.Match]):
+    """Matching blocks, as (a, b, size) records.
+
+    This is a compact form of the list returned by get_matching_blocks().
+    """
+
+    __slots__ = ()
+
+    fields = ("a", "b", "size")
+
+    @classmethod
+    def from_blocks(
+        cls, blocks: Iterable[Tuple[int, int, int]]
+    ) -> "MatchArray":
+        data = array("q")
+        for block in blocks:
+            data.extend(block)
+        return cls(data)
+
+    def _record(self, offset: int) -> difflib.Match:
+        data = self.data
+        return difflib.Match(data[offset], data[offset + 1], data[offset + 2])
+
+
+class OpcodeArray(_RecordArray[Opcode]):
+    """Opcodes, as (tag, i1, i2, j1, j2) records.
+
+    This is a compact form of the list returned by get_opcodes(); the tag
+    column holds indexes into OpcodeArray.tags.
+    """
+
+    __slots__ = ()
+
+    fields = ("tag", "i1", "i2", "j1", "j2")
+
+    tags = ("equal", "replace", "delete", "insert")
+
+    @classmethod
+    def from_opcodes(cls, opcodes: Iterable[Opcode]) -> "OpcodeArray":
+        codes = {tag: code for code, tag in enumerate(cls.tags)}
+        data = array("q")
+        for tag, i1, i2, j1, j2 in opcodes:
+            data.extend((codes[tag], i1, i2, j1, j2))
+        return cls(data)
+
+    def _record(self, offset: int) -> Opcode:
+        data = self.data
+        return (
+            self.tags[data[offset]],
+            data[offset + 1],
+            data[offset + 2],
+            data[offset + 3],
+            data[offset + 4],
+        )
+
+
 class PatienceSequenceMatcher_py(difflib.SequenceMatcher, Generic[T]):
     """Compare a pair of sequences using longest common subset."""
 
@@ -263,19 +1013,120 @@ class PatienceSequenceMatcher_py(difflib.SequenceMatcher, Generic[T]):
     a: Sequence[T]
     b: Sequence[T]
     matching_blocks: Optional[List[difflib.Match]]
+    # The lines which occur once in a and in b, kept while the other
+    # side is replaced
+    _unique_a: Optional[Dict[T, int]] = None
+    _unique_b: Optional[Dict[T, int]] = None
+    # Once apply_edit_b() has been called, the outline of the last diff
+    # and the edits made to b since
+    _track_edits = False
+    _outline: Optional[Outline] = None
+    _edit: Optional[Edit] = None
+    # Whether b is a list owned by the matcher, which edits update
+    _owns_b = False
+    # The keys of the lines of a and b, once computed
+    _keys_a: Optional[List[Hashable]] = None
+    _keys_b: Optional[List[Hashable]] = None
 
     def __init__(
         self,
         isjunk: Optional[Callable[[T], bool]] = None,
         a: Sequence[T] = "",  # type: ignore[assignment]
         b: Sequence[T] = "",  # type: ignore[assignment]
+        collect_stats: bool = False,
+        histogram: bool = False,
+        timeout: Optional[float] = None,
+        cancel: Optional[Cancellable] = None,
+        key: Optional[Callable[[T], Hashable]] = None,
     ) -> None:
+        """Create a matcher for a and b.
+
+        :param collect_stats: Record how the matching blocks were found
+            in the stats attribute once they have been computed
+        :param histogram: Anchor regions without unique lines on their
+            least frequent lines, like histogram diff does, rather than
+            only matching their common leading and trailing lines
+        :param timeout: If given, the number of seconds that computing the
+            matching blocks may take. Once it has passed, the regions left
+            to match are reported as changed, and degraded is set
+        :param cancel: A CancellationToken which stops computing the
+            matching blocks in the same way once it is cancelled
+        :param key: If given, items are matched by the result of calling
+            key on them rather than by the items themselves, such as a
+            LineKey. Every item is passed to it once
+        """
         if isjunk is not None:
             raise NotImplementedError(
                 "Currently we do not support isjunk for sequence matching"
             )
+        if timeout is not None and not timeout >= 0:
+            raise ValueError("timeout must be a number of seconds")
+        self.collect_stats = collect_stats
+        self.histogram = histogram
+        self.timeout = timeout
+        self.cancel = cancel
+        self.key = key
+        # Whether the matching blocks were cut short by timeout or cancel
+        self.degraded = False
+        self.stats: Optional[DiffStats] = None
         difflib.SequenceMatcher.__init__(self, isjunk, a, b)
 
+    def set_seq1(self, a: Sequence[T]) -> None:
+        """Set the first sequence to be compared.
+
+        What is known about the second sequence is kept, so comparing
+        many sequences to the same second sequence only indexes each of
+        them.
+        """
+        if a is self.a:
+            return
+        difflib.SequenceMatcher.set_seq1(self, a)
+        self._unique_a = self._keys_a = None
+        self._outline = self._edit = None
+        self.stats = None
+
+    def set_seq2(self, b: Sequence[T]) -> None:
+        """Set the second sequence to be compared.
+
+        What is known about the first sequence is kept, so comparing the
+        same first sequence to many others only indexes each of them.
+        """
+        if b is self.b:
+            return
+        difflib.SequenceMatcher.set_seq2(self, b)
+        self._unique_b = self._keys_b = None
+        self._outline = self._edit = None
+        self._owns_b = False
+        self.stats = None
+
+    def apply_edit_b(self, start: int, end: int, items: Sequence[T]) -> None:
+        """Replace b[start:end] with items, updating the diff incrementally.
+
+        The next diff only matches the top-level gaps between anchors that
+        were touched by edits again, and gives the same result as a fresh
+        one. b is copied into a list owned by the matcher on the first
+        edit. Only the matching blocks and what is derived from them are
+        kept up to date, not the index used by find_longest_match().
+        """
+        if not 0 <= start <= end <= len(self.b):
+            raise IndexError("edit out of range")
+        if self._owns_b:
+            b = cast(List[T], self.b)
+        else:
+            b = self.b = list(self.b)
+            self._owns_b = True
+        b[start:end] = items
+        if self._keys_b is not None and self.key is not None:
+            key = self.key
+            self._keys_b[start:end] = [key(item) for item in items]
+        if self._track_edits:
+            self._edit = _replace_edit(self._edit, start, end, len(items))
+        self._track_edits = True
+        self.matching_blocks = self.opcodes = None
+        self.fullbcount = None
+        self._unique_b = None
+        self.stats = None
+
     def get_matching_blocks(self) -> List[difflib.Match]:
         """Return list of triples describing matching subsequences.
 
@@ -298,10 +1149,77 @@ class PatienceSequenceMatcher_py(difflib.SequenceMatcher, Generic[T]):
         if self.matching_blocks is not None:
             return self.matching_blocks
 
+        stats = None
+        if self.collect_stats or _stats_hook is not None:
+            stats = self.stats = DiffStats()
+            start = perf_counter()
+
+        a = self.a
+        b = self.b
+        if self.key is not None:
+            key = self.key
+            if self._keys_a is None:
+                self._keys_a = [key(item) for item in self.a]
+            if self._keys_b is None:
+                self._keys_b = [key(item) for item in self.b]
+            # The keys are matched in place of the items
+            a = cast(Sequence[T], self._keys_a)
+            b = cast(Sequence[T], self._keys_b)
+
+        if self._unique_a is None:
+            self._unique_a = _unique_positions(a, 0, len(a))
+        if self._unique_b is None:
+            self._unique_b = _unique_positions(b, 0, len(b))
+        if stats is not None:
+            # Mapping the keys and hashing the lines to find the unique
+            # ones is what the Rust matcher does when it tokenizes
+            stats.tokenize_seconds = perf_counter() - start
+            stats.lines_a = len(a)
+            stats.lines_b = len(b)
+            stats.unique_lines = _count_unique_lines(a, b)
+            start = perf_counter()
+        deadline = None
+        if self.timeout is not None or self.cancel is not None:
+            deadline = _Deadline(self.timeout, self.cancel)
         matches: List[Tuple[int, int]] = []
-        recurse_matches_py(
-            self.a, self.b, 0, 0, len(self.a), len(self.b), matches, 10
-        )
+        if self._track_edits:
+            previous = None
+            if self._outline is not None and self._edit is not None:
+                previous = (self._outline, self._edit)
+            self._outline = _outline_matches(
+                a,
+                b,
+                matches,
+                stats,
+                self._unique_a,
+                self._unique_b,
+                previous,
+                self.histogram,
+                deadline,
+            )
+            self._edit = None
+        else:
+            recurse_matches_py(
+                a,
+                b,
+                0,
+                0,
+                len(a),
+                len(b),
+                matches,
+                10,
+                stats,
+                self._unique_a,
+                self._unique_b,
+                histogram=self.histogram,
+                deadline=deadline,
+            )
+        self.degraded = deadline is not None and deadline.expired
+        if stats is not None:
+            converted = perf_counter()
+            stats.recursion_seconds = (
+                converted - start - stats.unique_lcs_seconds
+            )
         # Matches now has individual line pairs of
         # line A matches line B, at the given offsets
         collapsed = _collapse_sequences(matches)
@@ -316,4 +1234,283 @@ class PatienceSequenceMatcher_py(difflib.SequenceMatcher, Generic[T]):
                     [(m.a, m.b, m.size) for m in self.matching_blocks]
                 )
 
+        if stats is not None:
+            stats.conversion_seconds = perf_counter() - converted
+            stats.allocated_bytes = (
+                sys.getsizeof(matches)
+                + len(matches) * sys.getsizeof((0, 0))
+                + sys.getsizeof(self.matching_blocks)
+                + len(self.matching_blocks)
+                * sys.getsizeof(difflib.Match(0, 0, 0))
+            )
+            _report_stats(stats)
         return self.matching_blocks
+
+    def iter_opcodes(self) -> Iterator[Opcode]:
+        """Return an iterator over the opcodes to turn a into b.
+
+        This produces the same opcodes as get_opcodes(), but computes them
+        from the matching blocks on demand.
+        """
+        return _iter_opcodes(self.get_matching_blocks())
+
+    def iter_grouped_opcodes(self, n: int = 3) -> Iterator[List[Opcode]]:
+        """Return an iterator over groups with up to n lines of context.
+
+        This produces the same groups as get_grouped_opcodes(), but
+        computes them from the matching blocks on demand.
+        """
+        return _group_opcodes(self.iter_opcodes(), n)
+
+    def get_matching_blocks_array(self) -> MatchArray:
+        """Return the matching blocks as a compact MatchArray."""
+        return MatchArray.from_blocks(self.get_matching_blocks())
+
+    def get_opcodes_array(self) -> OpcodeArray:
+        """Return the opcodes as a compact OpcodeArray."""
+        return OpcodeArray.from_opcodes(self.get_opcodes())
+
+
+def split_lines_py(data: BytesLike) -> List[bytes]:
+    r"""Split a bytes-like object (such as bytes or an mmap) into lines.
+
+    Lines end after each b"\n", like readlines() on a file opened in
+    binary mode.
+    """
+    return io.BytesIO(data).readlines()
+
+
+def _diff_pair(
+    job: Tuple[Sequence[T], Sequence[T], Optional[int]],
+) -> Union[List[Opcode], List[List[Opcode]]]:
+    a, b, n = job
+    matcher = PatienceSequenceMatcher_py(None, a, b)
+    if n is None:
+        opcodes: List[Opcode] = list(matcher.get_opcodes())
+        return opcodes
+    return list(matcher.get_grouped_opcodes(n))
+
+
+def diff_many_py(
+    pairs: Iterable[Tuple[Sequence[T], Sequence[T]]],
+    workers: Optional[int] = None,
+    n: Optional[int] = None,
+) -> List[Union[List[Opcode], List[List[Opcode]]]]:
+    """Compute the opcodes for many pairs of sequences at once.
+
+    :param pairs: An iterable of (a, b) sequence pairs
+    :param workers: The number of worker processes to use, defaults to
+        the number of CPUs
+    :param n: If given, return the grouped opcodes with n lines of context
+        for each pair rather than the plain opcodes
+    :return: A list with one result per pair, in input order
+    """
+    jobs = [(a, b, n) for a, b in pairs]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        return [_diff_pair(job) for job in jobs]
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(workers) as executor:
+        return list(
+            executor.map(
+                _diff_pair, jobs, chunksize=max(1, len(jobs) // (workers * 4))
+            )
+        )
+
+
+# A region of a three-way merge, as (tag, base_start, base_end, this_start,
+# this_end, other_start, other_end)
+MergeRegion = Tuple[str, int, int, int, int, int, int]
+
+
+def _sync_regions(
+    base: Sequence[T],
+    this: Sequence[T],
+    other: Sequence[T],
+    sequencematcher: Callable[..., difflib.SequenceMatcher],
+) -> List[Tuple[int, int, int, int, int, int]]:
+    """Return the regions of base that are unchanged on both sides.
+
+    Every region is (base_start, base_end, this_start, this_end,
+    other_start, other_end); the last one is the empty region at the end
+    of all three.
+    """
+    this_blocks = sequencematcher(None, base, this).get_matching_blocks()
+    other_blocks = sequencematcher(None, base, other).get_matching_blocks()
+    regions = []
+    i = j = 0
+    while i < len(this_blocks) and j < len(other_blocks):
+        this_base, this_start, this_len = this_blocks[i]
+        other_base, other_start, other_len = other_blocks[j]
+        # The part of base matched on both sides
+        start = max(this_base, other_base)
+        end = min(this_base + this_len, other_base + other_len)
+        if start < end:
+            this_sub = this_start + (start - this_base)
+            other_sub = other_start + (start - other_base)
+            regions.append(
+                (
+                    start,
+                    end,
+                    this_sub,
+                    this_sub + (end - start),
+                    other_sub,
+                    other_sub + (end - start),
+                )
+            )
+        # Advance whichever block ends first in base
+        if this_base + this_len < other_base + other_len:
+            i += 1
+        else:
+            j += 1
+    regions.append(
+        (len(base), len(base), len(this), len(this), len(other), len(other))
+    )
+    return regions
+
+
+def _same_range(
+    a: Sequence[T], alo: int, ahi: int, b: Sequence[T], blo: int, bhi: int
+) -> bool:
+    if ahi - alo != bhi - blo:
+        return False
+    return all(a[alo + i] == b[blo + i] for i in range(ahi - alo))
+
+
+def merge_regions_py(
+    base: Sequence[T],
+    this: Sequence[T],
+    other: Sequence[T],
+    sequencematcher: Optional[Callable[..., difflib.SequenceMatcher]] = None,
+) -> List[MergeRegion]:
+    """Return the regions of a three-way merge of this and other.
+
+    :param base: The common ancestor of this and other
+    :param sequencematcher: The matcher to diff base against both sides
+        with, defaulting to PatienceSequenceMatcher_py
+    :return: A list of (tag, base_start, base_end, this_start, this_end,
+        other_start, other_end) tuples, where tag is "unchanged", "same"
+        (both sides made the same change), "this" or "other" (only that
+        side changed) or "conflict"
+    """
+    if sequencematcher is None:
+        sequencematcher = PatienceSequenceMatcher_py
+    result: List[MergeRegion] = []
+    iz = ia = ib = 0
+    for zmatch, zend, amatch, aend, bmatch, bend in _sync_regions(
+        base, this, other, sequencematcher
+    ):
+        if amatch > ia or bmatch > ib:
+            changed_this = not _same_range(this, ia, amatch, base, iz, zmatch)
+            changed_other = not _same_range(
+                other, ib, bmatch, base, iz, zmatch
+            )
+            if _same_range(this, ia, amatch, other, ib, bmatch):
+                tag = "same"
+            elif changed_this and changed_other:
+                tag = "conflict"
+            elif changed_this:
+                tag = "this"
+            else:
+                tag = "other"
+            result.append((tag, iz, zmatch, ia, amatch, ib, bmatch))
+        if zend > zmatch:
+            result.append(
+                ("unchanged", zmatch, zend, amatch, aend, bmatch, bend)
+            )
+        iz, ia, ib = zend, aend, bend
+    return result
+
+
+# The intra-line changes of a pair of lines, as (line in a, line in b,
+# changed spans of the line in a, changed spans of the line in b), where
+# every span is a (start, end) offset into the line
+LineRefinement = Tuple[int, int, List[Tuple[int, int]], List[Tuple[int, int]]]
+
+# A run of word characters, a run of whitespace or any other character
+_WORD_RE = re.compile(r"\w+|\s+|.", re.DOTALL)
+
+
+def _token_bounds(line: str, words: bool) -> List[int]:
+    """Return the offsets at which the tokens of line start, plus its end."""
+    if not words:
+        return list(range(len(line) + 1))
+    return [0] + [m.end() for m in _WORD_RE.finditer(line)]
+
+
+def _changed_spans(
+    line_a: str, line_b: str, words: bool
+) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]:
+    """Return the spans of two lines that differ, by matching their tokens."""
+    bounds_a = _token_bounds(line_a, words)
+    bounds_b = _token_bounds(line_b, words)
+    tokens_a = [line_a[i:j] for i, j in zip(bounds_a, bounds_a[1:])]
+    tokens_b = [line_b[i:j] for i, j in zip(bounds_b, bounds_b[1:])]
+    spans_a: List[Tuple[int, int]] = []
+    spans_b: List[Tuple[int, int]] = []
+    i = j = 0
+    for ai, bj, n in PatienceSequenceMatcher_py(
+        None, tokens_a, tokens_b
+    ).get_matching_blocks():
+        if ai > i:
+            spans_a.append((bounds_a[i], bounds_a[ai]))
+        if bj > j:
+            spans_b.append((bounds_b[j], bounds_b[bj]))
+        i, j = ai + n, bj + n
+    return spans_a, spans_b
+
+
+def _line_text(line: Union[str, bytes]) -> str:
+    if isinstance(line, bytes):
+        return line.decode("latin-1")
+    if isinstance(line, str):
+        return line
+    raise TypeError("lines must be str or bytes")
+
+
+def refine_opcodes_py(
+    a: Union[Sequence[str], Sequence[bytes]],
+    b: Union[Sequence[str], Sequence[bytes]],
+    opcodes: Iterable[Opcode],
+    mode: str = "word",
+    budget: int = 10000,
+) -> List[LineRefinement]:
+    """Return the intra-line changes of the replace opcodes of a diff.
+
+    The lines of every replace opcode are paired up in order, and the
+    tokens of each pair are matched with the patience matcher. Lines that
+    are not paired up and lines of skipped opcodes get no entry, as they
+    changed as a whole.
+
+    :param a: The lines of the original text
+    :param b: The lines of the new text
+    :param opcodes: The opcodes of the diff, as returned by get_opcodes()
+    :param mode: "word" to match runs of word characters, runs of
+        whitespace and single other characters, or "char" to match single
+        characters. Bytes lines are read as Latin-1.
+    :param budget: Replace opcodes with more than this many characters on
+        both sides combined are skipped, to bound the cost of large ones
+    :return: A list of (i, j, spans_a, spans_b) tuples, where spans_a and
+        spans_b are the (start, end) offsets of the changed parts of a[i]
+        and b[j]
+    """
+    if mode not in ("word", "char"):
+        raise ValueError(f"unknown mode: {mode}")
+    words = mode == "word"
+    result: List[LineRefinement] = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag != "replace":
+            continue
+        size = sum(len(a[i]) for i in range(i1, i2))
+        size += sum(len(b[j]) for j in range(j1, j2))
+        if size > budget:
+            continue
+        for i, j in zip(range(i1, i2), range(j1, j2)):
+            spans_a, spans_b = _changed_spans(
+                _line_text(a[i]), _line_text(b[j]), words
+            )
+            result.append((i, j, spans_a, spans_b))
+    return result
@@ -1,7 +1,40 @@
 """Type stubs for the Rust implementation of patiencediff."""
 
 import difflib
-from typing import Any, Callable, Literal, Sequence
+from typing import (
+    Any,
+    Callable,
+    Hashable,
+    Iterable,
+    Iterator,
+    Literal,
+    Sequence,
+    overload,
+)
+
+from typing_extensions import Buffer
+
+from ._patiencediff_py import (
+    DiffStats,
+    LineRefinement,
+    MatchArray,
+    OpcodeArray,
+)
+
+class CancellationToken_rs:
+    """A flag that stops the diffs using it once it is cancelled."""
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether cancel() has been called."""
+        ...
+
+    def cancel(self) -> None:
+        """Stop the diffs using this token.
+
+        This can be called from any thread, while they run without the GIL.
+        """
+        ...
 
 class PatienceSequenceMatcher_rs(difflib.SequenceMatcher):
     """Python wrapper for patiencediff SequenceMatcher implemented in Rust.
@@ -10,11 +43,29 @@ class PatienceSequenceMatcher_rs(difflib.SequenceMatcher):
     the patience diff algorithm for finding matching blocks.
     """
 
+    collect_stats: bool
+    histogram: bool
+    degraded: bool
+    @property
+    def key(self) -> Callable[[Any], Hashable] | None:
+        """What items are matched by, if not by themselves."""
+        ...
+
+    @property
+    def stats(self) -> DiffStats | None:
+        """The DiffStats for this diff, if they were collected."""
+        ...
+
     def __init__(
         self,
         junk: Callable[[Any], bool] | None,
         a: Sequence[Any],
         b: Sequence[Any],
+        collect_stats: bool = False,
+        histogram: bool = False,
+        timeout: float | None = None,
+        cancel: CancellationToken_rs | None = None,
+        key: Callable[[Any], Hashable] | None = None,
     ) -> None:
         """Initialize the SequenceMatcher.
 
@@ -22,9 +73,72 @@ class PatienceSequenceMatcher_rs(difflib.SequenceMatcher):
             junk: A function that determines if an element is junk (currently ignored).
             a: The first sequence to compare.
             b: The second sequence to compare.
+            collect_stats: Whether to record how the matching blocks were
+                found in the stats attribute.
+            histogram: Whether to anchor regions without unique lines on
+                their least frequent lines, like histogram diff does.
+            timeout: If given, the number of seconds that computing the
+                matching blocks may take. Once it has passed, the regions
+                left to match are reported as changed, and degraded is set.
+            cancel: A token which stops computing the matching blocks in
+                the same way once it is cancelled.
+            key: If given, items are matched by the result of calling key
+                on them. A LineKey is not called: str and bytes lines are
+                normalized natively, and the lines of a ByteLines_rs without
+                holding the GIL.
 
         Raises:
-            TypeError: If the sequences contain unhashable types.
+            TypeError: If the sequences contain unhashable types, or if key
+                is a LineKey and they contain items other than str or bytes.
+            ValueError: If timeout is negative.
+        """
+        ...
+
+    def set_seq1(self, a: Sequence[Any]) -> None:
+        """Set the first sequence to be compared.
+
+        The token table of the second sequence is kept, so comparing many
+        sequences to the same second sequence only tokenizes each of them.
+
+        Args:
+            a: The new first sequence.
+        """
+        ...
+
+    def set_seq2(self, b: Sequence[Any]) -> None:
+        """Set the second sequence to be compared.
+
+        The token table of the first sequence is kept, so comparing the same
+        first sequence to many others only tokenizes each of them.
+
+        Args:
+            b: The new second sequence.
+        """
+        ...
+
+    def set_seqs(self, a: Sequence[Any], b: Sequence[Any]) -> None:
+        """Set both sequences to be compared.
+
+        Args:
+            a: The new first sequence.
+            b: The new second sequence.
+        """
+        ...
+
+    def apply_edit_b(self, start: int, end: int, items: Sequence[Any]) -> None:
+        """Replace b[start:end] with items, updating the diff incrementally.
+
+        Only the new items are tokenized, and the next diff only matches the
+        top-level gaps between anchors that were touched by edits again. The
+        result is the same as that of a fresh diff.
+
+        Args:
+            start: The start of the replaced range of b.
+            end: The end of the replaced range of b.
+            items: The items to put in its place.
+
+        Raises:
+            IndexError: If start:end is not a range of b.
         """
         ...
 
@@ -43,6 +157,67 @@ class PatienceSequenceMatcher_rs(difflib.SequenceMatcher):
         """
         ...
 
+    def iter_opcodes(
+        self,
+    ) -> Iterator[
+        tuple[
+            Literal["replace", "delete", "insert", "equal"], int, int, int, int
+        ]
+    ]:
+        """Return an iterator over the opcodes to turn a into b.
+
+        This produces the same opcodes as get_opcodes(), but computes them
+        from the matching blocks on demand.
+
+        Returns:
+            An iterator over (tag, i1, i2, j1, j2) tuples.
+        """
+        ...
+
+    def iter_grouped_opcodes(
+        self, n: int = 3
+    ) -> Iterator[
+        list[
+            tuple[
+                Literal["replace", "delete", "insert", "equal"],
+                int,
+                int,
+                int,
+                int,
+            ]
+        ]
+    ]:
+        """Return an iterator over groups with up to n lines of context.
+
+        This produces the same groups as get_grouped_opcodes(), but computes
+        them from the matching blocks on demand.
+
+        Args:
+            n: Number of lines of context to include (default: 3).
+
+        Returns:
+            An iterator over groups, where each group is a list of opcodes.
+        """
+        ...
+
+    def get_matching_blocks_array(self) -> MatchArray:
+        """Return the matching blocks as a compact MatchArray.
+
+        Returns:
+            The same blocks as get_matching_blocks(), stored in an array('q').
+        """
+        ...
+
+    def get_opcodes_array(self) -> OpcodeArray:
+        """Return the opcodes as a compact OpcodeArray.
+
+        No tuple or string is created per opcode.
+
+        Returns:
+            The same opcodes as get_opcodes(), stored in an array('q').
+        """
+        ...
+
     def get_opcodes(
         self,
     ) -> list[
@@ -119,6 +294,8 @@ def recurse_matches_rs(
     bhi: int,
     answer: list[tuple[int, int]],
     maxrecursion: int,
+    *,
+    histogram: bool = False,
 ) -> None:
     """Recursively find matches between two sequences.
 
@@ -134,5 +311,138 @@ def recurse_matches_rs(
         bhi: End index in sequence b.
         answer: List to append matches to (modified in place).
         maxrecursion: Maximum recursion depth allowed.
+        histogram: Whether to anchor regions without unique lines on their
+            least frequent lines.
+    """
+    ...
+
+def diff_many_rs(
+    pairs: Iterable[tuple[Sequence[Any], Sequence[Any]]],
+    workers: int | None = None,
+    n: int | None = None,
+) -> list[Any]:
+    """Compute the opcodes for many pairs of sequences at once.
+
+    All pairs are tokenized up front; the matching then runs on a pool of
+    native threads without holding the GIL.
+
+    Args:
+        pairs: An iterable of (a, b) sequence pairs.
+        workers: Number of worker threads (default: number of CPUs).
+        n: If given, return the grouped opcodes with n lines of context
+            for each pair rather than the plain opcodes.
+
+    Returns:
+        A list with one result per pair, in input order.
+    """
+    ...
+
+def merge_regions_rs(
+    base: Sequence[Any], this: Sequence[Any], other: Sequence[Any]
+) -> list[tuple[str, int, int, int, int, int, int]]:
+    """Return the regions of a three-way merge of this and other.
+
+    All three sequences are tokenized together, and both diffs against base
+    run concurrently without holding the GIL.
+
+    Args:
+        base: The common ancestor of this and other.
+        this: One descendant of base.
+        other: The other descendant of base.
+
+    Returns:
+        A list of (tag, base_start, base_end, this_start, this_end,
+        other_start, other_end) tuples, where tag is "unchanged", "same",
+        "this", "other" or "conflict".
+    """
+    ...
+
+def refine_opcodes_rs(
+    a: Sequence[str] | Sequence[bytes],
+    b: Sequence[str] | Sequence[bytes],
+    opcodes: Iterable[tuple[str, int, int, int, int]],
+    mode: str = "word",
+    budget: int = 10000,
+) -> list[LineRefinement]:
+    """Return the intra-line changes of the replace opcodes of a diff.
+
+    The lines of every replace opcode are paired up in order, and the
+    tokens of all pairs are matched natively, in parallel and without
+    holding the GIL.
+
+    Args:
+        a: The lines of the original text.
+        b: The lines of the new text.
+        opcodes: The opcodes of the diff, as returned by get_opcodes().
+        mode: "word" to match runs of word characters, runs of whitespace
+            and single other characters, or "char" to match single
+            characters. Bytes lines are read as Latin-1.
+        budget: Replace opcodes with more than this many characters on both
+            sides combined are skipped.
+
+    Returns:
+        A list of (i, j, spans_a, spans_b) tuples, where spans_a and spans_b
+        are the (start, end) offsets of the changed parts of a[i] and b[j].
+
+    Raises:
+        ValueError: If mode is unknown.
+        TypeError: If a line is not str or bytes.
+    """
+    ...
+
+class ByteLines_rs(Sequence[bytes]):
+    r"""The lines of a bytes-like object, split natively.
+
+    Lines end after each b"\n", like readlines() on a file opened in binary
+    mode. No Python object is created for a line until it is accessed, and
+    PatienceSequenceMatcher_rs compares lines as raw bytes when both sides
+    are ByteLines_rs.
+    """
+
+    def __len__(self) -> int: ...
+    @overload
+    def __getitem__(self, index: int) -> bytes: ...
+    @overload
+    def __getitem__(self, index: slice) -> list[bytes]: ...
+
+def split_lines_rs(data: Buffer) -> ByteLines_rs:
+    """Split a bytes-like object (such as bytes or an mmap) into lines.
+
+    Args:
+        data: An object supporting the buffer protocol.
+
+    Returns:
+        A read-only sequence of the lines, referencing the original buffer.
+    """
+    ...
+
+def render_unified_rs(
+    a: Sequence[Any],
+    b: Sequence[Any],
+    fromfile: str | bytes | None = None,
+    tofile: str | bytes | None = None,
+    fromfiledate: str | bytes | float | None = None,
+    tofiledate: str | bytes | float | None = None,
+    n: int = 3,
+    lineterm: str | bytes | None = None,
+) -> str | bytes:
+    r"""Render a unified diff of a and b into a single str or bytes object.
+
+    The output is identical to joining the lines generated by unified_diff()
+    (or unified_diff_bytes(), if lineterm is bytes) with the patience
+    matcher, but is built without creating a Python object per output line.
+
+    Args:
+        a: The original lines.
+        b: The new lines.
+        fromfile: The name of the original file, or None.
+        tofile: The name of the new file, or None.
+        fromfiledate: The modification time of the original file, or None.
+        tofiledate: The modification time of the new file, or None.
+        n: Number of lines of context.
+        lineterm: The line terminator for the control lines (default: "\n").
+
+    Returns:
+        The complete diff, as bytes if lineterm is bytes and as str otherwise.
     """
     ...
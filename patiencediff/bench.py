@@ -0,0 +1,448 @@
+# Copyright (C) 2026 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Benchmarks for the patiencediff sequence matchers.
+
+Run with ``python -m patiencediff.bench``. Every engine is timed on a set
+of seeded synthetic corpora, so that results are comparable between runs
+and machines; ``--json`` writes them out and ``--compare`` reports the
+change against an earlier run. ``--baseline`` also times the matchers on
+items that are compared through Python-level ``__eq__`` and ``__hash__``,
+the path every item took through the Rust matcher before it interned
+items to integer tokens, and reports the speedup over it.
+"""
+
+import difflib
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+)
+
+from . import __version__, unified_diff
+from ._patiencediff_py import PatienceSequenceMatcher_py
+
+Lines = List[str]
+
+
+def _edit(rng: random.Random, lines: Lines, nedits: int) -> Lines:
+    """Return a copy of lines with nedits single line edits applied."""
+    lines = list(lines)
+    for _ in range(nedits):
+        pos = rng.randrange(len(lines) + 1)
+        choice = rng.random()
+        if choice < 0.4 and pos < len(lines):
+            del lines[pos]
+        elif choice < 0.7 and pos < len(lines):
+            lines[pos] = f"    changed = {rng.random()}\n"
+        else:
+            lines.insert(pos, f"    inserted = {rng.random()}\n")
+    return lines
+
+
+def source_edits(rng: random.Random, nlines: int) -> Tuple[Lines, Lines]:
+    """Source code with scattered single line edits."""
+    a = []
+    for i in range(nlines):
+        if i % 20 == 0:
+            a.append(f"def function_{i}(value):\n")
+        elif i % 20 == 19:
+            a.append("\n")
+        else:
+            a.append(f"    value = compute(value, {rng.randrange(1000)})\n")
+    return a, _edit(rng, a, max(1, nlines // 100))
+
+
+def block_moves(rng: random.Random, nlines: int) -> Tuple[Lines, Lines]:
+    """Source code with whole blocks of lines moved around."""
+    a, _ = source_edits(rng, nlines)
+    blocks = [a[i : i + 20] for i in range(0, len(a), 20)]
+    for _ in range(max(1, len(blocks) // 20)):
+        block = blocks.pop(rng.randrange(len(blocks)))
+        blocks.insert(rng.randrange(len(blocks) + 1), block)
+    return a, [line for block in blocks for line in block]
+
+
+def duplicated_lines(rng: random.Random, nlines: int) -> Tuple[Lines, Lines]:
+    """Generated SQL, where few lines are unique."""
+    a = [
+        f"INSERT INTO t VALUES ({rng.randrange(50)});\n"
+        if i % 50
+        else f"-- chunk {i}\n"
+        for i in range(nlines)
+    ]
+    return a, _edit(rng, a, max(1, nlines // 200))
+
+
+def append_only_log(rng: random.Random, nlines: int) -> Tuple[Lines, Lines]:
+    """A log file which only had lines appended to it."""
+    log = [
+        f"2026-01-01 00:00:{i % 60:02d} INFO request {rng.randrange(10**6)}\n"
+        for i in range(nlines + nlines // 10)
+    ]
+    return log[:nlines], log
+
+
+def huge_tiny_change(rng: random.Random, nlines: int) -> Tuple[Lines, Lines]:
+    """A huge file with a handful of changes."""
+    a, _ = source_edits(rng, nlines * 10)
+    return a, _edit(rng, a, 3)
+
+
+class ObjectItem:
+    """A line that can only be hashed and compared by calling into Python."""
+
+    __slots__ = ("line",)
+
+    def __init__(self, line: str) -> None:
+        """Wrap a line."""
+        self.line = line
+
+    def __eq__(self, other: object) -> bool:
+        """Compare the wrapped lines."""
+        return isinstance(other, ObjectItem) and self.line == other.line
+
+    def __hash__(self) -> int:
+        """Hash the wrapped line."""
+        return hash(self.line)
+
+
+CORPORA: Dict[str, Callable[[random.Random, int], Tuple[Lines, Lines]]] = {
+    "source": source_edits,
+    "moves": block_moves,
+    "duplicated": duplicated_lines,
+    "log": append_only_log,
+    "huge": huge_tiny_change,
+}
+
+
+def _matching(
+    matcher: Type[difflib.SequenceMatcher], a: Sequence[Any], b: Sequence[Any]
+) -> None:
+    matcher(None, a, b).get_matching_blocks()
+
+
+def _opcodes(
+    matcher: Type[difflib.SequenceMatcher], a: Sequence[Any], b: Sequence[Any]
+) -> None:
+    matcher(None, a, b).get_opcodes()
+
+
+def _unified_diff(
+    matcher: Type[difflib.SequenceMatcher], a: Sequence[Any], b: Sequence[Any]
+) -> None:
+    for _ in unified_diff(a, b, sequencematcher=matcher):
+        pass
+
+
+OPERATIONS: Dict[
+    str,
+    Callable[
+        [Type[difflib.SequenceMatcher], Sequence[Any], Sequence[Any]], None
+    ],
+] = {
+    "matching": _matching,
+    "opcodes": _opcodes,
+    "unified_diff": _unified_diff,
+}
+
+# The operations that can be timed on ObjectItem sequences; unified_diff
+# needs str lines to render
+BASELINE_OPERATIONS = ("matching", "opcodes")
+
+
+def available_matchers() -> Dict[str, Type[difflib.SequenceMatcher]]:
+    matchers: Dict[str, Type[difflib.SequenceMatcher]] = {
+        "py": PatienceSequenceMatcher_py,
+    }
+    try:
+        from ._patiencediff_rs import PatienceSequenceMatcher_rs
+    except ImportError:
+        pass
+    else:
+        matchers["rs"] = PatienceSequenceMatcher_rs
+    matchers["difflib"] = difflib.SequenceMatcher
+    return matchers
+
+
+def measure(
+    operation: Callable[[], None], repeat: int = 3
+) -> Tuple[float, int]:
+    """Return the best wall clock time and the peak memory of operation.
+
+    The peak memory is measured by tracemalloc in a separate run, as
+    tracing slows down allocations; it only covers memory allocated
+    through Python's allocators.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        operation()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        operation()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def time_threads(
+    matcher: Type[difflib.SequenceMatcher],
+    pairs: List[Tuple[Lines, Lines]],
+    threads: int,
+) -> float:
+    """Return the wall clock time for diffing pairs using a thread pool."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        for _ in executor.map(
+            lambda pair: matcher(None, *pair).get_opcodes(), pairs
+        ):
+            pass
+    return time.perf_counter() - start
+
+
+def run(
+    corpora: List[str],
+    engines: List[str],
+    operations: List[str],
+    nlines: int,
+    repeat: int = 3,
+    seed: int = 0,
+    baseline: bool = False,
+) -> List[Dict[str, Any]]:
+    """Run the benchmarks, returning one result per measurement.
+
+    :param baseline: Also time every engine on ObjectItem sequences,
+        reported as engine "<engine>-obj"
+    """
+    matchers = available_matchers()
+    results = []
+    for corpus in corpora:
+        a, b = CORPORA[corpus](random.Random(seed), nlines)
+        objects = (
+            [ObjectItem(line) for line in a],
+            [ObjectItem(line) for line in b],
+        )
+        for engine in engines:
+            if engine not in matchers:
+                continue
+            matcher = matchers[engine]
+            for operation in operations:
+                fn = OPERATIONS[operation]
+                runs: List[Tuple[str, Sequence[Any], Sequence[Any]]] = [
+                    (engine, a, b)
+                ]
+                if baseline and operation in BASELINE_OPERATIONS:
+                    runs.append((f"{engine}-obj", *objects))
+                timings = []
+                for name, items_a, items_b in runs:
+                    seconds, peak = measure(
+                        lambda: fn(matcher, items_a, items_b), repeat
+                    )
+                    timings.append(seconds)
+                    print(
+                        f"{corpus:>10} {name:>11} {operation:>12}: "
+                        f"{seconds:8.4f}s {peak / 1e6:9.1f} MB",
+                        flush=True,
+                    )
+                    results.append(
+                        {
+                            "corpus": corpus,
+                            "engine": name,
+                            "operation": operation,
+                            "lines_a": len(a),
+                            "lines_b": len(b),
+                            "seconds": seconds,
+                            "peak_bytes": peak,
+                        }
+                    )
+                if len(timings) > 1:
+                    print(
+                        f"{corpus:>10} {engine:>11} {operation:>12}: "
+                        f"{timings[1] / timings[0]:.1f}x faster than on "
+                        "object items",
+                        flush=True,
+                    )
+    return results
+
+
+def compare(
+    baseline: List[Dict[str, Any]], results: List[Dict[str, Any]]
+) -> None:
+    """Print how results changed relative to a baseline run."""
+
+    def key(result: Dict[str, Any]) -> Tuple[str, str, str]:
+        return (result["corpus"], result["engine"], result["operation"])
+
+    old = {key(result): result for result in baseline}
+    for result in results:
+        previous = old.get(key(result))
+        if previous is None:
+            continue
+        corpus, engine, operation = key(result)
+        seconds = result["seconds"] / previous["seconds"] - 1
+        memory = result["peak_bytes"] / max(previous["peak_bytes"], 1) - 1
+        print(
+            f"{corpus:>10} {engine:>11} {operation:>12}: "
+            f"time {seconds:+7.1%} memory {memory:+7.1%}"
+        )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    import optparse
+
+    matchers = available_matchers()
+    p = optparse.OptionParser(usage="%prog [options]")
+    p.add_option(
+        "--lines",
+        type="int",
+        default=10000,
+        help="Number of lines in each generated file (the huge corpus "
+        "has ten times as many)",
+    )
+    p.add_option(
+        "--repeat", type="int", default=3, help="Number of timing runs"
+    )
+    p.add_option("--seed", type="int", default=0, help="Seed for the corpora")
+    p.add_option(
+        "--corpus",
+        action="append",
+        choices=list(CORPORA),
+        help="Corpus to run, may be repeated (default: all of "
+        f"{', '.join(CORPORA)})",
+    )
+    p.add_option(
+        "--engine",
+        action="append",
+        choices=["py", "rs", "difflib"],
+        help="Engine to run, may be repeated (default: all of "
+        f"{', '.join(matchers)})",
+    )
+    p.add_option(
+        "--operation",
+        action="append",
+        choices=list(OPERATIONS),
+        help="Operation to time, may be repeated (default: all of "
+        f"{', '.join(OPERATIONS)})",
+    )
+    p.add_option(
+        "--json", type="string", help="Write the results to this file"
+    )
+    p.add_option(
+        "--compare",
+        type="string",
+        help="Compare the results to those in this file, written earlier "
+        "with --json",
+    )
+    p.add_option(
+        "--baseline",
+        action="store_true",
+        help="Also time the matchers on items compared through Python "
+        "__eq__ and __hash__, and report the speedup over them",
+    )
+    p.add_option(
+        "--threads",
+        type="int",
+        default=0,
+        help="Also diff this many file pairs concurrently, one per thread",
+    )
+    p.add_option(
+        "--min-speedup",
+        type="float",
+        default=0.0,
+        help="With --threads, exit with an error if diffing concurrently "
+        "is not at least this many times faster than serially",
+    )
+    (opts, args) = p.parse_args(argv)
+
+    engines = opts.engine or list(matchers)
+    results = run(
+        opts.corpus or list(CORPORA),
+        engines,
+        opts.operation or list(OPERATIONS),
+        opts.lines,
+        opts.repeat,
+        opts.seed,
+        opts.baseline,
+    )
+
+    status = 0
+    if opts.threads:
+        pairs = [
+            source_edits(random.Random(seed), opts.lines)
+            for seed in range(opts.threads)
+        ]
+        for name, matcher in matchers.items():
+            if name not in engines:
+                continue
+            # Take the best of the runs, as other processes may be busy
+            serial = min(
+                time_threads(matcher, pairs, 1) for _ in range(opts.repeat)
+            )
+            parallel = min(
+                time_threads(matcher, pairs, opts.threads)
+                for _ in range(opts.repeat)
+            )
+            print(
+                f"{name}: {opts.threads} pairs in {serial:.3f}s serially, "
+                f"{parallel:.3f}s with {opts.threads} threads "
+                f"({serial / parallel:.1f}x)"
+            )
+            if serial / parallel < opts.min_speedup:
+                print(
+                    f"{name}: expected at least {opts.min_speedup:.1f}x",
+                    file=sys.stderr,
+                )
+                status = 1
+
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump(
+                {
+                    "version": ".".join(map(str, __version__)),
+                    "python": platform.python_version(),
+                    "implementation": platform.python_implementation(),
+                    "machine": platform.machine(),
+                    "lines": opts.lines,
+                    "seed": opts.seed,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if opts.compare:
+        with open(opts.compare) as f:
+            compare(json.load(f)["results"], results)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
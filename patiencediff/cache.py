@@ -0,0 +1,369 @@
+# Copyright (C) 2026 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""A cache for the opcodes of diffs between the same pairs of sequences."""
+
+import difflib
+import functools
+import hashlib
+import sqlite3
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    Union,
+)
+
+from ._patiencediff_py import Opcode, OpcodeArray, _group_opcodes
+
+# Bump this when the stored representation changes
+_FORMAT = b"1"
+# Matcher options that do not change the opcodes of a finished diff
+_NEUTRAL_OPTIONS = frozenset(("collect_stats", "timeout", "cancel"))
+
+
+def _unwrap_matcher(
+    sequencematcher: Callable[..., Any],
+) -> Tuple[Callable[..., Any], Tuple[Any, ...], Dict[str, Any]]:
+    """Split a matcher factory into a callable and the arguments it binds."""
+    args: Tuple[Any, ...] = ()
+    keywords: Dict[str, Any] = {}
+    while isinstance(sequencematcher, functools.partial):
+        args = sequencematcher.args + args
+        keywords = {**sequencematcher.keywords, **keywords}
+        sequencematcher = sequencematcher.func
+    return sequencematcher, args, keywords
+
+
+def _describe_matcher(
+    func: Callable[..., Any], args: Tuple[Any, ...], keywords: Dict[str, Any]
+) -> bytes:
+    """Describe a matcher and the options that change its output."""
+    name = getattr(func, "__qualname__", type(func).__qualname__)
+    module = getattr(func, "__module__", type(func).__module__)
+    options = [repr(arg) for arg in args] + [
+        f"{option}={value!r}"
+        for option, value in sorted(keywords.items())
+        if option not in _NEUTRAL_OPTIONS
+    ]
+    return f"{module}.{name}({', '.join(options)})".encode()
+
+
+def content_hash(lines: Sequence[Union[str, bytes]]) -> bytes:
+    """Return a digest of a sequence of str or bytes lines.
+
+    Every line is hashed along with its length and type, so that no two
+    different sequences share a digest by splitting or joining lines.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    for line in lines:
+        if isinstance(line, str):
+            data = line.encode("utf-8", "surrogatepass")
+            h.update(b"s%d:" % len(data))
+        elif isinstance(line, (bytes, bytearray, memoryview)):
+            data = bytes(line)
+            h.update(b"b%d:" % len(data))
+        else:
+            raise TypeError(
+                f"can only hash str or bytes lines, not {type(line).__name__}"
+            )
+        h.update(data)
+    return h.digest()
+
+
+class DiffCache:
+    """A cache of opcodes, keyed by the contents of both sides of a diff.
+
+    Entries are kept in memory and evicted least recently used first once
+    there are more than max_entries of them or they use more than
+    max_bytes. If path is given, entries are also written to an sqlite
+    database there, which is consulted when an entry is not in memory;
+    the database is never evicted from.
+
+    Opcodes are stored as OpcodeArray data rather than as rendered diffs,
+    so a single entry serves any amount of context and any file names.
+    The cache can be shared between threads. Pass its sequencematcher to
+    unified_diff() to render diffs from cached opcodes::
+
+        cache = DiffCache(max_entries=1000)
+        lines = unified_diff(a, b, sequencematcher=cache.sequencematcher)
+
+    :ivar hits: Lookups answered from memory
+    :ivar disk_hits: Lookups answered from the database
+    :ivar misses: Lookups that required computing the diff
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = 1024,
+        max_bytes: Optional[int] = None,
+        path: Optional[str] = None,
+        sequencematcher: Optional[
+            Callable[..., difflib.SequenceMatcher]
+        ] = None,
+    ) -> None:
+        """Create a cache.
+
+        :param max_entries: The maximum number of entries to keep in
+            memory, or None for no limit
+        :param max_bytes: The maximum size of the opcodes kept in memory,
+            or None for no limit
+        :param path: The path of an sqlite database to keep entries in
+            as well, or None to only keep them in memory
+        :param sequencematcher: The matcher to compute diffs with,
+            defaulting to PatienceSequenceMatcher. This can be any callable
+            that creates a matcher, such as a functools.partial binding
+            histogram=True; the options it binds are part of the cache
+            keys, and a key it binds is applied as for get_opcodes()
+        """
+        if sequencematcher is None:
+            from . import PatienceSequenceMatcher
+
+            sequencematcher = PatienceSequenceMatcher
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        func, args, keywords = _unwrap_matcher(sequencematcher)
+        # Lines are matched by key by diffing their keys, see get_opcodes()
+        self._key = keywords.pop("key", None)
+        self._matcher = functools.partial(func, *args, **keywords)
+        self._options = _describe_matcher(func, args, keywords)
+        self._entries: OrderedDict[bytes, array[int]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            with self._db:
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS opcodes "
+                    "(key BLOB PRIMARY KEY, data BLOB NOT NULL)"
+                )
+        self.sequencematcher: Type[difflib.SequenceMatcher] = type(
+            "CachedSequenceMatcher", (_CachedSequenceMatcher,), {"cache": self}
+        )
+
+    def __len__(self) -> int:
+        """Return the number of entries kept in memory."""
+        return len(self._entries)
+
+    def __enter__(self) -> "DiffCache":
+        """Return the cache, to close it at the end of a with block."""
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        """Close the database."""
+        self.close()
+
+    def close(self) -> None:
+        """Close the database, if there is one."""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def clear(self) -> None:
+        """Remove all entries, from memory and from the database."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("DELETE FROM opcodes")
+
+    @property
+    def nbytes(self) -> int:
+        """The size of the opcodes kept in memory."""
+        return self._bytes
+
+    def key(
+        self,
+        a: Sequence[Union[str, bytes]],
+        b: Sequence[Union[str, bytes]],
+    ) -> bytes:
+        """Return the cache key for a diff of a and b."""
+        return hashlib.blake2b(
+            b"\0".join(
+                (_FORMAT, self._options, content_hash(a), content_hash(b))
+            ),
+            digest_size=20,
+        ).digest()
+
+    def get_opcodes(
+        self,
+        a: Sequence[Any],
+        b: Sequence[Any],
+        key: Optional[Callable[[Any], Hashable]] = None,
+    ) -> OpcodeArray:
+        """Return the opcodes to turn a into b, computing them if needed.
+
+        :param key: If given, match lines by the result of calling key on
+            them; the results must be str or bytes. Diffs that a timeout
+            or cancellation cut short are returned but not stored
+        """
+        if key is None:
+            key = self._key
+        if key is not None:
+            # Matching by key gives the diff of the keys, so that is what
+            # gets looked up and stored
+            a = [key(line) for line in a]
+            b = [key(line) for line in b]
+        digest = self.key(a, b)
+        data = self._lookup(digest)
+        if data is not None:
+            return OpcodeArray(data)
+        matcher: Any = self._matcher(None, a, b)
+        if hasattr(matcher, "get_opcodes_array"):
+            opcodes: OpcodeArray = matcher.get_opcodes_array()
+        else:
+            opcodes = OpcodeArray.from_opcodes(matcher.get_opcodes())
+        if not getattr(matcher, "degraded", False):
+            self._store(digest, opcodes.data)
+        return opcodes
+
+    def get_grouped_opcodes(
+        self,
+        a: Sequence[Union[str, bytes]],
+        b: Sequence[Union[str, bytes]],
+        n: int = 3,
+        key: Optional[Callable[[Any], Hashable]] = None,
+    ) -> Iterator[List[Opcode]]:
+        """Return the groups of opcodes with up to n lines of context."""
+        return _group_opcodes(self.get_opcodes(a, b, key), n)
+
+    def _lookup(self, key: bytes) -> "Optional[array[int]]":
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT data FROM opcodes WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    data = array("q")
+                    data.frombytes(row[0])
+                    if sys.byteorder == "big":
+                        data.byteswap()
+                    self._remember(key, data)
+                    return data
+            self.misses += 1
+            return None
+
+    def _store(self, key: bytes, data: "array[int]") -> None:
+        with self._lock:
+            self._remember(key, data)
+            if self._db is not None:
+                if sys.byteorder == "big":
+                    data = array("q", data)
+                    data.byteswap()
+                with self._db:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO opcodes VALUES (?, ?)",
+                        (key, data.tobytes()),
+                    )
+
+    def _remember(self, key: bytes, data: "array[int]") -> None:
+        """Add an entry to the memory tier, evicting old ones if needed."""
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= _entry_size(old)
+        self._entries[key] = data
+        self._bytes += _entry_size(data)
+        while self._entries and (
+            (
+                self.max_entries is not None
+                and len(self._entries) > self.max_entries
+            )
+            or (self.max_bytes is not None and self._bytes > self.max_bytes)
+        ):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= _entry_size(evicted)
+
+
+def _entry_size(data: "array[int]") -> int:
+    return len(data) * data.itemsize
+
+
+class _CachedSequenceMatcher(difflib.SequenceMatcher):
+    """A sequence matcher that gets its opcodes from a DiffCache.
+
+    DiffCache.sequencematcher is a subclass bound to the cache, which can
+    be passed to unified_diff() and friends.
+    """
+
+    cache: DiffCache
+
+    def __init__(
+        self,
+        isjunk: Optional[Callable[[Any], bool]] = None,
+        a: Sequence[Any] = "",
+        b: Sequence[Any] = "",
+        key: Optional[Callable[[Any], Hashable]] = None,
+    ) -> None:
+        if isjunk is not None:
+            raise NotImplementedError(
+                "Currently we do not support isjunk for sequence matching"
+            )
+        self.key = key
+        # difflib's constructor indexes b, which a cache hit never needs
+        self.isjunk = isjunk
+        self.autojunk = False
+        self.a = a
+        self.b = b
+        self.matching_blocks = None
+        self.opcodes = None
+        self.fullbcount = None
+        self._opcodes: Optional[OpcodeArray] = None
+
+    def get_opcodes_array(self) -> OpcodeArray:
+        """Return the opcodes as a compact OpcodeArray."""
+        if self._opcodes is None:
+            self._opcodes = self.cache.get_opcodes(self.a, self.b, self.key)
+        return self._opcodes
+
+    def get_opcodes(self) -> List[Opcode]:  # type: ignore[override]
+        return self.get_opcodes_array().tolist()
+
+    def iter_opcodes(self) -> Iterator[Opcode]:
+        return iter(self.get_opcodes_array())
+
+    def iter_grouped_opcodes(self, n: int = 3) -> Iterator[List[Opcode]]:
+        return _group_opcodes(self.get_opcodes_array(), n)
+
+    def get_matching_blocks(self) -> List[difflib.Match]:
+        blocks = [
+            difflib.Match(i1, j1, i2 - i1)
+            for tag, i1, i2, j1, j2 in self.get_opcodes_array()
+            if tag == "equal"
+        ]
+        blocks.append(difflib.Match(len(self.a), len(self.b), 0))
+        return blocks
@@ -0,0 +1,329 @@
+# Copyright (C) 2026 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Pre-tokenized indexes for files that are diffed many times."""
+
+import difflib
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Type,
+    Union,
+    cast,
+)
+
+from ._patiencediff_py import Opcode
+
+_MAGIC = b"PDINDEX1"
+# magic, byte order, number of lines, number of tokens, file size,
+# file mtime in nanoseconds, file digest
+_HEADER = struct.Struct("=8s8sQQQq32s")
+
+
+def _line_hash(line: Union[str, bytes]) -> int:
+    """Return the 64-bit hash of a line, as stored in an index."""
+    if isinstance(line, str):
+        line = line.encode("utf-8", "surrogatepass")
+    return int.from_bytes(
+        hashlib.blake2b(line, digest_size=8).digest(), "little"
+    )
+
+
+def _file_digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=32).digest()
+
+
+class LineIndex:
+    """The tokenized lines of a file, which can be saved and mmapped back.
+
+    Every distinct line is assigned a token, in order of first occurrence.
+    The index holds the token of every line and the 64-bit hash of every
+    token's line (sorted, for lookups). Diffing other sequences against the indexed one only requires
+    hashing the lines of the other side.
+
+    Lines are identified by their hash alone, so two different lines with
+    the same 64-bit hash would be treated as equal.
+
+    :ivar tokens: The token of every line
+    :ivar size: The size of the indexed file, or 0
+    :ivar mtime_ns: The modification time of the indexed file, or 0
+    :ivar digest: The blake2b digest of the indexed file, or empty
+    """
+
+    def __init__(
+        self,
+        tokens: Sequence[int],
+        hashes: Sequence[int],
+        hash_tokens: Sequence[int],
+        size: int = 0,
+        mtime_ns: int = 0,
+        digest: bytes = b"",
+    ) -> None:
+        """Create an index; use build(), from_file() or load() instead.
+
+        :param tokens: The token of every line
+        :param hashes: The sorted hashes of all distinct lines
+        :param hash_tokens: The token of the line with each of hashes
+        """
+        self.tokens = tokens
+        self._hashes = hashes
+        self._hash_tokens = hash_tokens
+        self._by_hash: Optional[Dict[int, int]] = None
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.digest = digest
+        self.sequencematcher: Type[difflib.SequenceMatcher] = type(
+            "IndexedSequenceMatcher",
+            (_IndexedSequenceMatcher,),
+            {"index": self},
+        )
+
+    def __len__(self) -> int:
+        """Return the number of lines in the index."""
+        return len(self.tokens)
+
+    @classmethod
+    def build(
+        cls,
+        lines: Sequence[Union[str, bytes]],
+        size: int = 0,
+        mtime_ns: int = 0,
+        digest: bytes = b"",
+    ) -> "LineIndex":
+        """Index a sequence of str or bytes lines."""
+        by_hash: Dict[int, int] = {}
+        tokens = array("I")
+        for line in lines:
+            h = _line_hash(line)
+            token = by_hash.get(h)
+            if token is None:
+                token = by_hash[h] = len(by_hash)
+            tokens.append(token)
+        hashes = array("Q", sorted(by_hash))
+        hash_tokens = array("I", (by_hash[h] for h in hashes))
+        return cls(tokens, hashes, hash_tokens, size, mtime_ns, digest)
+
+    @classmethod
+    def from_file(cls, path: str) -> "LineIndex":
+        """Index the lines of a file, split like readlines() in binary mode."""
+        from . import split_lines
+
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+        return cls.build(
+            split_lines(data), len(data), st.st_mtime_ns, _file_digest(data)
+        )
+
+    @classmethod
+    def for_file(cls, path: str, index_path: str) -> "LineIndex":
+        """Load the index of a file, rebuilding and saving it if needed.
+
+        :param path: The file to index
+        :param index_path: Where the index of the file is kept
+        """
+        try:
+            index = cls.load(index_path)
+        except (OSError, ValueError):
+            pass
+        else:
+            mtime_ns = index._current_mtime(path)
+            if mtime_ns is not None:
+                if mtime_ns != index.mtime_ns:
+                    # Only the modification time changed; record it, so
+                    # that the file is not hashed again next time
+                    index.mtime_ns = mtime_ns
+                    index.save(index_path)
+                return index
+        index = cls.from_file(path)
+        index.save(index_path)
+        return index
+
+    def is_stale(self, path: str) -> bool:
+        """Check whether the index no longer matches a file.
+
+        The size and modification time are compared first; if only the
+        modification time differs, the contents are hashed to tell whether
+        the file was actually changed.
+        """
+        return self._current_mtime(path) is None
+
+    def _current_mtime(self, path: str) -> Optional[int]:
+        """Return the modification time of a file the index still matches.
+
+        :return: The modification time of the file in nanoseconds, or None
+            if the file is missing or no longer matches the index
+        """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if st.st_size != self.size:
+            return None
+        if st.st_mtime_ns != self.mtime_ns:
+            with open(path, "rb") as f:
+                if _file_digest(f.read()) != self.digest:
+                    return None
+        return st.st_mtime_ns
+
+    def save(self, path: str) -> None:
+        """Write the index to a file, replacing it atomically."""
+        tmp = f"{path}.tmp{os.getpid()}"
+        with open(tmp, "wb") as f:
+            f.write(
+                _HEADER.pack(
+                    _MAGIC,
+                    sys.byteorder.encode(),
+                    len(self.tokens),
+                    len(self._hashes),
+                    self.size,
+                    self.mtime_ns,
+                    self.digest,
+                )
+            )
+            # The 8-byte hashes come first, so that they stay aligned
+            f.write(array("Q", self._hashes).tobytes())
+            f.write(array("I", self._hash_tokens).tobytes())
+            f.write(array("I", self.tokens).tobytes())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "LineIndex":
+        """Map an index written by save() into memory.
+
+        No data is copied; the arrays of the index are views on the
+        mapped file.
+
+        :raise ValueError: If the file is not an index or was written on
+            a machine with a different byte order
+        """
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(data) < _HEADER.size:
+            raise ValueError(f"{path} is not a line index")
+        magic, byteorder, nlines, ntokens, size, mtime_ns, digest = (
+            _HEADER.unpack_from(data)
+        )
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a line index")
+        if byteorder.rstrip(b"\0") != sys.byteorder.encode():
+            raise ValueError(f"{path} was written with a different byte order")
+        if len(data) != _HEADER.size + 12 * ntokens + 4 * nlines:
+            raise ValueError(f"{path} is truncated")
+        view = memoryview(data)
+        offset = _HEADER.size
+        hashes = view[offset : offset + 8 * ntokens].cast("Q")
+        offset += 8 * ntokens
+        hash_tokens = view[offset : offset + 4 * ntokens].cast("I")
+        offset += 4 * ntokens
+        tokens = view[offset:].cast("I")
+        return cls(tokens, hashes, hash_tokens, size, mtime_ns, digest)
+
+    def tokenize(self, lines: Sequence[Union[str, bytes]]) -> "array[int]":
+        """Return the tokens for another sequence of lines.
+
+        Lines that do not occur in the index all get the same token, one
+        that no indexed line has, as they can never match the indexed side.
+        """
+        if self._by_hash is None:
+            # Looking hashes up in a dict is much faster than bisecting
+            # the mapped array, and is only done once per index
+            self._by_hash = dict(zip(self._hashes, self._hash_tokens))
+        get = self._by_hash.get
+        missing = len(self._hashes)
+        return array("I", [get(_line_hash(line), missing) for line in lines])
+
+    def matcher(
+        self,
+        b: Sequence[Union[str, bytes]],
+        sequencematcher: Optional[Type[difflib.SequenceMatcher]] = None,
+    ) -> difflib.SequenceMatcher:
+        """Return a matcher comparing the indexed lines to b."""
+        if sequencematcher is None:
+            from . import PatienceSequenceMatcher
+
+            sequencematcher = PatienceSequenceMatcher
+        return sequencematcher(None, self.tokens, self.tokenize(b))
+
+
+class _IndexedSequenceMatcher(difflib.SequenceMatcher):
+    """A sequence matcher that diffs against the tokens of a LineIndex.
+
+    LineIndex.sequencematcher is a subclass bound to the index, which can
+    be passed to unified_diff() and friends along with the indexed lines.
+    The index holds the hashes of the lines themselves, so when lines are
+    matched by key the index is not used and both sides are diffed in full.
+    """
+
+    index: LineIndex
+
+    def __init__(
+        self,
+        isjunk: Optional[Callable[[Any], bool]] = None,
+        a: Sequence[Any] = "",
+        b: Sequence[Any] = "",
+        key: Optional[Callable[[Any], Hashable]] = None,
+    ) -> None:
+        if isjunk is not None:
+            raise NotImplementedError(
+                "Currently we do not support isjunk for sequence matching"
+            )
+        if len(a) != len(self.index):
+            raise ValueError("a does not have the lines of the index")
+        self.key = key
+        # The work is done by the matcher on the tokens
+        self.isjunk = isjunk
+        self.autojunk = False
+        self.a = a
+        self.b = b
+        self.matching_blocks = None
+        self.opcodes = None
+        self.fullbcount = None
+        if key is None:
+            self._matcher: Any = self.index.matcher(b)
+        else:
+            from . import PatienceSequenceMatcher
+
+            factory = cast(
+                Callable[..., difflib.SequenceMatcher], PatienceSequenceMatcher
+            )
+            self._matcher = factory(None, a, b, key=key)
+
+    def get_matching_blocks(self) -> List[difflib.Match]:
+        blocks: List[difflib.Match] = self._matcher.get_matching_blocks()
+        return blocks
+
+    def get_opcodes(self) -> List[Opcode]:  # type: ignore[override]
+        opcodes: List[Opcode] = self._matcher.get_opcodes()
+        return opcodes
+
+    def iter_opcodes(self) -> Iterator[Opcode]:
+        return iter(self._matcher.iter_opcodes())
+
+    def iter_grouped_opcodes(self, n: int = 3) -> Iterator[List[Opcode]]:
+        return iter(self._matcher.iter_grouped_opcodes(n))
@@ -0,0 +1,164 @@
+# Copyright (C) 2026 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Three-way merges built on the patience matcher."""
+
+import difflib
+from typing import (
+    AnyStr,
+    Callable,
+    Generic,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Type,
+    cast,
+)
+
+from ._patiencediff_py import MergeRegion, merge_regions_py
+
+__all__ = ["Merge3", "MergeRegion", "merge_regions"]
+
+merge_regions: Callable[..., List[MergeRegion]]
+
+try:
+    from ._patiencediff_rs import merge_regions_rs as merge_regions
+except ImportError:
+    merge_regions = merge_regions_py
+
+
+def _encode_marker(text: str) -> bytes:
+    return text.encode("utf-8", "surrogateescape")
+
+
+class Merge3(Generic[AnyStr]):
+    """A three-way merge of two descendants of a common base.
+
+    Both sides are diffed against base, and the changes are combined into
+    merge regions; regions that were changed differently on both sides
+    are conflicts::
+
+        m = Merge3(base, this, other)
+        merged = list(m.merge_lines(name_this="mine", name_other="theirs"))
+
+    :ivar base: The lines of the common ancestor
+    :ivar this: The lines of one descendant
+    :ivar other: The lines of the other descendant
+    """
+
+    def __init__(
+        self,
+        base: Sequence[AnyStr],
+        this: Sequence[AnyStr],
+        other: Sequence[AnyStr],
+        sequencematcher: Optional[Type[difflib.SequenceMatcher]] = None,
+    ) -> None:
+        """Create a merge.
+
+        :param sequencematcher: The matcher to diff base against both sides
+            with. By default both diffs run natively if the Rust extension
+            is available, and PatienceSequenceMatcher_py is used otherwise.
+        """
+        self.base: Sequence[AnyStr] = base
+        self.this: Sequence[AnyStr] = this
+        self.other: Sequence[AnyStr] = other
+        self._sequencematcher = sequencematcher
+        self._regions: Optional[List[MergeRegion]] = None
+
+    def merge_regions(self) -> List[MergeRegion]:
+        """Return the regions of the merge.
+
+        :return: A list of (tag, base_start, base_end, this_start, this_end,
+            other_start, other_end) tuples, where tag is "unchanged",
+            "same" (both sides made the same change), "this" or "other"
+            (only that side changed) or "conflict"
+        """
+        if self._regions is None:
+            if self._sequencematcher is None:
+                self._regions = merge_regions(self.base, self.this, self.other)
+            else:
+                self._regions = merge_regions_py(
+                    self.base, self.this, self.other, self._sequencematcher
+                )
+        return self._regions
+
+    def has_conflicts(self) -> bool:
+        """Check whether any region was changed differently on both sides."""
+        return any(region[0] == "conflict" for region in self.merge_regions())
+
+    def _newline(self) -> str:
+        """Return the line ending used by the lines of this."""
+        for line in (self.this or self.base or self.other)[:1]:
+            text = line.decode("latin-1") if isinstance(line, bytes) else line
+            if text.endswith("\r\n"):
+                return "\r\n"
+            if text.endswith("\r"):
+                return "\r"
+        return "\n"
+
+    def merge_lines(
+        self,
+        name_this: Optional[AnyStr] = None,
+        name_other: Optional[AnyStr] = None,
+        name_base: Optional[AnyStr] = None,
+        start_marker: str = "<<<<<<<",
+        mid_marker: str = "=======",
+        end_marker: str = ">>>>>>>",
+        base_marker: Optional[str] = None,
+    ) -> Iterator[AnyStr]:
+        """Generate the merged lines, with markers around conflicts.
+
+        :param name_this: The name to put after the start marker
+        :param name_other: The name to put after the end marker
+        :param name_base: The name to put after the base marker
+        :param base_marker: If given, the base lines of every conflict are
+            included after a line with this marker
+        """
+        newline = self._newline()
+        bytes_mode = any(
+            isinstance(lines[0], bytes)
+            for lines in (self.this, self.other, self.base)
+            if lines
+        )
+
+        to_line = cast(
+            Callable[[str], AnyStr], _encode_marker if bytes_mode else str
+        )
+
+        def marker(text: str, name: Optional[AnyStr]) -> AnyStr:
+            if isinstance(name, bytes):
+                text += " " + name.decode("utf-8", "surrogateescape")
+            elif name is not None:
+                text += " " + name
+            return to_line(text + newline)
+
+        for tag, bz, ez, ba, ea, bb, eb in self.merge_regions():
+            if tag == "unchanged":
+                yield from self.base[bz:ez]
+            elif tag in ("same", "this"):
+                yield from self.this[ba:ea]
+            elif tag == "other":
+                yield from self.other[bb:eb]
+            else:
+                yield marker(start_marker, name_this)
+                yield from self.this[ba:ea]
+                if base_marker is not None:
+                    yield marker(base_marker, name_base)
+                    yield from self.base[bz:ez]
+                yield marker(mid_marker, None)
+                yield from self.other[bb:eb]
+                yield marker(end_marker, name_other)
@@ -15,10 +15,19 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import asyncio
+import concurrent.futures
+import contextlib
 import difflib
+import functools
+import io
 import os
+import random
 import shutil
+import subprocess
+import sys
 import tempfile
+import types
 import unittest
 from typing import Any, Callable, List, Sequence, Tuple, Type
 
@@ -39,6 +48,22 @@ class TestPatienceDiffLib(unittest.TestCase):
         self._PatienceSequenceMatcher: Type[difflib.SequenceMatcher] = (
             _patiencediff_py.PatienceSequenceMatcher_py
         )
+        self._diff_many: Callable[..., List[Any]] = (
+            _patiencediff_py.diff_many_py
+        )
+        self._split_lines: Callable[[bytes], Sequence[bytes]] = (
+            _patiencediff_py.split_lines_py
+        )
+        self._render_unified: Callable[..., Any] = patiencediff.render_unified
+        self._merge_regions: Callable[..., List[Any]] = (
+            _patiencediff_py.merge_regions_py
+        )
+        self._refine_opcodes: Callable[..., List[Any]] = (
+            _patiencediff_py.refine_opcodes_py
+        )
+        self._CancellationToken: Callable[[], Any] = (
+            _patiencediff_py.CancellationToken_py
+        )
 
     def test_diff_unicode_string(self) -> None:
         a = "".join([chr(i) for i in range(4000, 4500, 3)])
@@ -103,6 +128,65 @@ class TestPatienceDiffLib(unittest.TestCase):
         # This is what it currently gives:
         test_one("aBccDe", "abccde", [(0, 0), (5, 5)])
 
+    def test_diff_many(self) -> None:
+        pairs = [
+            ("abcd", "abce"),
+            ("", "abc"),
+            (["hello\n", "world\n"], ["hello\n", "there\n"]),
+            ("abcdefghijklmnop", "abcdefxydefghijklmnop"),
+        ]
+        expected = [
+            self._PatienceSequenceMatcher(None, a, b).get_opcodes()
+            for a, b in pairs
+        ]
+        self.assertEqual([], self._diff_many([]))
+        self.assertEqual(expected, self._diff_many(pairs, workers=1))
+        self.assertEqual(expected, self._diff_many(iter(pairs), workers=2))
+        expected_grouped = [
+            list(
+                self._PatienceSequenceMatcher(None, a, b).get_grouped_opcodes(
+                    1
+                )
+            )
+            for a, b in pairs
+        ]
+        self.assertEqual(
+            expected_grouped, self._diff_many(pairs, workers=2, n=1)
+        )
+
+    def test_split_lines(self) -> None:
+        self.assertEqual([], list(self._split_lines(b"")))
+        lines = self._split_lines(b"a\nb\r\n\nc")
+        self.assertEqual(4, len(lines))
+        self.assertEqual([b"a\n", b"b\r\n", b"\n", b"c"], list(lines))
+        self.assertEqual(b"c", lines[-1])
+        self.assertEqual([b"b\r\n", b"\n"], lines[1:3])
+        self.assertEqual([b"a\n"], list(self._split_lines(b"a\n")))
+
+    def test_patience_unified_diff_bytes(self) -> None:
+        txt_a = self._split_lines(b"hello there\nworld\nhow are you\xff\n")
+        txt_b = self._split_lines(b"hello there\nhow are you\xff\n")
+        self.assertEqual(
+            [
+                b"--- a\t2008-08-08\n",
+                b"+++ b\n",
+                b"@@ -1,3 +1,2 @@\n",
+                b" hello there\n",
+                b"-world\n",
+                b" how are you\xff\n",
+            ],
+            list(
+                patiencediff.unified_diff_bytes(
+                    txt_a,
+                    txt_b,
+                    fromfile=b"a",
+                    tofile=b"b",
+                    fromfiledate="2008-08-08",
+                    sequencematcher=self._PatienceSequenceMatcher,
+                )
+            ),
+        )
+
     def assertDiffBlocks(
         self,
         a: Sequence[Any],
@@ -323,6 +407,458 @@ class TestPatienceDiffLib(unittest.TestCase):
             ],
         )
 
+    def test_opcodes_array(self) -> None:
+        s: Any = self._PatienceSequenceMatcher(None, "abxcdef", "abycdzef")
+        ops = s.get_opcodes_array()
+        self.assertIsInstance(ops, patiencediff.OpcodeArray)
+        self.assertEqual(s.get_opcodes(), list(ops))
+        self.assertEqual(s.get_opcodes(), ops)
+        self.assertEqual(len(s.get_opcodes()), len(ops))
+        self.assertEqual(("equal", 5, 7, 6, 8), ops[-1])
+        self.assertEqual(s.get_opcodes()[1:3], ops[1:3])
+        self.assertRaises(IndexError, ops.__getitem__, len(ops))
+        self.assertEqual(
+            [op[2] for op in s.get_opcodes()], ops.column("i2").tolist()
+        )
+        self.assertEqual(8, ops.data.itemsize)
+        self.assertEqual(5 * len(ops), len(memoryview(ops.data)))
+
+        blocks = s.get_matching_blocks_array()
+        self.assertIsInstance(blocks, patiencediff.MatchArray)
+        self.assertEqual(s.get_matching_blocks(), list(blocks))
+        self.assertIsInstance(blocks[0], difflib.Match)
+        self.assertEqual([2, 2, 2, 0], blocks.column("size").tolist())
+
+    def test_set_seqs(self) -> None:
+        base = ["a\n", "b\n", "c\n", "b\n", "d\n", "e\n"]
+        others = [
+            ["a\n", "x\n", "c\n", "b\n", "e\n"],
+            ["e\n", "d\n", "b\n", "c\n", "b\n", "a\n"],
+            [],
+            ["x\n", "y\n"],
+            base,
+        ]
+        s: Any = self._PatienceSequenceMatcher(None, base, base)
+        for other in others:
+            s.set_seq2(other)
+            self.assertEqual(
+                self._PatienceSequenceMatcher(None, base, other).get_opcodes(),
+                s.get_opcodes(),
+            )
+        for other in others:
+            s.set_seq1(other)
+            self.assertEqual(
+                self._PatienceSequenceMatcher(None, other, base).get_opcodes(),
+                s.get_opcodes(),
+            )
+        s.set_seqs(base, others[0])
+        self.assertEqual(
+            self._PatienceSequenceMatcher(None, base, others[0]).get_opcodes(),
+            s.get_opcodes(),
+        )
+
+    def test_apply_edit_b(self) -> None:
+        a = [f"{i % 7 if i % 3 else i}\n" for i in range(60)]
+        b = list(a)
+        s: Any = self._PatienceSequenceMatcher(None, a, b)
+        s.get_opcodes()
+        edits = [
+            (10, 11, ["x\n"]),
+            (40, 40, ["y\n", "z\n"]),
+            (0, 3, []),
+            (20, 25, ["1\n", "2\n", "3\n"]),
+            (50, 50, ["0\n"]),
+            (5, 6, ["5\n"]),
+        ]
+        for i, (start, end, items) in enumerate(edits):
+            s.apply_edit_b(start, end, items)
+            b[start:end] = items
+            if i % 2:
+                # Several edits can be made before diffing again
+                continue
+            self.assertEqual(
+                self._PatienceSequenceMatcher(None, a, b).get_opcodes(),
+                s.get_opcodes(),
+            )
+        self.assertEqual(
+            self._PatienceSequenceMatcher(None, a, b).get_matching_blocks(),
+            s.get_matching_blocks(),
+        )
+        self.assertRaises(IndexError, s.apply_edit_b, 5, 4, [])
+        self.assertRaises(IndexError, s.apply_edit_b, 0, len(b) + 1, [])
+
+    def test_adiff(self) -> None:
+        a = list("abcdefg")
+        b = list("abXdefgY")
+        psm = self._PatienceSequenceMatcher
+        self.assertEqual(
+            psm(None, a, b).get_opcodes(),
+            asyncio.run(patiencediff.adiff(a, b, sequencematcher=psm)),
+        )
+
+    def test_aunified_diff_hunks(self) -> None:
+        a = [f"{i}\n" for i in range(20)]
+        b = list(a)
+        b[2] = "x\n"
+        b[15] = "y\n"
+        psm = self._PatienceSequenceMatcher
+
+        async def collect() -> List[List[str]]:
+            return [
+                hunk
+                async for hunk in patiencediff.aunified_diff_hunks(
+                    a, b, "a", "b", sequencematcher=psm
+                )
+            ]
+
+        hunks = asyncio.run(collect())
+        self.assertEqual(2, len(hunks))
+        self.assertEqual(["--- a\n", "+++ b\n"], hunks[0][:2])
+        self.assertEqual(
+            list(
+                patiencediff.unified_diff(a, b, "a", "b", sequencematcher=psm)
+            ),
+            [line for hunk in hunks for line in hunk],
+        )
+
+    def test_unified_diff_windowed(self) -> None:
+        a = [f"{i}\n" for i in range(200)]
+        b = list(a)
+        b[2] = "x\n"
+        b[150] = "y\n"
+        b[100:100] = ["new\n"] * 3
+        psm = self._PatienceSequenceMatcher
+        # Changes that fit in a window are found as in a full diff
+        self.assertEqual(
+            list(
+                patiencediff.unified_diff(a, b, "a", "b", sequencematcher=psm)
+            ),
+            list(
+                patiencediff.unified_diff_windowed(
+                    iter(a), iter(b), "a", "b", sequencematcher=psm, window=50
+                )
+            ),
+        )
+        # So are changes larger than the window, by looking further ahead
+        a = a[:100]
+        b = a[:10] + a[60:]
+        for x, y in ((a, b), (b, a)):
+            self.assertEqual(
+                list(patiencediff.unified_diff(x, y, sequencematcher=psm)),
+                list(
+                    patiencediff.unified_diff_windowed(
+                        iter(x), iter(y), sequencematcher=psm, window=8
+                    )
+                ),
+            )
+        # After a change too large to look past, the diff catches up
+        a = [f"{i}\n" for i in range(1000)]
+        b = a[:10] + [f"new {i}\n" for i in range(300)] + a[10:]
+        diff = list(
+            patiencediff.unified_diff_windowed(
+                iter(a), iter(b), sequencematcher=psm, window=8
+            )
+        )
+        added = [line for line in diff[2:] if line.startswith("+")]
+        removed = [line for line in diff[2:] if line.startswith("-")]
+        self.assertEqual(300, len(added) - len(removed))
+        self.assertEqual([" 262\n", " 263\n", " 264\n"], diff[-3:])
+        self.assertEqual(
+            [],
+            list(
+                patiencediff.unified_diff_windowed(
+                    iter(a), iter(a), sequencematcher=psm, window=8
+                )
+            ),
+        )
+        self.assertRaises(
+            ValueError,
+            list,
+            patiencediff.unified_diff_windowed(a, b, window=0),
+        )
+
+    def test_diff_stats(self) -> None:
+        psm = self._PatienceSequenceMatcher
+        self.assertEqual(
+            (2, 1),
+            patiencediff.diff_stats(
+                list("abcd"), list("aXbdY"), sequencematcher=psm
+            ),
+        )
+        self.assertEqual((0, 0), patiencediff.diff_stats([], []))
+
+    def test_histogram(self) -> None:
+        # No line is unique, and the first and last lines differ
+        a = list("xyxyzzww")
+        b = list("qqxyxyzzwwrr")
+        psm: Any = self._PatienceSequenceMatcher
+        self.assertEqual(
+            [("replace", 0, 8, 0, 12)], psm(None, a, b).get_opcodes()
+        )
+        self.assertEqual(
+            [
+                ("insert", 0, 0, 0, 2),
+                ("equal", 0, 8, 2, 10),
+                ("insert", 8, 8, 10, 12),
+            ],
+            psm(None, a, b, histogram=True).get_opcodes(),
+        )
+        answer: List[Tuple[int, int]] = []
+        self._recurse_matches(a, b, 0, 0, 8, 12, answer, 10, histogram=True)
+        self.assertEqual([(i, i + 2) for i in range(8)], answer)
+        # Lines that occur a different number of times are not anchors
+        self.assertEqual(
+            [
+                ("delete", 0, 2, 0, 0),
+                ("equal", 2, 4, 0, 2),
+                ("insert", 4, 4, 2, 5),
+            ],
+            psm(None, "xxyy", "yyxxx", histogram=True).get_opcodes(),
+        )
+
+    def test_cancel(self) -> None:
+        a = ["x\n", "a\n", "b\n", "c\n"]
+        b = ["a\n", "y\n", "b\n", "c\n"]
+        psm: Any = self._PatienceSequenceMatcher
+        token = self._CancellationToken()
+        sm = psm(None, a, b, cancel=token)
+        self.assertEqual(
+            [(1, 0, 1), (2, 2, 2), (4, 4, 0)], sm.get_matching_blocks()
+        )
+        self.assertFalse(sm.degraded)
+        # Once cancelled, nothing is matched but the result is still valid
+        token.cancel()
+        self.assertTrue(token.cancelled)
+        sm = psm(None, a, b, cancel=token)
+        self.assertEqual([("replace", 0, 4, 0, 4)], sm.get_opcodes())
+        self.assertTrue(sm.degraded)
+        sm = psm(None, a, b, timeout=0)
+        self.assertEqual([(4, 4, 0)], sm.get_matching_blocks())
+        self.assertTrue(sm.degraded)
+        sm = psm(None, a, b, timeout=60)
+        self.assertEqual(
+            [(1, 0, 1), (2, 2, 2), (4, 4, 0)], sm.get_matching_blocks()
+        )
+        self.assertFalse(sm.degraded)
+        self.assertRaises(ValueError, psm, None, a, b, timeout=-1)
+
+    def test_key(self) -> None:
+        a = ["x\n", "Hello  World\n", "y\r\n", "z\n"]
+        b = ["X\n", "hello world \n", "y\n", "q\n"]
+        psm: Any = self._PatienceSequenceMatcher
+        self.assertEqual(
+            [(4, 4, 0)], psm(None, a, b, key=None).get_matching_blocks()
+        )
+        key = patiencediff.LineKey(ignore_space_change=True, ignore_case=True)
+        sm = psm(None, a, b, key=key)
+        self.assertIs(key, sm.key)
+        self.assertEqual(
+            [("equal", 0, 3, 0, 3), ("replace", 3, 4, 3, 4)], sm.get_opcodes()
+        )
+        key = patiencediff.LineKey(ignore_all_space=True, ignore_eol=True)
+        self.assertEqual(
+            [(2, 2, 1), (4, 4, 0)],
+            psm(None, a, b, key=key).get_matching_blocks(),
+        )
+        # Bytes lines are normalized in the same way
+        key = patiencediff.LineKey(ignore_case=True, ignore_eol=True)
+        lines_a = self._split_lines(b"A\r\nb\nC\n")
+        lines_b = self._split_lines(b"a\nx\nc")
+        self.assertEqual(
+            [(0, 0, 1), (2, 2, 1), (3, 3, 0)],
+            psm(None, lines_a, lines_b, key=key).get_matching_blocks(),
+        )
+        self.assertRaises(
+            TypeError, lambda: psm(None, [1], [1], key=key).get_opcodes()
+        )
+        # Any callable can be used as a key
+        sm = psm(None, a, b, key=lambda line: line[:1].lower())
+        self.assertEqual([(0, 0, 3), (4, 4, 0)], sm.get_matching_blocks())
+        sm.set_seq2(["z\n", "x\n"])
+        self.assertEqual([(0, 1, 1), (4, 2, 0)], sm.get_matching_blocks())
+        sm.apply_edit_b(2, 2, ["W\n", "Z\n"])
+        self.assertEqual(
+            [(0, 1, 1), (3, 3, 1), (4, 4, 0)], sm.get_matching_blocks()
+        )
+
+    def test_unified_diff_key(self) -> None:
+        a = ["a\n", "B\n", "\n"] + [f"{i}\n" for i in range(8)]
+        b = ["a\n", "b\n"] + [f"{i}\n" for i in range(8)] + ["\n"]
+        key = patiencediff.LineKey(ignore_case=True)
+        psm = self._PatienceSequenceMatcher
+        self.assertEqual(
+            [
+                "--- \n",
+                "+++ \n",
+                "@@ -1,6 +1,5 @@\n",
+                " a\n",
+                " B\n",
+                "-\n",
+                " 0\n",
+                " 1\n",
+                " 2\n",
+                "@@ -9,3 +8,4 @@\n",
+                " 5\n",
+                " 6\n",
+                " 7\n",
+                "+\n",
+            ],
+            list(
+                patiencediff.unified_diff(a, b, sequencematcher=psm, key=key)
+            ),
+        )
+        # difflib is given the keys of the lines
+        self.assertEqual(
+            list(
+                patiencediff.unified_diff(a, b, sequencematcher=psm, key=key)
+            ),
+            list(patiencediff.unified_diff(a, b, key=key)),
+        )
+        self.assertEqual(
+            [],
+            list(
+                patiencediff.unified_diff(
+                    a, b, sequencematcher=psm, key=key, ignore_blank_lines=True
+                )
+            ),
+        )
+        self.assertEqual(
+            [
+                b"--- \n",
+                b"+++ \n",
+                b"@@ -1,4 +1,3 @@\n",
+                b" a\n",
+                b"-B\n",
+                b"-\n",
+                b"+b\n",
+                b" 0\n",
+            ],
+            list(
+                patiencediff.unified_diff_bytes(
+                    [line.encode() for line in a],
+                    [line.encode() for line in b],
+                    n=1,
+                    sequencematcher=psm,
+                    ignore_blank_lines=True,
+                )
+            ),
+        )
+
+    def test_refine_opcodes(self) -> None:
+        a = ["same\n", "x = foo(bar)\n", "gone\n"]
+        b = ["same\n", "x = baz(bar, 1)\n"]
+        opcodes = self._PatienceSequenceMatcher(None, a, b).get_opcodes()
+        self.assertEqual(
+            [(1, 1, [(4, 7)], [(4, 7), (11, 14)])],
+            self._refine_opcodes(a, b, opcodes),
+        )
+        self.assertEqual(
+            [(1, 1, [(4, 7)], [(4, 7), (11, 14)])],
+            self._refine_opcodes(
+                [line.encode() for line in a],
+                [line.encode() for line in b],
+                opcodes,
+            ),
+        )
+        self.assertEqual(
+            [(0, 0, [(1, 2)], [(1, 2)])],
+            self._refine_opcodes(
+                ["foo"], ["fxo"], [("replace", 0, 1, 0, 1)], mode="char"
+            ),
+        )
+        self.assertEqual([], self._refine_opcodes(a, b, opcodes, budget=10))
+        self.assertRaises(
+            ValueError, self._refine_opcodes, a, b, opcodes, mode="line"
+        )
+
+    def test_refine_opcodes_unicode(self) -> None:
+        # Words follow re's \w and \s, so both engines must agree on
+        # combining marks and the \x1c-\x1f separators, and offsets are
+        # counted in code points even around lone surrogates.
+        replace = [("replace", 0, 1, 0, 1)]
+        cases = [
+            ("word", "का x", "कि x", (1, 2), (1, 2)),
+            ("word", "ét", "és", (2, 3), (2, 3)),
+            ("word", "a\x1cb", "a\x1c\x1cc", (1, 3), (1, 4)),
+            ("word", "a\x1fb", "a\x1f\x1fc", (1, 3), (1, 4)),
+            ("word", "\ud800 ab", "\ud800 ac", (2, 4), (2, 4)),
+            ("char", "𐀀x", "𐀀y", (1, 2), (1, 2)),
+        ]
+        for mode, a, b, a_span, b_span in cases:
+            expected = [(0, 0, [a_span], [b_span])]
+            self.assertEqual(
+                expected,
+                _patiencediff_py.refine_opcodes_py(
+                    [a], [b], replace, mode=mode
+                ),
+            )
+            self.assertEqual(
+                expected, self._refine_opcodes([a], [b], replace, mode=mode)
+            )
+
+    def test_merge_regions(self) -> None:
+        base = list("abcdefg")
+        this = list("aXcdefgh")
+        other = list("abcdYfgh")
+        self.assertEqual(
+            [
+                ("unchanged", 0, 1, 0, 1, 0, 1),
+                ("this", 1, 2, 1, 2, 1, 2),
+                ("unchanged", 2, 4, 2, 4, 2, 4),
+                ("other", 4, 5, 4, 5, 4, 5),
+                ("unchanged", 5, 7, 5, 7, 5, 7),
+                ("same", 7, 7, 7, 8, 7, 8),
+            ],
+            self._merge_regions(base, this, other),
+        )
+        self.assertEqual(
+            [
+                ("unchanged", 0, 1, 0, 1, 0, 1),
+                ("conflict", 1, 2, 1, 2, 1, 2),
+                ("unchanged", 2, 3, 2, 3, 2, 3),
+            ],
+            self._merge_regions(list("abc"), list("aXc"), list("aYc")),
+        )
+        self.assertEqual([], self._merge_regions([], [], []))
+
+    def test_stats(self) -> None:
+        a = ["x\n", "a\n", "b\n", "a\n", "c\n", "d\n"]
+        b = ["y\n", "a\n", "b\n", "a\n", "e\n", "d\n"]
+        s: Any = self._PatienceSequenceMatcher(None, a, b)
+        s.get_opcodes()
+        self.assertIsNone(s.stats)
+
+        factory: Any = self._PatienceSequenceMatcher
+        s = factory(None, a, b, collect_stats=True)
+        self.assertIsNone(s.stats)
+        s.get_opcodes()
+        stats = s.stats
+        self.assertIsInstance(stats, patiencediff.DiffStats)
+        self.assertEqual((6, 6), (stats.lines_a, stats.lines_b))
+        # b and d are unique on both sides
+        self.assertEqual(2, stats.unique_lines)
+        self.assertAlmostEqual(1 / 3, stats.unique_fraction)
+        self.assertEqual(10, stats.max_recursion)
+        # Both gaps around b are anchored on a, leaving a single line
+        # mismatch one level further down
+        self.assertEqual(2, stats.max_depth)
+        self.assertEqual(5, stats.unique_lcs_calls)
+        self.assertGreater(stats.allocated_bytes, 0)
+        # Both engines time turning the lines into tokens
+        self.assertGreater(stats.tokenize_seconds, 0)
+        for name in ("unique_lcs", "recursion", "conversion"):
+            self.assertGreaterEqual(stats.as_dict()[name + "_seconds"], 0)
+
+        reported: List[Any] = []
+        previous = patiencediff.set_stats_hook(reported.append)
+        try:
+            s = self._PatienceSequenceMatcher(None, a, b)
+            s.get_opcodes()
+            s.get_opcodes()
+        finally:
+            patiencediff.set_stats_hook(previous)
+        self.assertEqual([s.stats], reported)
+
     def test_grouped_opcodes(self) -> None:
         def chk_ops(
             a: Sequence[Any],
@@ -330,8 +866,9 @@ class TestPatienceDiffLib(unittest.TestCase):
             expected_codes: List[Any],
             n: int = 3,
         ) -> None:
-            s = self._PatienceSequenceMatcher(None, a, b)
+            s: Any = self._PatienceSequenceMatcher(None, a, b)
             self.assertEqual(expected_codes, list(s.get_grouped_opcodes(n)))
+            self.assertEqual(expected_codes, list(s.iter_grouped_opcodes(n)))
 
         chk_ops("", "", [])
         chk_ops([], [], [])
@@ -386,6 +923,23 @@ class TestPatienceDiffLib(unittest.TestCase):
             [[("equal", 3, 6, 3, 6), ("insert", 6, 6, 6, 7)]],
         )
 
+    def test_iter_opcodes(self) -> None:
+        a = [f"line {i}\n" for i in range(100)]
+        b = [line for i, line in enumerate(a) if i % 10]
+        s: Any = self._PatienceSequenceMatcher(None, a, b)
+        self.assertEqual(s.get_opcodes(), list(s.iter_opcodes()))
+        opcodes = s.iter_opcodes()
+        self.assertEqual(("delete", 0, 1, 0, 0), next(opcodes))
+        self.assertEqual(("equal", 1, 10, 0, 9), next(opcodes))
+        groups = s.iter_grouped_opcodes(1)
+        self.assertEqual(
+            [("delete", 0, 1, 0, 0), ("equal", 1, 2, 0, 1)], next(groups)
+        )
+        self.assertEqual(9, len(list(groups)))
+        s = self._PatienceSequenceMatcher(None, a, a)
+        self.assertEqual([("equal", 0, 100, 0, 100)], list(s.iter_opcodes()))
+        self.assertEqual([], list(s.iter_grouped_opcodes()))
+
     def test_multiple_ranges(self) -> None:
         # There was an earlier bug where we used a bad set of ranges,
         # this triggers that specific bug, to make sure it doesn't regress
@@ -510,6 +1064,57 @@ pynff pzq_zxqve(Pbzznaq):
             list(unified_diff(txt_a, txt_b, sequencematcher=psm)),
         )
 
+    def test_render_unified(self) -> None:
+        psm = self._PatienceSequenceMatcher
+        cases = [
+            ([], []),
+            (["a\n"], ["a\n"]),
+            (["hello there\n", "world\n", "how are you today?\n"], []),
+            ([x + "\n" for x in "abcdefghijklmnop"], []),
+            (
+                [x + "\n" for x in "abcdefghijklmnop"],
+                [x + "\n" for x in "abcdefxydefghijklmnop"],
+            ),
+            (["\N{SNOWMAN}\n", "b"], ["a\n", "\N{SNOWMAN}\n", "c"]),
+        ]
+        for a, b in cases:
+            self.assertEqual(
+                "".join(patiencediff.unified_diff(a, b, sequencematcher=psm)),
+                self._render_unified(a, b),
+            )
+            self.assertEqual(
+                "".join(
+                    patiencediff.unified_diff(
+                        a, b, "a", "b", "d1", 1.5, 1, "", sequencematcher=psm
+                    )
+                ),
+                self._render_unified(a, b, "a", "b", "d1", 1.5, 1, ""),
+            )
+            a_bytes = [line.encode("utf-8") for line in a]
+            b_bytes = [line.encode("utf-8") for line in b]
+            self.assertEqual(
+                b"".join(
+                    patiencediff.unified_diff_bytes(
+                        a_bytes, b_bytes, b"a", b"b", sequencematcher=psm
+                    )
+                ),
+                self._render_unified(
+                    a_bytes, b_bytes, b"a", b"b", lineterm=b"\n"
+                ),
+            )
+            self.assertEqual(
+                b"".join(
+                    patiencediff.unified_diff_bytes(
+                        a_bytes, b_bytes, sequencematcher=psm
+                    )
+                ),
+                self._render_unified(
+                    self._split_lines(b"".join(a_bytes)),
+                    self._split_lines(b"".join(b_bytes)),
+                    lineterm=b"\n",
+                ),
+            )
+
     def test_patience_unified_diff_with_dates(self) -> None:
         txt_a = ["hello there\n", "world\n", "how are you today?\n"]
         txt_b = ["hello there\n", "how are you today?\n"]
@@ -628,21 +1233,810 @@ class TestPatienceDiffLibFiles(unittest.TestCase):
         finally:
             os.chdir(old_pwd)
 
+    def test_patience_unified_diff_files_identical(self) -> None:
+        # The contents are compared without decoding them
+        for name in ("a1", "b1"):
+            with open(os.path.join(self.test_dir, name), "wb") as f:
+                f.write(b"same\xff\n")
+        self.assertEqual(
+            [],
+            patiencediff.unified_diff_files(
+                os.path.join(self.test_dir, "a1"),
+                os.path.join(self.test_dir, "b1"),
+                sequencematcher=self._PatienceSequenceMatcher,
+            ),
+        )
+
+    def test_unified_diff_files_window(self) -> None:
+        a = os.path.join(self.test_dir, "a1")
+        b = os.path.join(self.test_dir, "b1")
+        with open(a, "w") as f:
+            f.writelines(f"{i}\n" for i in range(100))
+        with open(b, "w") as f:
+            f.writelines(f"{i}\n" for i in range(100) if i % 30)
+        psm = self._PatienceSequenceMatcher
+        self.assertEqual(
+            patiencediff.unified_diff_files(a, b, sequencematcher=psm),
+            patiencediff.unified_diff_files(
+                a, b, sequencematcher=psm, window=20
+            ),
+        )
+
+    def test_unified_diff_files_key(self) -> None:
+        path_a = os.path.join(self.test_dir, "a")
+        path_b = os.path.join(self.test_dir, "b")
+        lines = [f"line {i}\n" for i in range(20)]
+        with open(path_a, "w") as f:
+            f.writelines(lines[:10] + ["Hello\n", "\n"] + lines[10:])
+        with open(path_b, "w") as f:
+            f.writelines(lines[:10] + ["hello  \n"] + lines[10:])
+        key = patiencediff.LineKey(ignore_space_change=True, ignore_case=True)
+        psm = self._PatienceSequenceMatcher
+        expected = [
+            f"--- {path_a}\n",
+            f"+++ {path_b}\n",
+            "@@ -9,7 +9,6 @@\n",
+            " line 8\n",
+            " line 9\n",
+            " Hello\n",
+            "-\n",
+            " line 10\n",
+            " line 11\n",
+            " line 12\n",
+        ]
+        self.assertEqual(
+            expected,
+            patiencediff.unified_diff_files(
+                path_a, path_b, sequencematcher=psm, key=key
+            ),
+        )
+        self.assertEqual(
+            expected,
+            patiencediff.unified_diff_files(
+                path_a, path_b, sequencematcher=psm, key=key, window=20
+            ),
+        )
+        self.assertEqual(
+            [line.encode() for line in expected],
+            patiencediff.unified_diff_files_bytes(
+                path_a, path_b, sequencematcher=psm, key=key
+            ),
+        )
+        self.assertEqual(
+            [],
+            patiencediff.unified_diff_files(
+                path_a,
+                path_b,
+                sequencematcher=psm,
+                key=key,
+                ignore_blank_lines=True,
+            ),
+        )
+
+    def test_aunified_diff_files(self) -> None:
+        a = os.path.join(self.test_dir, "a1")
+        b = os.path.join(self.test_dir, "b1")
+        with open(a, "w") as f:
+            f.writelines(["hello\n", "world\n"])
+        with open(b, "w") as f:
+            f.writelines(["hello\n", "there\n"])
+        psm = self._PatienceSequenceMatcher
+        self.assertEqual(
+            patiencediff.unified_diff_files(a, b, sequencematcher=psm),
+            asyncio.run(
+                patiencediff.aunified_diff_files(a, b, sequencematcher=psm)
+            ),
+        )
+        self.assertEqual(
+            patiencediff.unified_diff_files_bytes(a, b, sequencematcher=psm),
+            asyncio.run(
+                patiencediff.aunified_diff_files_bytes(
+                    a, b, sequencematcher=psm
+                )
+            ),
+        )
+
+    def test_main_jobs_spawn(self) -> None:
+        """The CLI can diff trees with -j 2 when workers are spawned."""
+        for name in ("a/changed", "b/changed"):
+            path = os.path.join(self.test_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(f"one\n{name}\n")
+        # Like the console script: spawned workers run it again, as
+        # __mp_main__, which imports patiencediff.__main__
+        script = os.path.join(self.test_dir, "patiencediff-script.py")
+        with open(script, "w") as f:
+            f.write(
+                "import multiprocessing, sys\n"
+                "multiprocessing.set_start_method('spawn', force=True)\n"
+                "from patiencediff.__main__ import main\n"
+                "if __name__ == '__main__':\n"
+                "    sys.exit(main())\n"
+            )
+        result = subprocess.run(
+            [sys.executable, script, "-r", "-j", "2", "a", "b"],
+            cwd=self.test_dir,
+            env={
+                **os.environ,
+                "PYTHONPATH": os.path.dirname(
+                    os.path.dirname(os.path.abspath(patiencediff.__file__))
+                ),
+            },
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual("", result.stderr)
+        old_pwd = os.getcwd()
+        os.chdir(self.test_dir)
+        try:
+            expected = patiencediff.unified_diff_files(
+                os.path.join("a", "changed"), os.path.join("b", "changed")
+            )
+        finally:
+            os.chdir(old_pwd)
+        self.assertEqual("".join(expected), result.stdout)
+
+    def test_unified_diff_dirs(self) -> None:
+        files = {
+            "a/same": "same\n",
+            "b/same": "same\n",
+            "a/sub/changed": "one\ntwo\n",
+            "b/sub/changed": "one\n2\n",
+            "a/only": "gone\n",
+        }
+        for name, text in files.items():
+            path = os.path.join(self.test_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(text)
+        a = os.path.join(self.test_dir, "a")
+        b = os.path.join(self.test_dir, "b")
+        psm = self._PatienceSequenceMatcher
+        expected = [
+            [f"Only in {a}: only\n"],
+            patiencediff.unified_diff_files(
+                os.path.join(a, "sub", "changed"),
+                os.path.join(b, "sub", "changed"),
+                sequencematcher=psm,
+            ),
+        ]
+        for jobs in (1, 2):
+            self.assertEqual(
+                expected,
+                [
+                    lines
+                    for lines in patiencediff.unified_diff_dirs(
+                        a, b, jobs=jobs, sequencematcher=psm
+                    )
+                    if lines
+                ],
+            )
+        self.assertEqual(
+            [[line.encode() for line in lines] for lines in expected],
+            [
+                lines
+                for lines in patiencediff.unified_diff_dirs_bytes(
+                    a, b, jobs=1, sequencematcher=psm
+                )
+                if lines
+            ],
+        )
+
+    def test_diff_stats_files(self) -> None:
+        a = os.path.join(self.test_dir, "a")
+        b = os.path.join(self.test_dir, "b")
+        with open(a, "w") as f:
+            f.writelines(f"{i}\n" for i in range(100))
+        with open(b, "w") as f:
+            f.writelines(f"{i}\n" for i in range(100) if i % 10)
+            f.write("end")
+        psm = self._PatienceSequenceMatcher
+        self.assertEqual(
+            (1, 10), patiencediff.diff_stats_files(a, b, sequencematcher=psm)
+        )
+        self.assertEqual(
+            (0, 0), patiencediff.diff_stats_files(a, a, sequencematcher=psm)
+        )
+        # The common lines change which lines are matched, so they count
+        lines_a = ["2\n", "0\n", "1\n", "0\n", "5\n", "3\n"]
+        lines_b = ["2\n", "0\n", "0\n", "5\n", "1\n", "3\n"]
+        with open(a, "w") as f:
+            f.writelines(lines_a)
+        with open(b, "w") as f:
+            f.writelines(lines_b)
+        self.assertEqual(
+            patiencediff.diff_stats(lines_a, lines_b, psm),
+            patiencediff.diff_stats_files(a, b, sequencematcher=psm),
+        )
+
+    def test_diff_stats_dirs(self) -> None:
+        files = {
+            "a/same": "same\n",
+            "b/same": "same\n",
+            "a/sub/changed": "one\ntwo\n",
+            "b/sub/changed": "one\n2\n",
+            "b/new/file": "x\ny\n",
+        }
+        for name, text in files.items():
+            path = os.path.join(self.test_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(text)
+        a = os.path.join(self.test_dir, "a")
+        b = os.path.join(self.test_dir, "b")
+        expected = [
+            ("", os.path.join(b, "new", "file"), 2, 0),
+            (
+                os.path.join(a, "sub", "changed"),
+                os.path.join(b, "sub", "changed"),
+                1,
+                1,
+            ),
+        ]
+        for jobs in (1, 2):
+            self.assertEqual(
+                expected,
+                list(
+                    patiencediff.diff_stats_dirs(
+                        a,
+                        b,
+                        jobs=jobs,
+                        sequencematcher=self._PatienceSequenceMatcher,
+                    )
+                ),
+            )
+
+    def test_dirs_key(self) -> None:
+        for name, text in {
+            "a/sub/changed": "Hello\n\nworld\n",
+            "b/sub/changed": "hello\nworld\n",
+        }.items():
+            path = os.path.join(self.test_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(text)
+        a = os.path.join(self.test_dir, "a")
+        b = os.path.join(self.test_dir, "b")
+        path_a = os.path.join(a, "sub", "changed")
+        path_b = os.path.join(b, "sub", "changed")
+        psm = self._PatienceSequenceMatcher
+        key = patiencediff.LineKey(ignore_case=True)
+        self.assertEqual(
+            (1, 2), patiencediff.diff_stats_files(path_a, path_b, psm)
+        )
+        self.assertEqual(
+            (0, 1), patiencediff.diff_stats_files(path_a, path_b, psm, key)
+        )
+        self.assertEqual(
+            (0, 0),
+            patiencediff.diff_stats_files(
+                path_a, path_b, psm, key, ignore_blank_lines=True
+            ),
+        )
+        for jobs in (1, 2):
+            self.assertEqual(
+                [],
+                [
+                    lines
+                    for lines in patiencediff.unified_diff_dirs(
+                        a,
+                        b,
+                        jobs=jobs,
+                        sequencematcher=psm,
+                        key=key,
+                        ignore_blank_lines=True,
+                    )
+                    if lines
+                ],
+            )
+            self.assertEqual(
+                [(path_a, path_b, 0, 1)],
+                list(
+                    patiencediff.diff_stats_dirs(
+                        a, b, jobs=jobs, sequencematcher=psm, key=key
+                    )
+                ),
+            )
+        self.assertEqual(
+            [],
+            [
+                lines
+                for lines in patiencediff.unified_diff_dirs_bytes(
+                    a,
+                    b,
+                    jobs=1,
+                    sequencematcher=psm,
+                    key=key,
+                    ignore_blank_lines=True,
+                )
+                if lines
+            ],
+        )
+
+        from .__main__ import main
+
+        for args in (
+            ["-r", a, b],
+            ["--numstat", path_a, path_b],
+            ["--numstat", "-r", a, b],
+        ):
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                self.assertEqual(0, main(["-i", "-B", *args]))
+            self.assertEqual("", out.getvalue())
+
+    def test_patience_unified_diff_files_common_lines(self) -> None:
+        header = [f"header {i}\n" for i in range(1000)]
+        trailer = [f"trailer {i}\n" for i in range(1000)]
+        txt_a = header + ["a\n", "b\n", "c\n"] + trailer + ["end"]
+        txt_b = header + ["a\n", "X\n", "c\n", "d\n"] + trailer + ["end"]
+        with open(os.path.join(self.test_dir, "a1"), "w") as f:
+            f.writelines(txt_a)
+        with open(os.path.join(self.test_dir, "b1"), "w") as f:
+            f.writelines(txt_b)
+
+        old_pwd = os.getcwd()
+        os.chdir(self.test_dir)
+        try:
+            self.assertEqual(
+                [
+                    "--- a1\n",
+                    "+++ b1\n",
+                    "@@ -999,8 +999,9 @@\n",
+                    " header 998\n",
+                    " header 999\n",
+                    " a\n",
+                    "-b\n",
+                    "+X\n",
+                    " c\n",
+                    "+d\n",
+                    " trailer 0\n",
+                    " trailer 1\n",
+                    " trailer 2\n",
+                ],
+                patiencediff.unified_diff_files(
+                    "a1", "b1", sequencematcher=self._PatienceSequenceMatcher
+                ),
+            )
+        finally:
+            os.chdir(old_pwd)
+
+    def test_unified_diff_files_matches_unified_diff(self) -> None:
+        path_a = os.path.join(self.test_dir, "a")
+        path_b = os.path.join(self.test_dir, "b")
+        psm = self._PatienceSequenceMatcher
+        a = "0 5 15 6 12 10 13 13 19 17 19 8 0 9 9".split()
+        b = a[:6] + ["14"] + a[6:-1]
+        cases = [(a, b)]
+        rng = random.Random(6)
+        for _ in range(300):
+            a = [str(rng.randint(0, 20)) for _ in range(rng.randint(0, 20))]
+            b = list(a)
+            for _ in range(rng.randint(1, 3)):
+                if b and rng.random() < 0.5:
+                    del b[rng.randrange(len(b))]
+                else:
+                    b.insert(rng.randint(0, len(b)), str(rng.randint(0, 20)))
+            cases.append((a, b))
+        for a, b in cases:
+            lines_a = [f"{line}\n" for line in a]
+            lines_b = [f"{line}\n" for line in b]
+            with open(path_a, "w") as f:
+                f.writelines(lines_a)
+            with open(path_b, "w") as f:
+                f.writelines(lines_b)
+            self.assertEqual(
+                list(
+                    patiencediff.unified_diff(
+                        lines_a,
+                        lines_b,
+                        fromfile=path_a,
+                        tofile=path_b,
+                        sequencematcher=psm,
+                    )
+                ),
+                patiencediff.unified_diff_files(
+                    path_a, path_b, sequencematcher=psm
+                ),
+            )
+
+    def test_patience_unified_diff_files_bytes(self) -> None:
+        with open(os.path.join(self.test_dir, "a1"), "wb") as f:
+            f.write(b"hello there\nworld\nhow are you today?\xff\n")
+        with open(os.path.join(self.test_dir, "b1"), "wb") as f:
+            f.write(b"hello there\nhow are you today?\xff\n")
+        with open(os.path.join(self.test_dir, "empty"), "wb") as f:
+            pass
+
+        unified_diff_files_bytes = patiencediff.unified_diff_files_bytes
+        psm = self._PatienceSequenceMatcher
+
+        old_pwd = os.getcwd()
+        os.chdir(self.test_dir)
+        try:
+            self.assertEqual(
+                [
+                    b"--- a1\n",
+                    b"+++ b1\n",
+                    b"@@ -1,3 +1,2 @@\n",
+                    b" hello there\n",
+                    b"-world\n",
+                    b" how are you today?\xff\n",
+                ],
+                unified_diff_files_bytes("a1", "b1", sequencematcher=psm),
+            )
+            self.assertEqual(
+                [
+                    b"--- empty\n",
+                    b"+++ b1\n",
+                    b"@@ -1,0 +1,2 @@\n",
+                    b"+hello there\n",
+                    b"+how are you today?\xff\n",
+                ],
+                unified_diff_files_bytes("empty", "b1", sequencematcher=psm),
+            )
+        finally:
+            os.chdir(old_pwd)
+
+
+class TestDiffCache(unittest.TestCase):
+    a = ["hello\n", "there\n", "world\n"]
+    b = ["hello\n", "world\n", "again\n"]
+
+    def test_hits_and_misses(self) -> None:
+        cache = patiencediff.DiffCache()
+        expected = patiencediff.PatienceSequenceMatcher(
+            None, self.a, self.b
+        ).get_opcodes()
+        self.assertEqual(expected, cache.get_opcodes(self.a, self.b))
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+        self.assertEqual(expected, cache.get_opcodes(list(self.a), self.b))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        # Joining lines gives different contents
+        cache.get_opcodes(["hello\nthere\n", "world\n"], self.b)
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+        self.assertRaises(TypeError, cache.get_opcodes, [1], [2])
+
+    def test_unified_diff(self) -> None:
+        cache = patiencediff.DiffCache()
+        expected = list(
+            patiencediff.unified_diff(
+                self.a,
+                self.b,
+                sequencematcher=patiencediff.PatienceSequenceMatcher,
+            )
+        )
+        for _ in range(2):
+            self.assertEqual(
+                expected,
+                list(
+                    patiencediff.unified_diff(
+                        self.a, self.b, sequencematcher=cache.sequencematcher
+                    )
+                ),
+            )
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        matcher = cache.sequencematcher(None, self.a, self.b)
+        self.assertEqual(
+            patiencediff.PatienceSequenceMatcher(
+                None, self.a, self.b
+            ).get_matching_blocks(),
+            matcher.get_matching_blocks(),
+        )
+
+    def test_eviction(self) -> None:
+        cache = patiencediff.DiffCache(max_entries=2)
+        for i in range(3):
+            cache.get_opcodes(self.a, [str(i)])
+        self.assertEqual(2, len(cache))
+        cache.get_opcodes(self.a, ["2"])
+        cache.get_opcodes(self.a, ["0"])
+        self.assertEqual((1, 4), (cache.hits, cache.misses))
+
+        # "equal", "delete", "insert" and "equal" opcodes, 40 bytes each
+        cache = patiencediff.DiffCache(max_entries=None, max_bytes=200)
+        cache.get_opcodes(self.a, self.b)
+        self.assertEqual(160, cache.nbytes)
+        cache.get_opcodes(self.b, self.a)
+        self.assertEqual(1, len(cache))
+        self.assertLessEqual(cache.nbytes, 200)
+
+    def test_disk(self) -> None:
+        path = os.path.join(tempfile.mkdtemp(), "cache.sqlite")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with patiencediff.DiffCache(path=path) as cache:
+            expected = cache.get_opcodes(self.a, self.b)
+        with patiencediff.DiffCache(path=path) as cache:
+            self.assertEqual(expected, cache.get_opcodes(self.a, self.b))
+            self.assertEqual(expected, cache.get_opcodes(self.a, self.b))
+            self.assertEqual(
+                (1, 1, 0), (cache.hits, cache.disk_hits, cache.misses)
+            )
+            cache.clear()
+            cache.get_opcodes(self.a, self.b)
+            self.assertEqual(1, cache.misses)
+
+    def test_key(self) -> None:
+        cache = patiencediff.DiffCache()
+        key = patiencediff.LineKey(ignore_case=True)
+        a = ["Hello\n", "there\n", "World\n"]
+        expected = list(
+            patiencediff.unified_diff(
+                a,
+                self.b,
+                sequencematcher=patiencediff.PatienceSequenceMatcher,
+                key=key,
+            )
+        )
+        for _ in range(2):
+            self.assertEqual(
+                expected,
+                list(
+                    patiencediff.unified_diff(
+                        a,
+                        self.b,
+                        sequencematcher=cache.sequencematcher,
+                        key=key,
+                    )
+                ),
+            )
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        # Keyed and plain diffs of the same lines are kept apart
+        self.assertNotEqual(
+            cache.get_opcodes(a, self.b, key), cache.get_opcodes(a, self.b)
+        )
+        self.assertEqual((2, 2), (cache.hits, cache.misses))
+
+    def test_sequencematcher_options(self) -> None:
+        PatienceSequenceMatcher_py = (
+            _patiencediff_py.PatienceSequenceMatcher_py
+        )
+        histogram = patiencediff.DiffCache(
+            sequencematcher=functools.partial(
+                PatienceSequenceMatcher_py, histogram=True, collect_stats=True
+            )
+        )
+        plain = patiencediff.DiffCache(
+            sequencematcher=PatienceSequenceMatcher_py
+        )
+        self.assertNotEqual(
+            histogram.key(self.a, self.b), plain.key(self.a, self.b)
+        )
+        self.assertEqual(
+            histogram.key(self.a, self.b),
+            patiencediff.DiffCache(
+                sequencematcher=functools.partial(
+                    PatienceSequenceMatcher_py, histogram=True
+                )
+            ).key(self.a, self.b),
+        )
+        a = ["x\n", "y\n", "x\n", "z\n"]
+        b = ["x\n", "z\n", "x\n", "y\n"]
+        self.assertEqual(
+            PatienceSequenceMatcher_py(
+                None, a, b, histogram=True
+            ).get_opcodes(),
+            histogram.get_opcodes(a, b),
+        )
+        keyed = patiencediff.DiffCache(
+            sequencematcher=functools.partial(
+                PatienceSequenceMatcher_py,
+                key=patiencediff.LineKey(ignore_case=True),
+            )
+        )
+        self.assertEqual(
+            [("equal", 0, 3, 0, 3)],
+            keyed.get_opcodes(self.a, ["HELLO\n", "There\n", "world\n"]),
+        )
+
+    def test_degraded(self) -> None:
+        token = _patiencediff_py.CancellationToken_py()
+        token.cancel()
+        cache = patiencediff.DiffCache(
+            sequencematcher=functools.partial(
+                _patiencediff_py.PatienceSequenceMatcher_py, cancel=token
+            )
+        )
+        cache.get_opcodes(self.a, self.b)
+        self.assertEqual(0, len(cache))
+
+
+class TestMerge3(unittest.TestCase):
+    base = ["a\n", "b\n", "c\n"]
+
+    def test_clean(self) -> None:
+        m = patiencediff.Merge3(
+            self.base, ["a\n", "B\n", "c\n"], ["a\n", "b\n", "c\n", "d\n"]
+        )
+        self.assertFalse(m.has_conflicts())
+        self.assertEqual(["a\n", "B\n", "c\n", "d\n"], list(m.merge_lines()))
+
+    def test_conflict(self) -> None:
+        m = patiencediff.Merge3(
+            self.base, ["a\n", "X\n", "c\n"], ["a\n", "Y\n", "c\n"]
+        )
+        self.assertTrue(m.has_conflicts())
+        self.assertEqual(
+            [
+                "a\n",
+                "<<<<<<< mine\n",
+                "X\n",
+                "||||||| base\n",
+                "b\n",
+                "=======\n",
+                "Y\n",
+                ">>>>>>> theirs\n",
+                "c\n",
+            ],
+            list(
+                m.merge_lines(
+                    name_this="mine",
+                    name_other="theirs",
+                    name_base="base",
+                    base_marker="|||||||",
+                )
+            ),
+        )
+
+    def test_bytes(self) -> None:
+        m = patiencediff.Merge3(
+            [b"a\r\n", b"b\r\n"], [b"a\r\n", b"X\r\n"], [b"a\r\n", b"Y\r\n"]
+        )
+        self.assertEqual(
+            [
+                b"a\r\n",
+                b"<<<<<<< mine\r\n",
+                b"X\r\n",
+                b"=======\r\n",
+                b"Y\r\n",
+                b">>>>>>>\r\n",
+            ],
+            list(m.merge_lines(name_this=b"mine")),
+        )
+
+    def test_sequencematcher(self) -> None:
+        m = patiencediff.Merge3(
+            self.base,
+            ["a\n", "B\n", "c\n"],
+            self.base,
+            sequencematcher=difflib.SequenceMatcher,
+        )
+        self.assertEqual(["a\n", "B\n", "c\n"], list(m.merge_lines()))
+
+
+class TestLineIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "base")
+        self.index_path = self.path + ".idx"
+        with open(self.path, "wb") as f:
+            f.write(b"a\nb\na\nc\n")
+
+    def test_build(self) -> None:
+        index = patiencediff.LineIndex.from_file(self.path)
+        self.assertEqual([0, 1, 0, 2], list(index.tokens))
+        self.assertEqual(
+            [1, 3, 0, 3], list(index.tokenize(["b\n", "x\n", "a\n", "y"]))
+        )
+
+    def test_save_and_load(self) -> None:
+        index = patiencediff.LineIndex.from_file(self.path)
+        index.save(self.index_path)
+        loaded = patiencediff.LineIndex.load(self.index_path)
+        self.assertIsInstance(loaded.tokens, memoryview)
+        self.assertEqual(list(index.tokens), list(loaded.tokens))
+        self.assertEqual(index.digest, loaded.digest)
+        self.assertEqual(index.tokenize(["c\n"]), loaded.tokenize(["c\n"]))
+
+        with open(self.index_path, "wb") as f:
+            f.write(b"garbage")
+        self.assertRaises(
+            ValueError, patiencediff.LineIndex.load, self.index_path
+        )
+
+    def test_unified_diff(self) -> None:
+        index = patiencediff.LineIndex.for_file(self.path, self.index_path)
+        a = [b"a\n", b"b\n", b"a\n", b"c\n"]
+        b = [b"a\n", b"c\n", b"b\n", b"d\n"]
+        self.assertEqual(
+            list(
+                patiencediff.unified_diff_bytes(
+                    a, b, sequencematcher=patiencediff.PatienceSequenceMatcher
+                )
+            ),
+            list(
+                patiencediff.unified_diff_bytes(
+                    a, b, sequencematcher=index.sequencematcher
+                )
+            ),
+        )
+        self.assertRaises(ValueError, index.sequencematcher, None, a[1:], b)
+
+    def test_key(self) -> None:
+        index = patiencediff.LineIndex.for_file(self.path, self.index_path)
+        a = [b"a\n", b"b\n", b"a\n", b"c\n"]
+        b = [b"A\n", b"c\n", b"B\n", b"d\n"]
+        key = patiencediff.LineKey(ignore_case=True)
+        self.assertEqual(
+            list(
+                patiencediff.unified_diff_bytes(
+                    a,
+                    b,
+                    sequencematcher=patiencediff.PatienceSequenceMatcher,
+                    key=key,
+                )
+            ),
+            list(
+                patiencediff.unified_diff_bytes(
+                    a, b, sequencematcher=index.sequencematcher, key=key
+                )
+            ),
+        )
+
+    def test_staleness(self) -> None:
+        index = patiencediff.LineIndex.for_file(self.path, self.index_path)
+        self.assertFalse(index.is_stale(self.path))
+        # Touching the file does not change its contents, and checking
+        # does not change the index
+        mtime_ns = index.mtime_ns
+        os.utime(self.path, ns=(0, 0))
+        self.assertFalse(index.is_stale(self.path))
+        self.assertEqual(mtime_ns, index.mtime_ns)
+        # The new modification time is saved, so the file is not hashed
+        # again on the next load
+        os.utime(self.path, ns=(10**9, 10**9))
+        index = patiencediff.LineIndex.for_file(self.path, self.index_path)
+        self.assertEqual(
+            10**9, patiencediff.LineIndex.load(self.index_path).mtime_ns
+        )
+        os.utime(self.path, ns=(0, 0))
+        with open(self.path, "wb") as f:
+            f.write(b"a\nb\na\nd\n")
+        os.utime(self.path, ns=(0, 0))
+        self.assertTrue(index.is_stale(self.path))
+        index = patiencediff.LineIndex.for_file(self.path, self.index_path)
+        self.assertEqual([0, 1, 0, 2], list(index.tokens))
+        self.assertEqual(list(index.tokenize([b"d\n"])), [2])
+        self.assertFalse(
+            patiencediff.LineIndex.load(self.index_path).is_stale(self.path)
+        )
+
+
+def _import_rs(test: unittest.TestCase) -> types.ModuleType:
+    """Import the Rust extension, skipping the test if it was not built.
+
+    The extension is optional, so a failed build only leaves these tests
+    skipped; set PATIENCEDIFF_REQUIRE_RS=1 to make them fail instead.
+    """
+    try:
+        from . import _patiencediff_rs
+    except ImportError:
+        if os.environ.get("PATIENCEDIFF_REQUIRE_RS", "0") == "1":
+            raise
+        test.skipTest("Rust extension not built")
+    return _patiencediff_rs
+
 
 class TestPatienceDiffLib_rs(TestPatienceDiffLib):
     """Test class for the Rust implementation using PyO3 bindings."""
 
     def setUp(self) -> None:
         super(TestPatienceDiffLib, self).setUp()
-        try:
-            from . import _patiencediff_rs
-        except ImportError:
-            self.skipTest("Rust extension not built")
+        _patiencediff_rs = _import_rs(self)
         self._unique_lcs = _patiencediff_rs.unique_lcs_rs
         self._recurse_matches = _patiencediff_rs.recurse_matches_rs
         self._PatienceSequenceMatcher = (
             _patiencediff_rs.PatienceSequenceMatcher_rs
         )
+        self._diff_many = _patiencediff_rs.diff_many_rs
+        self._split_lines = _patiencediff_rs.split_lines_rs
+        self._render_unified = _patiencediff_rs.render_unified_rs
+        self._merge_regions = _patiencediff_rs.merge_regions_rs
+        self._refine_opcodes = _patiencediff_rs.refine_opcodes_rs
+        self._CancellationToken = _patiencediff_rs.CancellationToken_rs
 
     def test_unhashable(self) -> None:
         """We should get a proper exception here."""
@@ -665,16 +2059,51 @@ class TestPatienceDiffLib_rs(TestPatienceDiffLib):
             ["valid", []],
         )
 
+    def test_threaded(self) -> None:
+        """Matchers running in several threads give the serial results."""
+        pairs = [
+            (
+                [f"line {i}\n" for i in range(2000)],
+                [f"line {i}\n" for i in range(2000) if i % (k + 2)],
+            )
+            for k in range(8)
+        ]
+        expected = [
+            self._PatienceSequenceMatcher(None, a, b).get_opcodes()
+            for a, b in pairs
+        ]
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            results = list(
+                executor.map(
+                    lambda pair: self._PatienceSequenceMatcher(
+                        None, *pair
+                    ).get_opcodes(),
+                    pairs,
+                )
+            )
+        self.assertEqual(expected, results)
+
+    def test_large_gaps(self) -> None:
+        """Gaps matched in parallel give the same blocks as Python."""
+        from ._patiencediff_py import PatienceSequenceMatcher_py
+
+        a = [f"line {i}\n" for i in range(30000)]
+        b = list(a)
+        for i in range(100, 30000, 997):
+            b[i] = "changed\n"
+            b.insert(i + 7, f"extra {i}\n")
+        self.assertEqual(
+            PatienceSequenceMatcher_py(None, a, b).get_matching_blocks(),
+            self._PatienceSequenceMatcher(None, a, b).get_matching_blocks(),
+        )
+
 
 class TestPatienceDiffLibFiles_rs(TestPatienceDiffLibFiles):
     """Test class for file operations with the Rust implementation."""
 
     def setUp(self) -> None:
         super().setUp()
-        try:
-            from . import _patiencediff_rs
-        except ImportError:
-            self.skipTest("Rust extension not built")
+        _patiencediff_rs = _import_rs(self)
         self._PatienceSequenceMatcher = (
             _patiencediff_rs.PatienceSequenceMatcher_rs
         )
@@ -717,6 +2146,16 @@ class TestUsingCompiledIfAvailable(unittest.TestCase):
 
             self.assertIs(recurse_matches_py, patiencediff.recurse_matches)
 
+    def test_diff_many(self) -> None:
+        try:
+            from ._patiencediff_rs import diff_many_rs
+
+            self.assertIs(diff_many_rs, patiencediff.diff_many)
+        except ImportError:
+            from ._patiencediff_py import diff_many_py
+
+            self.assertIs(diff_many_py, patiencediff.diff_many)
+
     def test_run_implementation(self) -> None:
         """Test that we can run the implementation that was loaded."""
         # Simple test with some basic strings
@@ -1,101 +1,653 @@
+use std::collections::HashMap;
+use std::sync::atomic::{AtomicBool, Ordering};
+use std::sync::{Arc, Mutex, OnceLock};
+use std::time::{Duration, Instant};
+
+use pyo3::buffer::PyBuffer;
+use pyo3::exceptions::{PyIndexError, PyTypeError, PyValueError};
+use pyo3::intern;
 use pyo3::prelude::*;
-use pyo3::types::{PyList, PySequence, PyTuple};
+use pyo3::sync::GILOnceCell;
+use pyo3::types::{PyBytes, PyList, PyModule, PySequence, PySlice, PyString, PyTuple, PyType};
+use rayon::prelude::*;
 
-/// Find the longest common subsequence of unique elements in sequences a and b.
+mod patience;
+
+use patience::Opcode;
+
+static MATCH: GILOnceCell<Py<PyType>> = GILOnceCell::new();
+static MATCH_ARRAY: GILOnceCell<Py<PyType>> = GILOnceCell::new();
+static OPCODE_ARRAY: GILOnceCell<Py<PyType>> = GILOnceCell::new();
+static PY_MODULE: GILOnceCell<Py<PyModule>> = GILOnceCell::new();
+static POOLS: OnceLock<Mutex<HashMap<usize, Arc<rayon::ThreadPool>>>> = OnceLock::new();
+
+/// Return the pure Python module, which holds DiffStats and the stats hook.
+fn py_module(py: Python<'_>) -> PyResult<&Bound<'_, PyModule>> {
+    PY_MODULE
+        .get_or_try_init(py, || {
+            Ok::<_, PyErr>(py.import("patiencediff._patiencediff_py")?.unbind())
+        })
+        .map(|module| module.bind(py))
+}
+
+/// Maps hashable Python objects to dense integer tokens.
 ///
-/// Returns a list of (i, j) tuples where a[i] == b[j].
-/// This implementation uses the patience sorting algorithm.
-#[pyfunction]
-fn unique_lcs_rs<'py>(
-    py: Python<'py>,
-    a: Bound<'py, PyAny>,
-    b: Bound<'py, PyAny>,
-) -> PyResult<Bound<'py, PyList>> {
-    // Convert Python sequences to vectors of PyItem for patiencediff crate
-    let a_seq = a.clone();
-    let b_seq = b.clone();
+/// Every item is hashed exactly once; equal items (as decided by Python's
+/// ``__eq__``) share a token, so the matching itself can run on plain
+/// integers without calling back into the interpreter.
+struct Interner<'py> {
+    buckets: HashMap<isize, Vec<(Bound<'py, PyAny>, u32)>>,
+    next: u32,
+}
 
-    let a_len = a_seq.len()?;
-    let b_len = b_seq.len()?;
+impl<'py> Interner<'py> {
+    fn new() -> Self {
+        Self {
+            buckets: HashMap::new(),
+            next: 0,
+        }
+    }
 
-    // Create PyItem sequences
-    let mut a_items = Vec::with_capacity(a_len);
-    let mut b_items = Vec::with_capacity(b_len);
+    /// Return the token for item, allocating a new one if it is unseen.
+    fn intern(&mut self, item: Bound<'py, PyAny>) -> PyResult<u32> {
+        let hash = item.hash()?;
+        let bucket = self.buckets.entry(hash).or_default();
+        for (existing, token) in bucket.iter() {
+            // Identity implies equality, like Python's own dict lookups
+            if existing.as_ptr() == item.as_ptr() || existing.eq(&item)? {
+                return Ok(*token);
+            }
+        }
+        let token = self.next;
+        self.next += 1;
+        bucket.push((item, token));
+        Ok(token)
+    }
 
-    // Extract items from sequences
-    for i in 0..a_len {
-        let item = a_seq.get_item(i)?;
-        a_items.push(PyItem(item.into()));
+    /// Tokenize the items of seq[lo:hi].
+    fn tokenize_range(
+        &mut self,
+        seq: &Bound<'py, PyAny>,
+        lo: usize,
+        hi: usize,
+    ) -> PyResult<Vec<u32>> {
+        let mut tokens = Vec::with_capacity(hi.saturating_sub(lo));
+        for i in lo..hi {
+            tokens.push(self.intern(seq.get_item(i)?)?);
+        }
+        Ok(tokens)
     }
 
-    for i in 0..b_len {
-        let item = b_seq.get_item(i)?;
-        b_items.push(PyItem(item.into()));
+    /// Tokenize all items of seq.
+    fn tokenize(&mut self, seq: &Bound<'py, PyAny>) -> PyResult<Vec<u32>> {
+        let mut tokens = Vec::with_capacity(seq.len()?);
+        for item in seq.try_iter()? {
+            tokens.push(self.intern(item?)?);
+        }
+        Ok(tokens)
     }
+}
 
-    // Use patiencediff crate's unique_lcs function
-    let matches = patiencediff::unique_lcs(&a_items, &b_items);
+/// The lines of a bytes-like object, split natively.
+///
+/// Lines end after each b"\n", like ``readlines()`` on a file opened in
+/// binary mode. No Python object is created for a line until it is
+/// accessed, and lines are only ever compared as raw bytes.
+#[pyclass(name = "ByteLines_rs", frozen)]
+struct ByteLines {
+    buffer: PyBuffer<u8>,
+    /// Offset at which every line starts, followed by the end of the data
+    offsets: Vec<usize>,
+}
 
-    // Create result list
-    let result = PyList::empty(py);
+impl ByteLines {
+    fn data(&self) -> &[u8] {
+        // The buffer was checked to be C-contiguous when it was acquired,
+        // and the exporter can not resize it while we hold on to it.
+        unsafe {
+            std::slice::from_raw_parts(self.buffer.buf_ptr() as *const u8, self.buffer.len_bytes())
+        }
+    }
 
-    // Add matches to the result list
-    for &(a_pos, b_pos) in &matches {
-        let tuple = PyTuple::new(py, &[a_pos, b_pos])?;
-        result.append(tuple)?;
+    fn line(&self, index: usize) -> &[u8] {
+        &self.data()[self.offsets[index]..self.offsets[index + 1]]
     }
 
-    Ok(result)
+    fn len(&self) -> usize {
+        self.offsets.len() - 1
+    }
 }
 
-/// Python item wrapper that implements the necessary traits for patiencediff crate
-struct PyItem(Py<PyAny>);
+#[pymethods]
+impl ByteLines {
+    fn __len__(&self) -> usize {
+        self.len()
+    }
 
-// Implement Clone for PyItem using clone_ref() for Py<PyAny>
-impl Clone for PyItem {
-    fn clone(&self) -> Self {
-        Python::attach(|py| PyItem(self.0.clone_ref(py)))
+    fn __getitem__<'py>(
+        &self,
+        py: Python<'py>,
+        index: Bound<'py, PyAny>,
+    ) -> PyResult<Bound<'py, PyAny>> {
+        if let Ok(slice) = index.downcast::<PySlice>() {
+            let indices = slice.indices(self.len() as isize)?;
+            let result = PyList::empty(py);
+            let mut i = indices.start;
+            for _ in 0..indices.slicelength {
+                result.append(PyBytes::new(py, self.line(i as usize)))?;
+                i += indices.step;
+            }
+            return Ok(result.into_any());
+        }
+        let mut i: isize = index.extract()?;
+        if i < 0 {
+            i += self.len() as isize;
+        }
+        if i < 0 || i as usize >= self.len() {
+            return Err(PyIndexError::new_err("line index out of range"));
+        }
+        Ok(PyBytes::new(py, self.line(i as usize)).into_any())
     }
 }
 
-// Define equality for PyItem that uses Python's eq
-impl PartialEq for PyItem {
-    fn eq(&self, other: &Self) -> bool {
-        Python::attach(|py| {
-            let a = self.0.extract::<Bound<PyAny>>(py).unwrap();
-            let b = other.0.extract::<Bound<PyAny>>(py).unwrap();
-            a.eq(&b).unwrap_or(false)
+/// Split a bytes-like object (such as bytes or an mmap) into lines.
+///
+/// The returned object behaves like a read-only list of bytes but keeps a
+/// reference to the original buffer rather than copying every line.
+#[pyfunction]
+fn split_lines_rs(py: Python<'_>, data: Bound<'_, PyAny>) -> PyResult<ByteLines> {
+    let buffer = PyBuffer::<u8>::get(&data)?;
+    if !buffer.is_c_contiguous() {
+        return Err(PyValueError::new_err("buffer is not contiguous"));
+    }
+    let mut lines = ByteLines {
+        buffer,
+        offsets: Vec::new(),
+    };
+    let data = lines.data();
+    let offsets = py.detach(|| {
+        let mut offsets = vec![0];
+        offsets.extend(
+            data.iter()
+                .enumerate()
+                .filter(|&(_, &c)| c == b'\n')
+                .map(|(i, _)| i + 1),
+        );
+        if offsets[offsets.len() - 1] != data.len() {
+            offsets.push(data.len());
+        }
+        offsets
+    });
+    lines.offsets = offsets;
+    Ok(lines)
+}
+
+/// Assign tokens to lines, sharing a table between both sides of a diff.
+fn tokenize_lines<'a>(table: &mut HashMap<&'a [u8], u32>, lines: &'a ByteLines) -> Vec<u32> {
+    (0..lines.len())
+        .map(|i| {
+            let next = table.len() as u32;
+            *table.entry(lines.line(i)).or_insert(next)
         })
+        .collect()
+}
+
+/// Return the items of a buffer of C unsigned ints, such as an array('I').
+fn u32_buffer(obj: &Bound<'_, PyAny>) -> Option<Vec<u32>> {
+    let buffer = PyBuffer::<u32>::get(obj).ok()?;
+    buffer.to_vec(obj.py()).ok()
+}
+
+/// Tokenize sequences together, so that equal items get equal tokens.
+///
+/// Lines produced by split_lines_rs are hashed as raw bytes without
+/// creating any Python objects, and buffers of unsigned ints (such as the
+/// tokens of a LineIndex) are used as tokens directly; any other
+/// sequences go through a single Interner and must contain hashable items.
+fn tokenize_all(seqs: &[&Bound<'_, PyAny>]) -> PyResult<Vec<Vec<u32>>> {
+    let buffers: Option<Vec<Vec<u32>>> = seqs.iter().map(|seq| u32_buffer(seq)).collect();
+    if let Some(tokens) = buffers {
+        return Ok(tokens);
+    }
+    let lines: Option<Vec<&ByteLines>> = seqs
+        .iter()
+        .map(|seq| seq.downcast::<ByteLines>().ok().map(|lines| lines.get()))
+        .collect();
+    if let Some(lines) = lines {
+        let py = seqs[0].py();
+        return Ok(py.detach(|| {
+            let mut table = HashMap::new();
+            lines
+                .iter()
+                .map(|lines| tokenize_lines(&mut table, lines))
+                .collect()
+        }));
     }
+
+    // All of them must be sequences
+    let seqs = seqs
+        .iter()
+        .map(|seq| seq.downcast::<PySequence>())
+        .collect::<Result<Vec<_>, _>>()?;
+
+    // Hashing every item once also raises TypeError for unhashable items
+    let mut interner = Interner::new();
+    seqs.iter()
+        .map(|seq| interner.tokenize(seq.as_any()))
+        .collect()
+}
+
+/// Tokenize a pair of sequences, so that equal items get equal tokens.
+fn tokenize_pair<'py>(
+    a: &Bound<'py, PyAny>,
+    b: &Bound<'py, PyAny>,
+) -> PyResult<(Vec<u32>, Vec<u32>)> {
+    let mut tokens = tokenize_all(&[a, b])?;
+    let b_tokens = tokens.pop().unwrap();
+    let a_tokens = tokens.pop().unwrap();
+    Ok((a_tokens, b_tokens))
 }
 
-impl Eq for PyItem {}
+/// Whether a byte is ASCII whitespace, as LineKey defines it.
+fn is_space(c: u8) -> bool {
+    matches!(c, b' ' | b'\t' | b'\n' | b'\r' | 0x0b | 0x0c)
+}
+
+/// The options of a LineKey, applied natively to the bytes of lines.
+#[derive(Clone, Copy)]
+struct Normalization {
+    ignore_all_space: bool,
+    ignore_space_change: bool,
+    ignore_case: bool,
+    ignore_eol: bool,
+}
+
+impl Normalization {
+    /// Return the options of key, or None if it is not a LineKey.
+    fn of_key<'py>(key: &Bound<'py, PyAny>) -> PyResult<Option<Self>> {
+        let py = key.py();
+        if !key.is_instance(&py_module(py)?.getattr(intern!(py, "LineKey"))?)? {
+            return Ok(None);
+        }
+        let flag = |name: &Bound<'py, PyString>| key.getattr(name)?.is_truthy();
+        Ok(Some(Self {
+            ignore_all_space: flag(intern!(py, "ignore_all_space"))?,
+            ignore_space_change: flag(intern!(py, "ignore_space_change"))?,
+            ignore_case: flag(intern!(py, "ignore_case"))?,
+            ignore_eol: flag(intern!(py, "ignore_eol"))?,
+        }))
+    }
 
-// Define hashing for PyItem that uses Python's hash
-impl std::hash::Hash for PyItem {
-    fn hash<H: std::hash::Hasher>(&self, state: &mut H) {
-        let hash_value = Python::attach(|py| {
-            let obj = self.0.extract::<Bound<PyAny>>(py).unwrap();
-            match obj.hash() {
-                Ok(hash) => hash,
-                Err(e) => {
-                    // Properly propagate a TypeError without panicking
-                    if e.is_instance_of::<pyo3::exceptions::PyTypeError>(py) {
-                        return 0; // Use a constant hash for unhashable types
+    /// Return the normalized form of a line, which is UTF-8 if text is set.
+    ///
+    /// This gives the UTF-8 encoding of what LineKey returns for a str
+    /// line, and exactly what it returns for a bytes line.
+    fn normalize(&self, line: &[u8], text: bool) -> Vec<u8> {
+        let mut line = line;
+        if self.ignore_eol {
+            line = line
+                .strip_suffix(b"\r\n")
+                .or_else(|| line.strip_suffix(b"\n"))
+                .or_else(|| line.strip_suffix(b"\r"))
+                .unwrap_or(line);
+        }
+        let mut key = Vec::with_capacity(line.len());
+        if self.ignore_all_space {
+            key.extend(line.iter().copied().filter(|&c| !is_space(c)));
+        } else if self.ignore_space_change {
+            // Runs of whitespace become a single space, unless they end
+            // the line
+            let mut space = false;
+            for &c in line {
+                if is_space(c) {
+                    space = true;
+                    continue;
+                }
+                if space {
+                    key.push(b' ');
+                    space = false;
+                }
+                key.push(c);
+            }
+        } else {
+            key.extend_from_slice(line);
+        }
+        if self.ignore_case {
+            if !text {
+                key.make_ascii_lowercase();
+            } else {
+                match String::from_utf8(key) {
+                    Ok(line) => key = line.to_lowercase().into_bytes(),
+                    // Text with lone surrogates only has its ASCII
+                    // letters lowercased
+                    Err(err) => {
+                        key = err.into_bytes();
+                        key.make_ascii_lowercase();
                     }
-                    // For any other errors, use a different constant
-                    return 1;
                 }
             }
-        });
-        state.write_isize(hash_value);
+        }
+        key
+    }
+
+    /// Return the normalized form of a str or bytes line.
+    ///
+    /// The key of a str line is tagged, so it never equals that of a
+    /// bytes line, as in Python.
+    fn normalize_item(&self, item: &Bound<'_, PyAny>) -> PyResult<(bool, Box<[u8]>)> {
+        if let Ok(line) = item.downcast::<PyString>() {
+            let key = match line.to_str() {
+                Ok(text) => self.normalize(text.as_bytes(), true),
+                Err(_) => {
+                    let py = item.py();
+                    let encoded =
+                        line.call_method1(intern!(py, "encode"), ("utf-8", "surrogatepass"))?;
+                    self.normalize(encoded.downcast::<PyBytes>()?.as_bytes(), true)
+                }
+            };
+            Ok((true, key.into_boxed_slice()))
+        } else if let Ok(line) = item.downcast::<PyBytes>() {
+            Ok((
+                false,
+                self.normalize(line.as_bytes(), false).into_boxed_slice(),
+            ))
+        } else {
+            Err(PyTypeError::new_err(format!(
+                "LineKey needs str or bytes lines, not {}",
+                item.get_type().name()?
+            )))
+        }
     }
 }
 
+/// Tokens for the keys of items, as given by the key argument of a matcher.
+///
+/// The keys of a LineKey are computed natively from the bytes of str and
+/// bytes lines, and those of the lines of a ByteLines_rs without holding
+/// the GIL. Any other key is called once on every item, and its results
+/// are bucketed by hash like the items of an Interner.
+struct KeyTable {
+    key: Py<PyAny>,
+    normalization: Option<Normalization>,
+    /// The normalized lines, tagged with whether they were str
+    lines: HashMap<(bool, Box<[u8]>), u32>,
+    /// The results of any other key
+    objects: HashMap<isize, Vec<(Py<PyAny>, u32)>>,
+    next: u32,
+}
+
+impl KeyTable {
+    fn new(key: &Bound<'_, PyAny>) -> PyResult<Self> {
+        Ok(Self {
+            key: key.clone().unbind(),
+            normalization: Normalization::of_key(key)?,
+            lines: HashMap::new(),
+            objects: HashMap::new(),
+            next: 0,
+        })
+    }
+
+    /// Return the token of a normalized line.
+    ///
+    /// Unseen lines get a new token if grow is set, and otherwise all get
+    /// the same token, which no line in the table has.
+    fn line_token(&mut self, key: (bool, Box<[u8]>), grow: bool) -> u32 {
+        if let Some(&token) = self.lines.get(&key) {
+            return token;
+        }
+        let token = self.next;
+        if grow {
+            self.lines.insert(key, token);
+            self.next += 1;
+        }
+        token
+    }
+
+    /// Return the token of the key of an item, like line_token().
+    fn object_token(&mut self, key: Bound<'_, PyAny>, grow: bool) -> PyResult<u32> {
+        let py = key.py();
+        let hash = key.hash()?;
+        for (existing, token) in self.objects.get(&hash).into_iter().flatten() {
+            if existing.as_ptr() == key.as_ptr() || existing.bind(py).eq(&key)? {
+                return Ok(*token);
+            }
+        }
+        let token = self.next;
+        if grow {
+            self.objects
+                .entry(hash)
+                .or_default()
+                .push((key.unbind(), token));
+            self.next += 1;
+        }
+        Ok(token)
+    }
+
+    /// Tokenize the items of seq by their keys.
+    fn tokenize(&mut self, seq: &Bound<'_, PyAny>, grow: bool) -> PyResult<Vec<u32>> {
+        let py = seq.py();
+        if let (Some(normalization), Ok(lines)) = (self.normalization, seq.downcast::<ByteLines>())
+        {
+            let lines = lines.get();
+            return Ok(py.detach(|| {
+                let keys: Vec<Vec<u8>> = (0..lines.len())
+                    .into_par_iter()
+                    .map(|i| normalization.normalize(lines.line(i), false))
+                    .collect();
+                keys.into_iter()
+                    .map(|key| self.line_token((false, key.into_boxed_slice()), grow))
+                    .collect()
+            }));
+        }
+        let mut tokens = Vec::with_capacity(seq.len()?);
+        for item in seq.try_iter()? {
+            let item = item?;
+            let token = match self.normalization {
+                Some(normalization) => self.line_token(normalization.normalize_item(&item)?, grow),
+                None => {
+                    let key = self.key.bind(py).call1((item,))?;
+                    self.object_token(key, grow)?
+                }
+            };
+            tokens.push(token);
+        }
+        Ok(tokens)
+    }
+}
+
+/// One side of a diff.
+#[derive(Clone, Copy, PartialEq, Eq)]
+enum Side {
+    A,
+    B,
+}
+
+impl Side {
+    fn other(self) -> Side {
+        match self {
+            Side::A => Side::B,
+            Side::B => Side::A,
+        }
+    }
+}
+
+/// The token table of one side of a diff.
+///
+/// It is kept while the other side is replaced with set_seq1() or
+/// set_seq2(), so that only the new side has to be tokenized. Items of the
+/// new side that are not in the table all get the same token, which no
+/// item of the kept side has, as they can never match.
+enum SideIndex {
+    /// The kept side was a buffer of tokens, so the other must be too.
+    Tokens,
+    /// The lines of a ByteLines_rs, by content.
+    Bytes(HashMap<Box<[u8]>, u32>),
+    /// Hashable Python objects bucketed by hash, and the number of tokens.
+    Objects(HashMap<isize, Vec<(Py<PyAny>, u32)>>, u32),
+    /// The keys of the items, if the matcher has a key.
+    Keys(KeyTable),
+}
+
+impl SideIndex {
+    /// Tokenize seq, returning its tokens along with their table.
+    ///
+    /// If key is given, the items are tokenized by their keys.
+    fn build(
+        seq: &Bound<'_, PyAny>,
+        key: Option<&Bound<'_, PyAny>>,
+    ) -> PyResult<(Vec<u32>, SideIndex)> {
+        if let Some(key) = key {
+            let mut table = KeyTable::new(key)?;
+            let tokens = table.tokenize(seq, true)?;
+            return Ok((tokens, SideIndex::Keys(table)));
+        }
+        if let Some(tokens) = u32_buffer(seq) {
+            return Ok((tokens, SideIndex::Tokens));
+        }
+        if let Ok(lines) = seq.downcast::<ByteLines>() {
+            let lines = lines.get();
+            return Ok(seq.py().detach(|| {
+                let mut table: HashMap<Box<[u8]>, u32> = HashMap::new();
+                let tokens = (0..lines.len())
+                    .map(|i| {
+                        let line = lines.line(i);
+                        if let Some(&token) = table.get(line) {
+                            return token;
+                        }
+                        let token = table.len() as u32;
+                        table.insert(line.into(), token);
+                        token
+                    })
+                    .collect();
+                (tokens, SideIndex::Bytes(table))
+            }));
+        }
+        let mut interner = Interner::new();
+        let tokens = interner.tokenize(seq.downcast::<PySequence>()?.as_any())?;
+        let buckets: HashMap<isize, Vec<(Py<PyAny>, u32)>> = interner
+            .buckets
+            .into_iter()
+            .map(|(hash, bucket)| {
+                let bucket: Vec<(Py<PyAny>, u32)> = bucket
+                    .into_iter()
+                    .map(|(item, token)| (item.unbind(), token))
+                    .collect();
+                (hash, bucket)
+            })
+            .collect();
+        Ok((tokens, SideIndex::Objects(buckets, interner.next)))
+    }
+
+    /// Return the tokens of seq in this table.
+    ///
+    /// Returns None if seq can not be looked up in this table, because it
+    /// is of a different kind than the side the table was built from.
+    fn lookup(&mut self, seq: &Bound<'_, PyAny>) -> PyResult<Option<Vec<u32>>> {
+        match self {
+            SideIndex::Tokens => Ok(u32_buffer(seq)),
+            SideIndex::Keys(table) => Ok(Some(table.tokenize(seq, false)?)),
+            SideIndex::Bytes(table) => {
+                let missing = table.len() as u32;
+                if let Ok(lines) = seq.downcast::<ByteLines>() {
+                    let lines = lines.get();
+                    return Ok(Some(seq.py().detach(|| {
+                        (0..lines.len())
+                            .map(|i| table.get(lines.line(i)).copied().unwrap_or(missing))
+                            .collect()
+                    })));
+                }
+                // Other sequences of bytes, such as the new lines of an edit
+                let mut tokens = Vec::new();
+                for item in seq.try_iter()? {
+                    let item = item?;
+                    let line = match item.downcast::<PyBytes>() {
+                        Ok(line) => line,
+                        Err(_) => return Ok(None),
+                    };
+                    tokens.push(table.get(line.as_bytes()).copied().unwrap_or(missing));
+                }
+                Ok(Some(tokens))
+            }
+            SideIndex::Objects(buckets, missing) => {
+                let py = seq.py();
+                let seq = seq.downcast::<PySequence>()?;
+                let mut tokens = Vec::with_capacity(seq.len()?);
+                for item in seq.try_iter()? {
+                    let item = item?;
+                    let mut token = *missing;
+                    if let Some(bucket) = buckets.get(&item.hash()?) {
+                        for (existing, existing_token) in bucket {
+                            if existing.as_ptr() == item.as_ptr() || existing.bind(py).eq(&item)? {
+                                token = *existing_token;
+                                break;
+                            }
+                        }
+                    }
+                    tokens.push(token);
+                }
+                Ok(Some(tokens))
+            }
+        }
+    }
+}
+
+/// Tokenize a pair of sequences, by key if one is given.
+///
+/// Returns the tokens of both, and the table of a if it can be kept.
+fn tokenize_sides<'py>(
+    a: &Bound<'py, PyAny>,
+    b: &Bound<'py, PyAny>,
+    key: Option<&Bound<'py, PyAny>>,
+) -> PyResult<(Vec<u32>, Vec<u32>, Option<(Side, SideIndex)>)> {
+    match key {
+        Some(key) => {
+            let mut table = KeyTable::new(key)?;
+            let a_tokens = table.tokenize(a, true)?;
+            let b_tokens = table.tokenize(b, true)?;
+            Ok((a_tokens, b_tokens, Some((Side::A, SideIndex::Keys(table)))))
+        }
+        None => {
+            let (a_tokens, b_tokens) = tokenize_pair(a, b)?;
+            Ok((a_tokens, b_tokens, None))
+        }
+    }
+}
+
+/// Find the longest common subsequence of unique elements in sequences a and b.
+///
+/// Returns a list of (i, j) tuples where a[i] == b[j].
+/// This implementation uses the patience sorting algorithm.
+#[pyfunction]
+fn unique_lcs_rs<'py>(
+    py: Python<'py>,
+    a: Bound<'py, PyAny>,
+    b: Bound<'py, PyAny>,
+) -> PyResult<Bound<'py, PyList>> {
+    let mut interner = Interner::new();
+    let a_tokens = interner.tokenize(&a)?;
+    let b_tokens = interner.tokenize(&b)?;
+
+    // The tokens are plain Rust data, so other Python threads can run in
+    // the meantime
+    let matches = py.detach(|| patience::unique_lcs(&a_tokens, &b_tokens));
+
+    // Create result list
+    let result = PyList::empty(py);
+
+    // Add matches to the result list
+    for &(a_pos, b_pos) in &matches {
+        let tuple = PyTuple::new(py, &[a_pos, b_pos])?;
+        result.append(tuple)?;
+    }
+
+    Ok(result)
+}
+
 /// Recursively find matches between two sequences.
 ///
-/// This function wraps the patiencediff crate's recurse_matches function.
+/// Gaps between the anchors of large regions are matched in parallel.
 #[pyfunction]
+#[pyo3(signature = (a, b, alo, blo, ahi, bhi, answer, maxrecursion, *, histogram=false))]
 fn recurse_matches_rs<'py>(
     py: Python<'py>,
     a: Bound<'py, PyAny>,
@@ -106,45 +658,36 @@ fn recurse_matches_rs<'py>(
     bhi: usize,
     answer: Bound<'py, PyList>,
     maxrecursion: i32,
+    histogram: bool,
 ) -> PyResult<()> {
     // Early return for base cases
     if maxrecursion < 0 || alo == ahi || blo == bhi {
         return Ok(());
     }
 
-    // Convert Python sequences to vectors of PyItem for patiencediff crate
-    let a_seq = a.clone();
-    let b_seq = b.clone();
-
-    // Create vectors of PyItems for the sliced sequences
-    let mut a_items = Vec::with_capacity(ahi - alo);
-    let mut b_items = Vec::with_capacity(bhi - blo);
-
-    // Extract the items we need from the sequences
-    for i in alo..ahi {
-        let item = a_seq.get_item(i)?;
-        a_items.push(PyItem(item.into()));
-    }
-
-    for i in blo..bhi {
-        let item = b_seq.get_item(i)?;
-        b_items.push(PyItem(item.into()));
-    }
+    // Only the ranges we are asked about need to be tokenized
+    let mut interner = Interner::new();
+    let a_tokens = interner.tokenize_range(&a, alo, ahi)?;
+    let b_tokens = interner.tokenize_range(&b, blo, bhi)?;
 
     // Create a vector to collect the matches
     let mut matches = Vec::new();
 
-    // Call the patiencediff crate's recurse_matches function
-    patiencediff::recurse_matches(
-        &a_items,
-        &b_items,
-        0,
-        0,
-        a_items.len(),
-        b_items.len(),
-        &mut matches,
-        maxrecursion,
-    );
+    py.detach(|| {
+        patience::recurse_matches(
+            &a_tokens,
+            &b_tokens,
+            0,
+            0,
+            a_tokens.len(),
+            b_tokens.len(),
+            &mut matches,
+            maxrecursion,
+            &patience::Options::new(histogram, None, None),
+            None,
+            0,
+        );
+    });
 
     // Convert the results to Python and add to the answer list
     for &(rel_a, rel_b) in &matches {
@@ -158,60 +701,859 @@ fn recurse_matches_rs<'py>(
     Ok(())
 }
 
+/// Return the tag of an opcode, as an interned string.
+fn opcode_tag<'py>(py: Python<'py>, opcode: &Opcode) -> &'py Bound<'py, PyString> {
+    match opcode {
+        Opcode::Equal(..) => intern!(py, "equal"),
+        Opcode::Replace(..) => intern!(py, "replace"),
+        Opcode::Delete(..) => intern!(py, "delete"),
+        Opcode::Insert(..) => intern!(py, "insert"),
+    }
+}
+
+/// Convert an opcode to a difflib-style (tag, i1, i2, j1, j2) tuple.
+fn opcode_to_tuple<'py>(py: Python<'py>, opcode: &Opcode) -> PyResult<Bound<'py, PyTuple>> {
+    let (_, i1, i2, j1, j2) = opcode.parts();
+    (opcode_tag(py, opcode), i1, i2, j1, j2).into_pyobject(py)
+}
+
+/// Pack values into an array('q'), to back a MatchArray or OpcodeArray.
+fn int64_array<'py>(py: Python<'py>, values: &[i64]) -> PyResult<Bound<'py, PyAny>> {
+    let bytes: Vec<u8> = values
+        .iter()
+        .flat_map(|value| value.to_ne_bytes())
+        .collect();
+    let array = py.import("array")?.getattr("array")?.call1(("q",))?;
+    array.call_method1("frombytes", (PyBytes::new(py, &bytes),))?;
+    Ok(array)
+}
+
+/// Convert grouped opcodes to a list of lists of opcode tuples.
+///
+/// Empty groups are skipped.
+fn grouped_opcodes_to_list<'py>(
+    py: Python<'py>,
+    grouped_opcodes: &[Vec<Opcode>],
+) -> PyResult<Bound<'py, PyList>> {
+    let result = PyList::empty(py);
+
+    for group in grouped_opcodes {
+        if group.is_empty() {
+            continue;
+        }
+        let group_list = PyList::empty(py);
+        for opcode in group {
+            group_list.append(opcode_to_tuple(py, opcode)?)?;
+        }
+        result.append(group_list)?;
+    }
+
+    Ok(result)
+}
+
+/// Return a thread pool with `workers` threads, or None for the global one.
+///
+/// Pools are kept for the life of the process, one per worker count, so
+/// that repeated calls do not spawn and tear down threads each time.
+fn worker_pool(workers: Option<usize>) -> PyResult<Option<Arc<rayon::ThreadPool>>> {
+    let workers = match workers {
+        Some(workers) if workers.max(1) != rayon::current_num_threads() => workers.max(1),
+        _ => return Ok(None),
+    };
+    let mut pools = POOLS
+        .get_or_init(|| Mutex::new(HashMap::new()))
+        .lock()
+        .unwrap_or_else(|e| e.into_inner());
+    if let Some(pool) = pools.get(&workers) {
+        return Ok(Some(pool.clone()));
+    }
+    let pool = rayon::ThreadPoolBuilder::new()
+        .num_threads(workers)
+        .build()
+        .map_err(|e| pyo3::exceptions::PyRuntimeError::new_err(e.to_string()))?;
+    let pool = Arc::new(pool);
+    pools.insert(workers, pool.clone());
+    Ok(Some(pool))
+}
+
+/// Compute the opcodes for many pairs of sequences at once.
+///
+/// All pairs are tokenized up front; the matching then runs on a pool of
+/// `workers` native threads without holding the GIL. Results are returned
+/// in input order. If `n` is given, each result is the list of grouped
+/// opcodes with `n` lines of context rather than the plain opcodes.
+#[pyfunction]
+#[pyo3(signature = (pairs, workers=None, n=None))]
+fn diff_many_rs<'py>(
+    py: Python<'py>,
+    pairs: Bound<'py, PyAny>,
+    workers: Option<usize>,
+    n: Option<usize>,
+) -> PyResult<Bound<'py, PyList>> {
+    let mut tokenized = Vec::new();
+    for pair in pairs.try_iter()? {
+        let (a, b): (Bound<'py, PyAny>, Bound<'py, PyAny>) = pair?.extract()?;
+        tokenized.push(tokenize_pair(&a, &b)?);
+    }
+
+    let pool = worker_pool(workers)?;
+    let diff_all = || -> Vec<Vec<Vec<Opcode>>> {
+        tokenized
+            .par_iter()
+            .map(|(a_tokens, b_tokens)| {
+                let opcodes = patience::opcodes(&patience::matching_blocks(a_tokens, b_tokens));
+                match n {
+                    Some(n) => patience::grouped_opcodes(&opcodes, n),
+                    None => vec![opcodes],
+                }
+            })
+            .collect()
+    };
+    let results = py.detach(|| match &pool {
+        Some(pool) => pool.install(diff_all),
+        None => diff_all(),
+    });
+
+    let result = PyList::empty(py);
+    for groups in &results {
+        match n {
+            Some(_) => result.append(grouped_opcodes_to_list(py, groups)?)?,
+            None => {
+                let opcodes = PyList::empty(py);
+                for opcode in &groups[0] {
+                    opcodes.append(opcode_to_tuple(py, opcode)?)?;
+                }
+                result.append(opcodes)?;
+            }
+        }
+    }
+
+    Ok(result)
+}
+
+/// Return the regions of a three-way merge of this and other.
+///
+/// All three sequences are tokenized together, and both diffs against
+/// base run concurrently without holding the GIL.
+#[pyfunction]
+fn merge_regions_rs<'py>(
+    py: Python<'py>,
+    base: Bound<'py, PyAny>,
+    this: Bound<'py, PyAny>,
+    other: Bound<'py, PyAny>,
+) -> PyResult<Bound<'py, PyList>> {
+    let tokens = tokenize_all(&[&base, &this, &other])?;
+    let regions = py.detach(|| patience::merge_regions(&tokens[0], &tokens[1], &tokens[2]));
+    let result = PyList::empty(py);
+    for (tag, base_start, base_end, this_start, this_end, other_start, other_end) in regions {
+        result.append((
+            PyString::intern(py, tag),
+            base_start,
+            base_end,
+            this_start,
+            this_end,
+            other_start,
+            other_end,
+        ))?;
+    }
+    Ok(result)
+}
+
+/// Return the code points of a str or bytes line; bytes are read as
+/// Latin-1.
+///
+/// Lone surrogates, which a Rust string can not hold, are kept as code
+/// points of their own, so that offsets are the same as in Python.
+fn line_code_points(line: &Bound<'_, PyAny>) -> PyResult<Vec<u32>> {
+    if let Ok(line) = line.downcast::<PyString>() {
+        if let Ok(text) = line.to_str() {
+            return Ok(text.chars().map(u32::from).collect());
+        }
+        let py = line.py();
+        let encoded = line.call_method1(intern!(py, "encode"), ("utf-32-le", "surrogatepass"))?;
+        Ok(encoded
+            .downcast::<PyBytes>()?
+            .as_bytes()
+            .chunks_exact(4)
+            .map(|c| u32::from_le_bytes([c[0], c[1], c[2], c[3]]))
+            .collect())
+    } else if let Ok(line) = line.downcast::<PyBytes>() {
+        Ok(line.as_bytes().iter().map(|&c| u32::from(c)).collect())
+    } else {
+        Err(PyTypeError::new_err("lines must be str or bytes"))
+    }
+}
+
+/// Classify the non-ASCII code points of pairs of lines for splitting them
+/// into words, with the `str.isalnum()` and `str.isspace()` that Python's
+/// `re` uses for `\w` and `\s`.
+fn char_classes(py: Python<'_>, pairs: &[(Vec<u32>, Vec<u32>)]) -> PyResult<patience::CharClasses> {
+    let chr = py.import("builtins")?.getattr("chr")?;
+    let mut classes = patience::CharClasses::new();
+    for (a, b) in pairs {
+        for &c in a.iter().chain(b) {
+            if c < 0x80 || classes.contains_key(&c) {
+                continue;
+            }
+            let text = chr.call1((c,))?;
+            let class = if text.call_method0(intern!(py, "isalnum"))?.is_truthy()? {
+                0
+            } else if text.call_method0(intern!(py, "isspace"))?.is_truthy()? {
+                1
+            } else {
+                2
+            };
+            classes.insert(c, class);
+        }
+    }
+    Ok(classes)
+}
+
+/// Return the intra-line changes of the replace opcodes of a diff.
+///
+/// The lines of every replace opcode are paired up in order, and the
+/// words (or characters) of each pair are matched natively, in parallel
+/// and without holding the GIL. Opcodes with more than `budget`
+/// characters on both sides combined are skipped.
+#[pyfunction]
+#[pyo3(signature = (a, b, opcodes, mode="word", budget=10000))]
+fn refine_opcodes_rs<'py>(
+    py: Python<'py>,
+    a: Bound<'py, PyAny>,
+    b: Bound<'py, PyAny>,
+    opcodes: Bound<'py, PyAny>,
+    mode: &str,
+    budget: usize,
+) -> PyResult<Bound<'py, PyList>> {
+    let words = match mode {
+        "word" => true,
+        "char" => false,
+        _ => return Err(PyValueError::new_err(format!("unknown mode: {mode}"))),
+    };
+    let a = a.downcast::<PySequence>()?;
+    let b = b.downcast::<PySequence>()?;
+    let mut lines = Vec::new();
+    let mut pairs = Vec::new();
+    for opcode in opcodes.try_iter()? {
+        let (tag, i1, i2, j1, j2): (Bound<'py, PyString>, usize, usize, usize, usize) =
+            opcode?.extract()?;
+        if tag.to_str()? != "replace" {
+            continue;
+        }
+        let mut size = 0;
+        for i in i1..i2 {
+            size += a.get_item(i)?.len()?;
+        }
+        for j in j1..j2 {
+            size += b.get_item(j)?.len()?;
+        }
+        if size > budget {
+            continue;
+        }
+        for (i, j) in (i1..i2).zip(j1..j2) {
+            lines.push((i, j));
+            pairs.push((
+                line_code_points(&a.get_item(i)?)?,
+                line_code_points(&b.get_item(j)?)?,
+            ));
+        }
+    }
+    let classes = if words {
+        char_classes(py, &pairs)?
+    } else {
+        patience::CharClasses::new()
+    };
+    let spans = py.detach(|| patience::refine_pairs(&pairs, words, &classes));
+    let result = PyList::empty(py);
+    for ((i, j), (a_spans, b_spans)) in lines.into_iter().zip(spans) {
+        result.append((i, j, a_spans, b_spans))?;
+    }
+    Ok(result)
+}
+
+/// Return the contents of a str or bytes object, as bytes.
+fn text_or_bytes(obj: &Bound<'_, PyAny>, bytes_mode: bool) -> PyResult<Vec<u8>> {
+    if bytes_mode {
+        Ok(obj.downcast::<PyBytes>()?.as_bytes().to_vec())
+    } else {
+        Ok(obj.str()?.to_str()?.as_bytes().to_vec())
+    }
+}
+
+/// Return the tab-separated date unified_diff puts after a file name.
+fn date_suffix(date: &Bound<'_, PyAny>, bytes_mode: bool) -> PyResult<Vec<u8>> {
+    let date = if bytes_mode {
+        match date.downcast::<PyBytes>() {
+            Ok(date) => date.as_bytes().to_vec(),
+            Err(_) => date.str()?.to_str()?.as_bytes().to_vec(),
+        }
+    } else if date.is_truthy()? {
+        date.str()?.to_str()?.as_bytes().to_vec()
+    } else {
+        Vec::new()
+    };
+    if date.is_empty() {
+        return Ok(date);
+    }
+    let mut suffix = b"\t".to_vec();
+    suffix.extend_from_slice(&date);
+    Ok(suffix)
+}
+
+/// Append seq[lo:hi] to out, with every line preceded by prefix.
+fn push_lines(
+    out: &mut Vec<u8>,
+    seq: &Bound<'_, PyAny>,
+    lo: usize,
+    hi: usize,
+    prefix: u8,
+    bytes_mode: bool,
+) -> PyResult<()> {
+    if let Ok(lines) = seq.downcast::<ByteLines>() {
+        let lines = lines.get();
+        for i in lo..hi {
+            out.push(prefix);
+            out.extend_from_slice(lines.line(i));
+        }
+        return Ok(());
+    }
+    for i in lo..hi {
+        let line = seq.get_item(i)?;
+        out.push(prefix);
+        if bytes_mode {
+            out.extend_from_slice(line.downcast::<PyBytes>()?.as_bytes());
+        } else {
+            out.extend_from_slice(line.downcast::<PyString>()?.to_str()?.as_bytes());
+        }
+    }
+    Ok(())
+}
+
+/// Render a unified diff of a and b into a single str or bytes object.
+///
+/// The output is identical to joining the lines generated by
+/// unified_diff() (or unified_diff_bytes(), if lineterm is bytes) with
+/// the patience matcher, but is built without creating a Python object
+/// per output line. File names and dates may be None, and lineterm
+/// defaults to "\n".
+#[pyfunction]
+#[pyo3(signature = (a, b, fromfile=None, tofile=None, fromfiledate=None, tofiledate=None, n=3, lineterm=None))]
+fn render_unified_rs<'py>(
+    py: Python<'py>,
+    a: Bound<'py, PyAny>,
+    b: Bound<'py, PyAny>,
+    fromfile: Option<Bound<'py, PyAny>>,
+    tofile: Option<Bound<'py, PyAny>>,
+    fromfiledate: Option<Bound<'py, PyAny>>,
+    tofiledate: Option<Bound<'py, PyAny>>,
+    n: usize,
+    lineterm: Option<Bound<'py, PyAny>>,
+) -> PyResult<Bound<'py, PyAny>> {
+    let lineterm = match lineterm {
+        Some(lineterm) => lineterm,
+        None => PyString::new(py, "\n").into_any(),
+    };
+    let bytes_mode = if lineterm.is_instance_of::<PyBytes>() {
+        true
+    } else if lineterm.is_instance_of::<PyString>() {
+        false
+    } else {
+        return Err(PyTypeError::new_err("lineterm must be str or bytes"));
+    };
+    if !bytes_mode && (a.is_instance_of::<ByteLines>() || b.is_instance_of::<ByteLines>()) {
+        return Err(PyTypeError::new_err("bytes lines require a bytes lineterm"));
+    }
+    let lineterm = text_or_bytes(&lineterm, bytes_mode)?;
+    let name = |obj: &Option<Bound<'py, PyAny>>| match obj {
+        Some(obj) => text_or_bytes(obj, bytes_mode),
+        None => Ok(Vec::new()),
+    };
+    let date = |obj: &Option<Bound<'py, PyAny>>| match obj {
+        Some(obj) => date_suffix(obj, bytes_mode),
+        None => Ok(Vec::new()),
+    };
+    let (fromfile, tofile) = (name(&fromfile)?, name(&tofile)?);
+    let (fromfiledate, tofiledate) = (date(&fromfiledate)?, date(&tofiledate)?);
+
+    let (a_tokens, b_tokens) = tokenize_pair(&a, &b)?;
+    let groups = py.detach(|| {
+        let blocks = patience::matching_blocks(&a_tokens, &b_tokens);
+        patience::grouped_opcodes(&patience::opcodes(&blocks), n)
+    });
+
+    let mut out = Vec::new();
+    let mut started = false;
+    for group in groups.iter().filter(|group| !group.is_empty()) {
+        if !started {
+            for (marker, file, filedate) in [
+                (b"--- ", &fromfile, &fromfiledate),
+                (b"+++ ", &tofile, &tofiledate),
+            ] {
+                out.extend_from_slice(marker);
+                out.extend_from_slice(file);
+                out.extend_from_slice(filedate);
+                out.extend_from_slice(&lineterm);
+            }
+            started = true;
+        }
+        let (_, i1, _, j1, _) = group[0].parts();
+        let (_, _, i2, _, j2) = group[group.len() - 1].parts();
+        out.extend_from_slice(
+            format!("@@ -{},{} +{},{} @@", i1 + 1, i2 - i1, j1 + 1, j2 - j1).as_bytes(),
+        );
+        out.extend_from_slice(&lineterm);
+        for opcode in group {
+            let (tag, i1, i2, j1, j2) = opcode.parts();
+            if tag == "equal" {
+                push_lines(&mut out, &a, i1, i2, b' ', bytes_mode)?;
+                continue;
+            }
+            if tag == "replace" || tag == "delete" {
+                push_lines(&mut out, &a, i1, i2, b'-', bytes_mode)?;
+            }
+            if tag == "replace" || tag == "insert" {
+                push_lines(&mut out, &b, j1, j2, b'+', bytes_mode)?;
+            }
+        }
+    }
+
+    if bytes_mode {
+        Ok(PyBytes::new(py, &out).into_any())
+    } else {
+        Ok(PyString::new(py, std::str::from_utf8(&out)?).into_any())
+    }
+}
+
+/// An iterator over the opcodes of a matcher, computed on demand.
+#[pyclass(name = "OpcodeIterator_rs")]
+struct OpcodeIterator {
+    opcodes: patience::Opcodes<Vec<(usize, usize, usize)>>,
+}
+
+#[pymethods]
+impl OpcodeIterator {
+    fn __iter__(slf: PyRef<'_, Self>) -> PyRef<'_, Self> {
+        slf
+    }
+
+    fn __next__<'py>(&mut self, py: Python<'py>) -> PyResult<Option<Bound<'py, PyTuple>>> {
+        self.opcodes
+            .next()
+            .map(|opcode| opcode_to_tuple(py, &opcode))
+            .transpose()
+    }
+}
+
+/// An iterator over the grouped opcodes of a matcher, computed on demand.
+#[pyclass(name = "GroupedOpcodeIterator_rs")]
+struct GroupedOpcodeIterator {
+    groups: patience::GroupedOpcodes<patience::Opcodes<Vec<(usize, usize, usize)>>>,
+}
+
+#[pymethods]
+impl GroupedOpcodeIterator {
+    fn __iter__(slf: PyRef<'_, Self>) -> PyRef<'_, Self> {
+        slf
+    }
+
+    fn __next__<'py>(&mut self, py: Python<'py>) -> PyResult<Option<Bound<'py, PyList>>> {
+        let group = match self.groups.next() {
+            Some(group) => group,
+            None => return Ok(None),
+        };
+        let result = PyList::empty(py);
+        for opcode in &group {
+            result.append(opcode_to_tuple(py, opcode)?)?;
+        }
+        Ok(Some(result))
+    }
+}
+
+/// A flag that stops the diffs using it once it is cancelled
+#[pyclass(name = "CancellationToken_rs", frozen)]
+#[derive(Default)]
+struct CancellationToken {
+    cancelled: Arc<AtomicBool>,
+}
+
+#[pymethods]
+impl CancellationToken {
+    #[new]
+    fn new() -> Self {
+        Self::default()
+    }
+
+    /// Stop the diffs using this token.
+    ///
+    /// This can be called from any thread, while they run without the GIL.
+    fn cancel(&self) {
+        self.cancelled.store(true, Ordering::Relaxed);
+    }
+
+    /// Whether cancel() has been called
+    #[getter]
+    fn cancelled(&self) -> bool {
+        self.cancelled.load(Ordering::Relaxed)
+    }
+}
+
 /// The PatienceSequenceMatcher class
 #[pyclass(name = "PatienceSequenceMatcher_rs")]
 struct PatienceSequenceMatcherRs {
-    matcher: patiencediff::SequenceMatcher<PyItem>,
+    a_seq: Py<PyAny>,
+    b_seq: Py<PyAny>,
+    a: Vec<u32>,
+    b: Vec<u32>,
+    /// The token table of the side that was kept by the last set_seq1()
+    /// or set_seq2() call, or of a if items are matched by key
+    index: Option<(Side, SideIndex)>,
+    /// What items are matched by, if not by themselves
+    key: Option<Py<PyAny>>,
+    /// Whether apply_edit_b() has been called, so outlines are kept
+    track_edits: bool,
+    /// The outline of the last diff, once edits are tracked
+    outline: Option<patience::Outline>,
+    /// The edits made to b since the outline was recorded
+    edit: Option<patience::Edit>,
+    /// Whether b_seq is a list owned by the matcher, which edits update
+    owns_b: bool,
+    matching_blocks: Option<Vec<(usize, usize, usize)>>,
+    #[pyo3(get)]
+    collect_stats: bool,
+    /// Whether regions without unique lines are anchored on their least
+    /// frequent lines
+    #[pyo3(get)]
+    histogram: bool,
+    /// How long computing the matching blocks may take
+    timeout: Option<Duration>,
+    /// The flag of the CancellationToken_rs that stops computing them
+    cancel: Option<Arc<AtomicBool>>,
+    /// Whether the matching blocks were cut short by timeout or cancel
+    #[pyo3(get)]
+    degraded: bool,
+    tokenize_time: Duration,
+    /// The DiffStats for the matching blocks, once they are computed
+    stats: Option<Py<PyAny>>,
+    /// Whether the stats hook has been called yet
+    reported: bool,
+}
+
+impl PatienceSequenceMatcherRs {
+    /// Compute the matching blocks on first use, without holding the GIL.
+    ///
+    /// If statistics are wanted, they are collected along the way.
+    fn blocks(&mut self, py: Python<'_>) -> PyResult<&[(usize, usize, usize)]> {
+        if self.matching_blocks.is_none() {
+            let module = py_module(py)?;
+            let (a, b) = (&self.a, &self.b);
+            let options = patience::Options::new(
+                self.histogram,
+                self.timeout
+                    .and_then(|timeout| Instant::now().checked_add(timeout)),
+                self.cancel.clone(),
+            );
+            let options = &options;
+            let edits = self
+                .track_edits
+                .then(|| (&mut self.outline, self.edit.take()));
+            if !self.collect_stats && module.getattr(intern!(py, "_stats_hook"))?.is_none() {
+                let (blocks, _) =
+                    py.detach(|| patience::matching_blocks_with_stats(a, b, options, None, edits));
+                self.degraded = options.stopped();
+                self.matching_blocks = Some(blocks);
+                return Ok(self.matching_blocks.as_deref().unwrap());
+            }
+            let (blocks, matches_bytes, stats, elapsed, unique_lines) = py.detach(|| {
+                let mut stats = patience::Stats::default();
+                let start = Instant::now();
+                let (blocks, matches_bytes) =
+                    patience::matching_blocks_with_stats(a, b, options, Some(&mut stats), edits);
+                let elapsed = start.elapsed();
+                (
+                    blocks,
+                    matches_bytes,
+                    stats,
+                    elapsed,
+                    patience::unique_lines(a, b),
+                )
+            });
+            let allocated = (a.capacity() + b.capacity()) * std::mem::size_of::<u32>()
+                + matches_bytes
+                + blocks.capacity() * std::mem::size_of::<(usize, usize, usize)>();
+            let diff_stats = module
+                .getattr(intern!(py, "DiffStats"))?
+                .call1((patience::MAX_RECURSION,))?;
+            diff_stats.setattr("lines_a", a.len())?;
+            diff_stats.setattr("lines_b", b.len())?;
+            diff_stats.setattr("tokenize_seconds", self.tokenize_time.as_secs_f64())?;
+            diff_stats.setattr("unique_lcs_seconds", stats.unique_lcs_time.as_secs_f64())?;
+            diff_stats.setattr(
+                "recursion_seconds",
+                elapsed.saturating_sub(stats.unique_lcs_time).as_secs_f64(),
+            )?;
+            diff_stats.setattr("unique_lcs_calls", stats.unique_lcs_calls)?;
+            diff_stats.setattr("max_depth", stats.max_depth)?;
+            diff_stats.setattr("unique_lines", unique_lines)?;
+            diff_stats.setattr("allocated_bytes", allocated)?;
+            self.stats = Some(diff_stats.unbind());
+            self.degraded = options.stopped();
+            self.matching_blocks = Some(blocks);
+        }
+        Ok(self.matching_blocks.as_deref().unwrap())
+    }
+
+    /// Forget the results for the previous pair of sequences.
+    fn reset(&mut self) {
+        self.matching_blocks = None;
+        self.stats = None;
+        self.reported = false;
+        self.outline = None;
+        self.edit = None;
+    }
+
+    /// Replace one side of the diff, only tokenizing the new sequence.
+    fn replace_side<'py>(
+        &mut self,
+        py: Python<'py>,
+        side: Side,
+        seq: Bound<'py, PyAny>,
+    ) -> PyResult<()> {
+        let start = Instant::now();
+        let key = self.key.as_ref().map(|key| key.bind(py).clone());
+        let kept_side = side.other();
+        let kept = match kept_side {
+            Side::A => self.a_seq.bind(py).clone(),
+            Side::B => self.b_seq.bind(py).clone(),
+        };
+        if !matches!(self.index, Some((indexed, _)) if indexed == kept_side) {
+            // The tokens of the kept side are renumbered along with its table
+            let (tokens, index) = SideIndex::build(&kept, key.as_ref())?;
+            match kept_side {
+                Side::A => self.a = tokens,
+                Side::B => self.b = tokens,
+            }
+            self.index = Some((kept_side, index));
+        }
+        let tokens = match &mut self.index {
+            Some((_, index)) => index.lookup(&seq)?,
+            None => None,
+        };
+        match (tokens, side) {
+            (Some(tokens), Side::A) => self.a = tokens,
+            (Some(tokens), Side::B) => self.b = tokens,
+            (None, _) => {
+                // The new sequence is of another kind than the kept one
+                let (a, b, index) = match side {
+                    Side::A => tokenize_sides(&seq, &kept, key.as_ref())?,
+                    Side::B => tokenize_sides(&kept, &seq, key.as_ref())?,
+                };
+                self.a = a;
+                self.b = b;
+                self.index = index;
+            }
+        }
+        match side {
+            Side::A => self.a_seq = seq.unbind(),
+            Side::B => {
+                self.b_seq = seq.unbind();
+                self.owns_b = false;
+            }
+        }
+        self.tokenize_time = start.elapsed();
+        self.reset();
+        Ok(())
+    }
+
+    /// Add the time since start to the conversion time in the statistics.
+    ///
+    /// The first time this is called, the statistics are also passed to
+    /// the stats hook.
+    fn record_conversion(&mut self, py: Python<'_>, start: Instant) -> PyResult<()> {
+        let stats = match &self.stats {
+            Some(stats) => stats.bind(py).clone(),
+            None => return Ok(()),
+        };
+        let name = intern!(py, "conversion_seconds");
+        let seconds: f64 = stats.getattr(name)?.extract()?;
+        stats.setattr(name, seconds + start.elapsed().as_secs_f64())?;
+        if !self.reported {
+            self.reported = true;
+            py_module(py)?
+                .getattr(intern!(py, "_report_stats"))?
+                .call1((stats,))?;
+        }
+        Ok(())
+    }
 }
 
 #[pymethods]
 impl PatienceSequenceMatcherRs {
     #[new]
-    fn new(py: Python<'_>, _junk: Option<Py<PyAny>>, a: Py<PyAny>, b: Py<PyAny>) -> PyResult<Self> {
-        // Extract sequences
-        let a_any = a.extract::<Bound<PyAny>>(py)?;
-        let b_any = b.extract::<Bound<PyAny>>(py)?;
-
-        // Convert to sequences
-        let a_seq = a_any.downcast::<PySequence>()?;
-        let b_seq = b_any.downcast::<PySequence>()?;
-
-        let a_len = a_seq.len()?;
-        let b_len = b_seq.len()?;
-
-        // Create PyItem sequences
-        let mut a_items = Vec::with_capacity(a_len);
-        let mut b_items = Vec::with_capacity(b_len);
-
-        // Check if all items are hashable before proceeding
-        for i in 0..a_len {
-            let item = a_seq.get_item(i)?;
-            // Try to hash the item to check if it's hashable
-            if let Err(e) = item.hash() {
-                if e.is_instance_of::<pyo3::exceptions::PyTypeError>(py) {
-                    return Err(pyo3::exceptions::PyTypeError::new_err("unhashable type"));
-                }
-                return Err(e);
-            }
-            a_items.push(PyItem(item.into()));
+    #[pyo3(signature = (
+        _junk, a, b, collect_stats=false, histogram=false, timeout=None, cancel=None,
+        key=None
+    ))]
+    fn new<'py>(
+        _junk: Option<Bound<'py, PyAny>>,
+        a: Bound<'py, PyAny>,
+        b: Bound<'py, PyAny>,
+        collect_stats: bool,
+        histogram: bool,
+        timeout: Option<f64>,
+        cancel: Option<Bound<'py, CancellationToken>>,
+        key: Option<Bound<'py, PyAny>>,
+    ) -> PyResult<Self> {
+        let timeout = timeout
+            .map(|seconds| {
+                Duration::try_from_secs_f64(seconds)
+                    .map_err(|_| PyValueError::new_err("timeout must be a number of seconds"))
+            })
+            .transpose()?;
+        // Hash every item once and diff the resulting tokens
+        let start = Instant::now();
+        let (a_tokens, b_tokens, index) = tokenize_sides(&a, &b, key.as_ref())?;
+
+        Ok(Self {
+            a_seq: a.unbind(),
+            b_seq: b.unbind(),
+            a: a_tokens,
+            b: b_tokens,
+            index,
+            key: key.map(Bound::unbind),
+            track_edits: false,
+            outline: None,
+            edit: None,
+            owns_b: false,
+            matching_blocks: None,
+            collect_stats,
+            histogram,
+            timeout,
+            cancel: cancel.map(|token| token.get().cancelled.clone()),
+            degraded: false,
+            tokenize_time: start.elapsed(),
+            stats: None,
+            reported: false,
+        })
+    }
+
+    /// Set the first sequence to be compared.
+    ///
+    /// The token table of the second sequence is kept, so that comparing
+    /// many sequences to the same second sequence only tokenizes each of
+    /// them.
+    fn set_seq1<'py>(&mut self, py: Python<'py>, a: Bound<'py, PyAny>) -> PyResult<()> {
+        if a.as_ptr() == self.a_seq.as_ptr() {
+            return Ok(());
         }
+        self.replace_side(py, Side::A, a)
+    }
 
-        for i in 0..b_len {
-            let item = b_seq.get_item(i)?;
-            // Try to hash the item to check if it's hashable
-            if let Err(e) = item.hash() {
-                if e.is_instance_of::<pyo3::exceptions::PyTypeError>(py) {
-                    return Err(pyo3::exceptions::PyTypeError::new_err("unhashable type"));
-                }
-                return Err(e);
+    /// Set the second sequence to be compared.
+    ///
+    /// The token table of the first sequence is kept, so that comparing
+    /// the same first sequence to many others only tokenizes each of them.
+    fn set_seq2<'py>(&mut self, py: Python<'py>, b: Bound<'py, PyAny>) -> PyResult<()> {
+        if b.as_ptr() == self.b_seq.as_ptr() {
+            return Ok(());
+        }
+        self.replace_side(py, Side::B, b)
+    }
+
+    /// Set both sequences to be compared.
+    fn set_seqs<'py>(&mut self, a: Bound<'py, PyAny>, b: Bound<'py, PyAny>) -> PyResult<()> {
+        let start = Instant::now();
+        let key = self.key.as_ref().map(|key| key.bind(a.py()).clone());
+        let (a_tokens, b_tokens, index) = tokenize_sides(&a, &b, key.as_ref())?;
+        self.a_seq = a.unbind();
+        self.b_seq = b.unbind();
+        self.owns_b = false;
+        self.a = a_tokens;
+        self.b = b_tokens;
+        self.index = index;
+        self.tokenize_time = start.elapsed();
+        self.reset();
+        Ok(())
+    }
+
+    /// Replace b[start:end] with items, updating the diff incrementally.
+    ///
+    /// Only the new items are tokenized, and the next diff only matches
+    /// the top-level gaps that were touched by edits again; the result is
+    /// the same as that of a fresh diff. b is copied into a list owned by
+    /// the matcher on the first edit.
+    fn apply_edit_b<'py>(
+        &mut self,
+        py: Python<'py>,
+        start: usize,
+        end: usize,
+        items: Bound<'py, PyAny>,
+    ) -> PyResult<()> {
+        if start > end || end > self.b.len() {
+            return Err(PyIndexError::new_err("edit out of range"));
+        }
+        let begin = Instant::now();
+        if !self.owns_b {
+            self.b_seq = PyList::new(
+                py,
+                self.b_seq
+                    .bind(py)
+                    .try_iter()?
+                    .collect::<PyResult<Vec<_>>>()?,
+            )?
+            .into_any()
+            .unbind();
+            self.owns_b = true;
+        }
+        let b_list = self.b_seq.bind(py).downcast::<PyList>()?.clone();
+        let key = self.key.as_ref().map(|key| key.bind(py).clone());
+        if !matches!(self.index, Some((Side::A, _))) {
+            let (a_tokens, mut index) = SideIndex::build(self.a_seq.bind(py), key.as_ref())?;
+            if let Some(b_tokens) = index.lookup(b_list.as_any())? {
+                self.a = a_tokens;
+                self.b = b_tokens;
+                self.index = Some((Side::A, index));
+            }
+        }
+        let tokens = match &mut self.index {
+            Some((Side::A, index)) => index.lookup(&items)?,
+            _ => None,
+        };
+        let len = items.len()?;
+        b_list.set_slice(start, end, &items)?;
+        match tokens {
+            Some(tokens) => {
+                self.b.splice(start..end, tokens);
+            }
+            None => {
+                // The new items can not be looked up in the table of a
+                let (a_tokens, b_tokens, index) =
+                    tokenize_sides(self.a_seq.bind(py), b_list.as_any(), key.as_ref())?;
+                self.a = a_tokens;
+                self.b = b_tokens;
+                self.index = index;
             }
-            b_items.push(PyItem(item.into()));
         }
+        let (outline, edit) = (self.outline.take(), self.edit);
+        self.reset();
+        if self.track_edits {
+            self.outline = outline;
+            self.edit = Some(patience::Edit::replace(edit, start, end, len));
+        }
+        self.track_edits = true;
+        self.tokenize_time = begin.elapsed();
+        Ok(())
+    }
 
-        // Create and return the matcher
-        let matcher = patiencediff::SequenceMatcher::new(&a_items, &b_items);
+    /// What items are matched by, if not by themselves.
+    #[getter]
+    fn key(&self, py: Python<'_>) -> Option<Py<PyAny>> {
+        self.key.as_ref().map(|key| key.clone_ref(py))
+    }
 
-        Ok(Self { matcher })
+    /// The DiffStats for this diff, if they were collected.
+    #[getter]
+    fn stats(&self, py: Python<'_>) -> Option<Py<PyAny>> {
+        self.stats.as_ref().map(|stats| stats.clone_ref(py))
     }
 
     /// Return list of triples describing matching subsequences.
@@ -223,25 +1565,86 @@ impl PatienceSequenceMatcherRs {
     /// The last triple is a dummy, (len(a), len(b), 0), and is the only
     /// triple with n==0.
     fn get_matching_blocks<'py>(&mut self, py: Python<'py>) -> PyResult<Bound<'py, PyList>> {
-        // Get matching blocks from the matcher
-        let blocks = self.matcher.get_matching_blocks();
+        let blocks = self.blocks(py)?.to_vec();
+        let start = Instant::now();
 
-        // Import difflib.Match
-        let difflib = py.import("difflib")?;
-        let match_class = difflib.getattr("Match")?;
+        let match_class = MATCH.import(py, "difflib", "Match")?;
 
         // Convert blocks to Python list
         let result = PyList::empty(py);
 
-        for &(a, b, size) in blocks {
+        for &(a, b, size) in &blocks {
             // Create a Match named tuple instead of a regular tuple
             let match_obj = match_class.call1((a, b, size))?;
             result.append(match_obj)?;
         }
 
+        self.record_conversion(py, start)?;
+        Ok(result)
+    }
+
+    /// Return the matching blocks as a compact MatchArray.
+    fn get_matching_blocks_array<'py>(&mut self, py: Python<'py>) -> PyResult<Bound<'py, PyAny>> {
+        let blocks = self.blocks(py)?;
+        let start = Instant::now();
+        let values: Vec<i64> = blocks
+            .iter()
+            .flat_map(|&(a, b, size)| [a as i64, b as i64, size as i64])
+            .collect();
+        let class = MATCH_ARRAY.import(py, "patiencediff._patiencediff_py", "MatchArray")?;
+        let result = class.call1((int64_array(py, &values)?,))?;
+        self.record_conversion(py, start)?;
         Ok(result)
     }
 
+    /// Return the opcodes as a compact OpcodeArray.
+    ///
+    /// No tuple or string is created per opcode.
+    fn get_opcodes_array<'py>(&mut self, py: Python<'py>) -> PyResult<Bound<'py, PyAny>> {
+        let opcodes = patience::opcodes(self.blocks(py)?);
+        let start = Instant::now();
+        let values: Vec<i64> = opcodes
+            .iter()
+            .flat_map(|opcode| {
+                let (_, i1, i2, j1, j2) = opcode.parts();
+                [opcode.code(), i1 as i64, i2 as i64, j1 as i64, j2 as i64]
+            })
+            .collect();
+        let class = OPCODE_ARRAY.import(py, "patiencediff._patiencediff_py", "OpcodeArray")?;
+        let result = class.call1((int64_array(py, &values)?,))?;
+        self.record_conversion(py, start)?;
+        Ok(result)
+    }
+
+    /// Return an iterator over the opcodes to turn a into b.
+    ///
+    /// This produces the same opcodes as get_opcodes(), but computes them
+    /// from the matching blocks on demand.
+    fn iter_opcodes(&mut self, py: Python<'_>) -> PyResult<OpcodeIterator> {
+        let blocks = self.blocks(py)?.to_vec();
+        self.record_conversion(py, Instant::now())?;
+        Ok(OpcodeIterator {
+            opcodes: patience::Opcodes::new(blocks),
+        })
+    }
+
+    /// Return an iterator over groups with up to n lines of context.
+    ///
+    /// This produces the same groups as get_grouped_opcodes(), but computes
+    /// them from the matching blocks on demand.
+    fn iter_grouped_opcodes(
+        &mut self,
+        py: Python<'_>,
+        n: Option<usize>,
+    ) -> PyResult<GroupedOpcodeIterator> {
+        let n = n.unwrap_or(3);
+        let opcodes = patience::Opcodes::new(self.blocks(py)?.to_vec());
+        self.record_conversion(py, Instant::now())?;
+        Ok(GroupedOpcodeIterator {
+            groups: patience::GroupedOpcodes::new(opcodes, n),
+        })
+    }
+
     /// Return list of 5-tuples describing how to turn a into b.
     ///
     /// Each tuple is of the form (tag, i1, i2, j1, j2).  The first tuple
@@ -257,69 +1660,18 @@ impl PatienceSequenceMatcherRs {
     ///                Note that i1==i2 in this case.
     /// 'equal':    a[i1:i2] == b[j1:j2]
     fn get_opcodes<'py>(&mut self, py: Python<'py>) -> PyResult<Bound<'py, PyList>> {
-        // Get opcodes directly from the matcher
-        let opcodes = self.matcher.get_opcodes();
+        let blocks = self.blocks(py)?;
+        let opcodes = patience::opcodes(blocks);
+        let start = Instant::now();
 
         // Convert opcodes to Python list
         let result = PyList::empty(py);
 
-        for opcode in opcodes {
-            match opcode {
-                patiencediff::Opcode::Equal(i1, i2, j1, j2) => {
-                    let tuple = PyTuple::new(
-                        py,
-                        &[
-                            "equal".into_pyobject(py)?.into_any().unbind(),
-                            i1.into_pyobject(py)?.into_any().unbind(),
-                            i2.into_pyobject(py)?.into_any().unbind(),
-                            j1.into_pyobject(py)?.into_any().unbind(),
-                            j2.into_pyobject(py)?.into_any().unbind(),
-                        ],
-                    )?;
-                    result.append(tuple)?;
-                }
-                patiencediff::Opcode::Replace(i1, i2, j1, j2) => {
-                    let tuple = PyTuple::new(
-                        py,
-                        &[
-                            "replace".into_pyobject(py)?.into_any().unbind(),
-                            i1.into_pyobject(py)?.into_any().unbind(),
-                            i2.into_pyobject(py)?.into_any().unbind(),
-                            j1.into_pyobject(py)?.into_any().unbind(),
-                            j2.into_pyobject(py)?.into_any().unbind(),
-                        ],
-                    )?;
-                    result.append(tuple)?;
-                }
-                patiencediff::Opcode::Delete(i1, i2, j1, j2) => {
-                    let tuple = PyTuple::new(
-                        py,
-                        &[
-                            "delete".into_pyobject(py)?.into_any().unbind(),
-                            i1.into_pyobject(py)?.into_any().unbind(),
-                            i2.into_pyobject(py)?.into_any().unbind(),
-                            j1.into_pyobject(py)?.into_any().unbind(),
-                            j2.into_pyobject(py)?.into_any().unbind(),
-                        ],
-                    )?;
-                    result.append(tuple)?;
-                }
-                patiencediff::Opcode::Insert(i1, i2, j1, j2) => {
-                    let tuple = PyTuple::new(
-                        py,
-                        &[
-                            "insert".into_pyobject(py)?.into_any().unbind(),
-                            i1.into_pyobject(py)?.into_any().unbind(),
-                            i2.into_pyobject(py)?.into_any().unbind(),
-                            j1.into_pyobject(py)?.into_any().unbind(),
-                            j2.into_pyobject(py)?.into_any().unbind(),
-                        ],
-                    )?;
-                    result.append(tuple)?;
-                }
-            }
+        for opcode in &opcodes {
+            result.append(opcode_to_tuple(py, opcode)?)?;
         }
 
+        self.record_conversion(py, start)?;
         Ok(result)
     }
 
@@ -333,43 +1685,13 @@ impl PatienceSequenceMatcherRs {
     ) -> PyResult<Bound<'py, PyList>> {
         let n = n.unwrap_or(3);
 
-        // Get grouped opcodes directly from the matcher
-        let grouped_opcodes = self.matcher.get_grouped_opcodes(n);
+        let blocks = self.blocks(py)?;
+        let grouped_opcodes = patience::grouped_opcodes(&patience::opcodes(blocks), n);
+        let start = Instant::now();
 
         // Convert to Python list
-        let result = PyList::empty(py);
-
-        for group in grouped_opcodes {
-            let group_list = PyList::empty(py);
-
-            for opcode in group {
-                let (tag, i1, i2, j1, j2) = match opcode {
-                    patiencediff::Opcode::Equal(i1, i2, j1, j2) => ("equal", i1, i2, j1, j2),
-                    patiencediff::Opcode::Replace(i1, i2, j1, j2) => ("replace", i1, i2, j1, j2),
-                    patiencediff::Opcode::Delete(i1, i2, j1, j2) => ("delete", i1, i2, j1, j2),
-                    patiencediff::Opcode::Insert(i1, i2, j1, j2) => ("insert", i1, i2, j1, j2),
-                };
-
-                let tuple = PyTuple::new(
-                    py,
-                    &[
-                        tag.into_pyobject(py)?.into_any().unbind(),
-                        i1.into_pyobject(py)?.into_any().unbind(),
-                        i2.into_pyobject(py)?.into_any().unbind(),
-                        j1.into_pyobject(py)?.into_any().unbind(),
-                        j2.into_pyobject(py)?.into_any().unbind(),
-                    ],
-                )?;
-
-                group_list.append(tuple)?;
-            }
-
-            if group_list.len() > 0 {
-                result.append(group_list)?;
-            }
-        }
-
-        // Note: We're not adding a default group for empty result anymore
+        let result = grouped_opcodes_to_list(py, &grouped_opcodes)?;
+        self.record_conversion(py, start)?;
         Ok(result)
     }
 }
@@ -377,7 +1699,16 @@ impl PatienceSequenceMatcherRs {
 #[pymodule]
 fn _patiencediff_rs(m: &Bound<'_, PyModule>) -> PyResult<()> {
     m.add_class::<PatienceSequenceMatcherRs>()?;
+    m.add_class::<CancellationToken>()?;
+    m.add_class::<ByteLines>()?;
+    m.add_class::<OpcodeIterator>()?;
+    m.add_class::<GroupedOpcodeIterator>()?;
     m.add_function(wrap_pyfunction!(unique_lcs_rs, m)?)?;
     m.add_function(wrap_pyfunction!(recurse_matches_rs, m)?)?;
+    m.add_function(wrap_pyfunction!(diff_many_rs, m)?)?;
+    m.add_function(wrap_pyfunction!(merge_regions_rs, m)?)?;
+    m.add_function(wrap_pyfunction!(refine_opcodes_rs, m)?)?;
+    m.add_function(wrap_pyfunction!(split_lines_rs, m)?)?;
+    m.add_function(wrap_pyfunction!(render_unified_rs, m)?)?;
     Ok(())
 }
@@ -0,0 +1,1072 @@
+//! Patience diff over integer tokens.
+//!
+//! This follows the pure Python implementation in _patiencediff_py.py
+//! step by step, but works on the dense tokens produced by the bindings,
+//! so it never touches Python objects and can run with the GIL released.
+//! Once the anchors of a region are known, the gaps between them are
+//! independent of each other and are matched in parallel on the rayon
+//! pool; the results are stitched back together in order, so they are
+//! identical to those of a serial run.
+
+use std::collections::HashMap;
+use std::hash::{BuildHasherDefault, Hasher};
+use std::sync::atomic::{AtomicBool, Ordering};
+use std::sync::Arc;
+use std::time::{Duration, Instant};
+
+use rayon::prelude::*;
+
+/// The recursion budget used by get_matching_blocks().
+pub const MAX_RECURSION: i32 = 10;
+
+/// How to match a and b, and when to stop.
+#[derive(Debug, Default)]
+pub struct Options {
+    /// Anchor regions without unique lines on their least frequent lines
+    pub histogram: bool,
+    /// Stop matching once this time has passed
+    pub deadline: Option<Instant>,
+    /// Stop matching once this is set, from any thread
+    pub cancel: Option<Arc<AtomicBool>>,
+    /// Whether matching has been stopped
+    stopped: AtomicBool,
+}
+
+impl Options {
+    pub fn new(
+        histogram: bool,
+        deadline: Option<Instant>,
+        cancel: Option<Arc<AtomicBool>>,
+    ) -> Self {
+        Self {
+            histogram,
+            deadline,
+            cancel,
+            stopped: AtomicBool::new(false),
+        }
+    }
+
+    /// Check whether matching should stop, remembering if it should.
+    fn expired(&self) -> bool {
+        if self.stopped() {
+            return true;
+        }
+        let expired = self
+            .deadline
+            .is_some_and(|deadline| Instant::now() >= deadline)
+            || self
+                .cancel
+                .as_ref()
+                .is_some_and(|cancel| cancel.load(Ordering::Relaxed));
+        if expired {
+            self.stopped.store(true, Ordering::Relaxed);
+        }
+        expired
+    }
+
+    /// Whether matching was stopped, so that the result is incomplete.
+    pub fn stopped(&self) -> bool {
+        self.stopped.load(Ordering::Relaxed)
+    }
+}
+
+/// Regions with fewer items than this (on both sides combined) have their
+/// gaps matched serially, as farming them out would cost more than it
+/// saves.
+const PARALLEL_THRESHOLD: usize = 1 << 14;
+
+/// A cheap hasher for tokens, which are already small dense integers.
+#[derive(Default)]
+struct TokenHasher(u64);
+
+impl Hasher for TokenHasher {
+    fn finish(&self) -> u64 {
+        self.0
+    }
+
+    fn write(&mut self, bytes: &[u8]) {
+        for &byte in bytes {
+            self.0 = (self.0.rotate_left(5) ^ byte as u64).wrapping_mul(0x517c_c1b7_2722_0a95);
+        }
+    }
+
+    fn write_u32(&mut self, i: u32) {
+        self.0 = (i as u64).wrapping_mul(0x9e37_79b9_7f4a_7c15);
+    }
+}
+
+type TokenMap<V> = HashMap<u32, V, BuildHasherDefault<TokenHasher>>;
+
+/// What recurse_matches() did, for DiffStats on the Python side.
+#[derive(Debug, Default, Clone, Copy)]
+pub struct Stats {
+    pub unique_lcs_calls: usize,
+    /// Time spent in unique_lcs, summed over all threads
+    pub unique_lcs_time: Duration,
+    /// The deepest recursion reached, counting from the top level
+    pub max_depth: i32,
+}
+
+impl Stats {
+    fn merge(&mut self, other: &Stats) {
+        self.unique_lcs_calls += other.unique_lcs_calls;
+        self.unique_lcs_time += other.unique_lcs_time;
+        self.max_depth = self.max_depth.max(other.max_depth);
+    }
+}
+
+/// A difflib-style opcode: (tag, i1, i2, j1, j2).
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+pub enum Opcode {
+    Equal(usize, usize, usize, usize),
+    Replace(usize, usize, usize, usize),
+    Delete(usize, usize, usize, usize),
+    Insert(usize, usize, usize, usize),
+}
+
+impl Opcode {
+    /// Split the opcode into its (tag, i1, i2, j1, j2) parts.
+    pub fn parts(&self) -> (&'static str, usize, usize, usize, usize) {
+        match *self {
+            Opcode::Equal(i1, i2, j1, j2) => ("equal", i1, i2, j1, j2),
+            Opcode::Replace(i1, i2, j1, j2) => ("replace", i1, i2, j1, j2),
+            Opcode::Delete(i1, i2, j1, j2) => ("delete", i1, i2, j1, j2),
+            Opcode::Insert(i1, i2, j1, j2) => ("insert", i1, i2, j1, j2),
+        }
+    }
+
+    /// The tag as an index into OpcodeArray.tags on the Python side.
+    pub fn code(&self) -> i64 {
+        match self {
+            Opcode::Equal(..) => 0,
+            Opcode::Replace(..) => 1,
+            Opcode::Delete(..) => 2,
+            Opcode::Insert(..) => 3,
+        }
+    }
+
+    fn is_equal(&self) -> bool {
+        matches!(self, Opcode::Equal(..))
+    }
+
+    fn with_bounds(&self, i1: usize, i2: usize, j1: usize, j2: usize) -> Opcode {
+        match self {
+            Opcode::Equal(..) => Opcode::Equal(i1, i2, j1, j2),
+            Opcode::Replace(..) => Opcode::Replace(i1, i2, j1, j2),
+            Opcode::Delete(..) => Opcode::Delete(i1, i2, j1, j2),
+            Opcode::Insert(..) => Opcode::Insert(i1, i2, j1, j2),
+        }
+    }
+}
+
+/// Find the longest common subset for unique lines.
+///
+/// Returns (position in a, position in b) pairs for the lines which
+/// occur exactly once on both sides, chosen with the Patience Sorting
+/// algorithm: http://en.wikipedia.org/wiki/Patience_sorting
+pub fn unique_lcs(a: &[u32], b: &[u32]) -> Vec<(usize, usize)> {
+    // index[line in a] = position of line in a, unless a is a duplicate,
+    // in which case it's set to None
+    let mut index: TokenMap<Option<usize>> = TokenMap::default();
+    for (i, &line) in a.iter().enumerate() {
+        index
+            .entry(line)
+            .and_modify(|pos| *pos = None)
+            .or_insert(Some(i));
+    }
+    // btoa[i] = position of line i in a, unless that line doesn't occur
+    // exactly once in both, in which case it's set to None
+    let mut btoa: Vec<Option<usize>> = vec![None; b.len()];
+    let mut index2: TokenMap<usize> = TokenMap::default();
+    for (pos, &line) in b.iter().enumerate() {
+        if let Some(&Some(next)) = index.get(&line) {
+            if let Some(&previous) = index2.get(&line) {
+                // unset the previous mapping, which we now know to be
+                // invalid because the line isn't unique
+                btoa[previous] = None;
+                index.remove(&line);
+            } else {
+                index2.insert(line, pos);
+                btoa[pos] = Some(next);
+            }
+        }
+    }
+    patience_sort(&btoa)
+}
+
+/// Find the anchors of a region: its unique lines, or with `histogram` its
+/// least frequent lines if it has no unique ones.
+fn anchor_lcs(a: &[u32], b: &[u32], histogram: bool) -> Vec<(usize, usize)> {
+    let anchors = unique_lcs(a, b);
+    if anchors.is_empty() && histogram {
+        return low_occurrence_lcs(a, b);
+    }
+    anchors
+}
+
+/// Find the longest increasing run of a positions in btoa.
+fn patience_sort(btoa: &[Option<usize>]) -> Vec<(usize, usize)> {
+    let mut backpointers: Vec<Option<usize>> = vec![None; btoa.len()];
+    let mut stacks: Vec<usize> = Vec::new();
+    let mut lasts: Vec<usize> = Vec::new();
+    let mut k = 0;
+    for (bpos, apos) in btoa.iter().enumerate() {
+        let apos = match *apos {
+            Some(apos) => apos,
+            None => continue,
+        };
+        if !stacks.is_empty() && stacks[stacks.len() - 1] < apos {
+            // as an optimization, check if the next line comes at the
+            // end, because it usually does
+            k = stacks.len();
+        } else if !stacks.is_empty()
+            && stacks[k] < apos
+            && (k == stacks.len() - 1 || stacks[k + 1] > apos)
+        {
+            // as an optimization, check if the next line comes right
+            // after the previous line, because usually it does
+            k += 1;
+        } else {
+            k = stacks.partition_point(|&top| top <= apos);
+        }
+        if k > 0 {
+            backpointers[bpos] = Some(lasts[k - 1]);
+        }
+        if k < stacks.len() {
+            stacks[k] = apos;
+            lasts[k] = bpos;
+        } else {
+            stacks.push(apos);
+            lasts.push(bpos);
+        }
+    }
+    let mut result = Vec::new();
+    let mut m = lasts.last().copied();
+    while let Some(bpos) = m {
+        result.push((btoa[bpos].unwrap(), bpos));
+        m = backpointers[bpos];
+    }
+    result.reverse();
+    result
+}
+
+/// Find the longest common subset for the least frequent lines.
+///
+/// This is what histogram anchoring falls back to in regions without
+/// unique lines: of the lines that occur equally often on both sides,
+/// those that occur least often are paired up in order, and the longest
+/// increasing run of the pairs is chosen with patience sorting.
+pub fn low_occurrence_lcs(a: &[u32], b: &[u32]) -> Vec<(usize, usize)> {
+    let mut counts: TokenMap<(usize, usize)> = TokenMap::default();
+    for &line in a {
+        counts.entry(line).or_default().0 += 1;
+    }
+    for &line in b {
+        if let Some(count) = counts.get_mut(&line) {
+            count.1 += 1;
+        }
+    }
+    let best = match counts.values().filter(|c| c.0 == c.1).map(|c| c.0).min() {
+        Some(best) => best,
+        None => return Vec::new(),
+    };
+    // positions[line] = the positions of a candidate line in a
+    let mut positions: TokenMap<Vec<usize>> = TokenMap::default();
+    for (i, &line) in a.iter().enumerate() {
+        if counts[&line] == (best, best) {
+            positions.entry(line).or_default().push(i);
+        }
+    }
+    let mut seen: TokenMap<usize> = TokenMap::default();
+    let btoa: Vec<Option<usize>> = b
+        .iter()
+        .map(|line| {
+            let found = positions.get(line)?;
+            let k = seen.entry(*line).or_default();
+            *k += 1;
+            Some(found[*k - 1])
+        })
+        .collect();
+    patience_sort(&btoa)
+}
+
+/// Return the number of tokens that occur exactly once in a and in b.
+pub fn unique_lines(a: &[u32], b: &[u32]) -> usize {
+    let mut counts: TokenMap<(u8, u8)> = TokenMap::default();
+    for &line in a {
+        let count = counts.entry(line).or_default();
+        count.0 = count.0.saturating_add(1);
+    }
+    for &line in b {
+        if let Some(count) = counts.get_mut(&line) {
+            count.1 = count.1.saturating_add(1);
+        }
+    }
+    counts.values().filter(|&&count| count == (1, 1)).count()
+}
+
+/// Find all of the matching lines in a[alo:ahi] and b[blo:bhi].
+///
+/// Matches are appended to answer as (line in a, line in b) pairs, in
+/// increasing order. Returns false if maxrecursion was exhausted, in
+/// which case the regions that were too deep are left unmatched, or if
+/// matching was stopped by options, in which case the regions that were
+/// not matched yet are left unmatched. If stats is given, the unique_lcs
+/// calls and the depth reached below `depth` are recorded in it.
+#[allow(clippy::too_many_arguments)]
+pub fn recurse_matches(
+    a: &[u32],
+    b: &[u32],
+    alo: usize,
+    blo: usize,
+    ahi: usize,
+    bhi: usize,
+    answer: &mut Vec<(usize, usize)>,
+    maxrecursion: i32,
+    options: &Options,
+    mut stats: Option<&mut Stats>,
+    depth: i32,
+) -> bool {
+    if maxrecursion < 0 || options.expired() {
+        return false;
+    }
+    if alo == ahi || blo == bhi {
+        return true;
+    }
+
+    let start = stats.as_ref().map(|_| Instant::now());
+    let anchors: Vec<(usize, usize)> = anchor_lcs(&a[alo..ahi], &b[blo..bhi], options.histogram)
+        .into_iter()
+        .map(|(apos, bpos)| (apos + alo, bpos + blo))
+        .collect();
+    if let (Some(stats), Some(start)) = (stats.as_deref_mut(), start) {
+        stats.unique_lcs_time += start.elapsed();
+        stats.unique_lcs_calls += 1;
+        stats.max_depth = stats.max_depth.max(depth);
+    }
+
+    if anchors.is_empty() {
+        return match_ends(
+            a,
+            b,
+            alo,
+            blo,
+            ahi,
+            bhi,
+            answer,
+            maxrecursion,
+            options,
+            stats,
+            depth,
+        );
+    }
+    let gaps = anchor_gaps(&anchors, (alo, blo, ahi, bhi));
+    let last = gaps.len() - 1;
+
+    let recurse_gap =
+        |i: usize, answer: &mut Vec<(usize, usize)>, stats: Option<&mut Stats>| -> bool {
+            let (gap_alo, gap_blo, gap_ahi, gap_bhi) = gaps[i];
+            // Most of the time, consecutive anchors have nothing between
+            // them
+            if i != last && gap_alo == gap_ahi && gap_blo == gap_bhi {
+                return true;
+            }
+            recurse_matches(
+                a,
+                b,
+                gap_alo,
+                gap_blo,
+                gap_ahi,
+                gap_bhi,
+                answer,
+                maxrecursion - 1,
+                options,
+                stats,
+                depth + 1,
+            )
+        };
+
+    let mut ok = true;
+    if (ahi - alo) + (bhi - blo) >= PARALLEL_THRESHOLD {
+        let collect_stats = stats.is_some();
+        let results: Vec<(bool, Vec<(usize, usize)>, Stats)> = (0..gaps.len())
+            .into_par_iter()
+            .map(|i| {
+                let mut matches = Vec::new();
+                let mut gap_stats = Stats::default();
+                let gap_ok = recurse_gap(i, &mut matches, collect_stats.then_some(&mut gap_stats));
+                (gap_ok, matches, gap_stats)
+            })
+            .collect();
+        for (i, (gap_ok, matches, gap_stats)) in results.into_iter().enumerate() {
+            ok &= gap_ok;
+            answer.extend(matches);
+            if let Some(stats) = stats.as_deref_mut() {
+                stats.merge(&gap_stats);
+            }
+            if i != last {
+                answer.push(anchors[i]);
+            }
+        }
+    } else {
+        for i in 0..gaps.len() {
+            ok &= recurse_gap(i, answer, stats.as_deref_mut());
+            if i != last {
+                answer.push(anchors[i]);
+            }
+        }
+    }
+    ok
+}
+
+/// A region of a and b, as (alo, blo, ahi, bhi).
+type Region = (usize, usize, usize, usize);
+
+/// Return the gaps before every anchor in a region and after the last one.
+///
+/// Each of them is matched on its own.
+fn anchor_gaps(anchors: &[(usize, usize)], (alo, blo, ahi, bhi): Region) -> Vec<Region> {
+    let mut gaps = Vec::with_capacity(anchors.len() + 1);
+    let (mut next_a, mut next_b) = (alo, blo);
+    for &(apos, bpos) in anchors {
+        gaps.push((next_a, next_b, apos, bpos));
+        next_a = apos + 1;
+        next_b = bpos + 1;
+    }
+    gaps.push((next_a, next_b, ahi, bhi));
+    gaps
+}
+
+/// Match a region without anchors, from its first and last lines inwards.
+#[allow(clippy::too_many_arguments)]
+fn match_ends(
+    a: &[u32],
+    b: &[u32],
+    alo: usize,
+    blo: usize,
+    ahi: usize,
+    bhi: usize,
+    answer: &mut Vec<(usize, usize)>,
+    maxrecursion: i32,
+    options: &Options,
+    stats: Option<&mut Stats>,
+    depth: i32,
+) -> bool {
+    if a[alo] == b[blo] {
+        // find matching lines at the very beginning
+        let (mut alo, mut blo) = (alo, blo);
+        while alo < ahi && blo < bhi && a[alo] == b[blo] {
+            answer.push((alo, blo));
+            alo += 1;
+            blo += 1;
+        }
+        recurse_matches(
+            a,
+            b,
+            alo,
+            blo,
+            ahi,
+            bhi,
+            answer,
+            maxrecursion - 1,
+            options,
+            stats,
+            depth + 1,
+        )
+    } else if a[ahi - 1] == b[bhi - 1] {
+        // find matching lines at the very end
+        let (mut nahi, mut nbhi) = (ahi - 1, bhi - 1);
+        while nahi > alo && nbhi > blo && a[nahi - 1] == b[nbhi - 1] {
+            nahi -= 1;
+            nbhi -= 1;
+        }
+        let ok = recurse_matches(
+            a,
+            b,
+            alo,
+            blo,
+            nahi,
+            nbhi,
+            answer,
+            maxrecursion - 1,
+            options,
+            stats,
+            depth + 1,
+        );
+        for i in 0..(ahi - nahi) {
+            answer.push((nahi + i, nbhi + i));
+        }
+        ok
+    } else {
+        true
+    }
+}
+
+/// The matches found in every top-level gap of a diff.
+///
+/// Once b has been edited, the gaps that the edit did not touch are
+/// reused rather than matched again; a gap's matches only depend on the
+/// lines inside it.
+#[derive(Debug, Default)]
+pub struct Outline {
+    gaps: HashMap<Region, Vec<(usize, usize)>>,
+}
+
+/// The part of b that changed since an Outline was recorded.
+///
+/// b[lo:hi] may have changed, and every line from hi onwards was
+/// `shift` lines earlier.
+#[derive(Debug, Clone, Copy)]
+pub struct Edit {
+    lo: usize,
+    hi: usize,
+    shift: isize,
+}
+
+impl Edit {
+    /// Add the replacement of b[start:end] with len lines to an edit.
+    pub fn replace(previous: Option<Edit>, start: usize, end: usize, len: usize) -> Edit {
+        let change = len as isize - (end - start) as isize;
+        let (lo, hi, shift) = match previous {
+            Some(edit) => (edit.lo.min(start), edit.hi.max(end), edit.shift),
+            None => (start, end, 0),
+        };
+        Edit {
+            lo,
+            hi: (hi as isize + change) as usize,
+            shift: shift + change,
+        }
+    }
+
+    /// Return where a region was before the edit, if the edit left it alone.
+    fn before(&self, (alo, blo, ahi, bhi): Region) -> Option<Region> {
+        if bhi <= self.lo {
+            Some((alo, blo, ahi, bhi))
+        } else if blo >= self.hi {
+            let shift = |pos: usize| (pos as isize - self.shift) as usize;
+            Some((alo, shift(blo), ahi, shift(bhi)))
+        } else {
+            None
+        }
+    }
+}
+
+/// Find all of the matching lines in a and b, keeping an outline.
+///
+/// This matches what recurse_matches() finds for all of a and b, but the
+/// gaps of a previous outline which were not touched by an edit are
+/// reused. Returns the new outline, or None if there were no anchors.
+fn outline_matches(
+    a: &[u32],
+    b: &[u32],
+    answer: &mut Vec<(usize, usize)>,
+    options: &Options,
+    mut stats: Option<&mut Stats>,
+    previous: Option<(&Outline, Edit)>,
+) -> Option<Outline> {
+    if a.is_empty() || b.is_empty() {
+        return None;
+    }
+    let start = stats.as_ref().map(|_| Instant::now());
+    let anchors = anchor_lcs(a, b, options.histogram);
+    if let (Some(stats), Some(start)) = (stats.as_deref_mut(), start) {
+        stats.unique_lcs_time += start.elapsed();
+        stats.unique_lcs_calls += 1;
+    }
+    if anchors.is_empty() {
+        match_ends(
+            a,
+            b,
+            0,
+            0,
+            a.len(),
+            b.len(),
+            answer,
+            MAX_RECURSION,
+            options,
+            stats,
+            0,
+        );
+        return None;
+    }
+    let gaps = anchor_gaps(&anchors, (0, 0, a.len(), b.len()));
+    let last = gaps.len() - 1;
+
+    let match_gap = |gap: Region, stats: Option<&mut Stats>| -> Vec<(usize, usize)> {
+        if let Some((outline, edit)) = previous {
+            if let Some(matches) = edit.before(gap).and_then(|old| outline.gaps.get(&old)) {
+                let shift = if gap.3 <= edit.lo { 0 } else { edit.shift };
+                return matches
+                    .iter()
+                    .map(|&(apos, bpos)| (apos, (bpos as isize + shift) as usize))
+                    .collect();
+            }
+        }
+        let mut matches = Vec::new();
+        recurse_matches(
+            a,
+            b,
+            gap.0,
+            gap.1,
+            gap.2,
+            gap.3,
+            &mut matches,
+            MAX_RECURSION - 1,
+            options,
+            stats,
+            1,
+        );
+        matches
+    };
+
+    let collect_stats = stats.is_some();
+    let results: Vec<(Vec<(usize, usize)>, Stats)> = if a.len() + b.len() >= PARALLEL_THRESHOLD {
+        gaps.clone()
+            .into_par_iter()
+            .map(|gap| {
+                let mut gap_stats = Stats::default();
+                let matches = match_gap(gap, collect_stats.then_some(&mut gap_stats));
+                (matches, gap_stats)
+            })
+            .collect()
+    } else {
+        gaps.iter()
+            .map(|&gap| {
+                let mut gap_stats = Stats::default();
+                let matches = match_gap(gap, collect_stats.then_some(&mut gap_stats));
+                (matches, gap_stats)
+            })
+            .collect()
+    };
+    let mut outline = Outline::default();
+    for (i, (matches, gap_stats)) in results.into_iter().enumerate() {
+        answer.extend_from_slice(&matches);
+        if let Some(stats) = stats.as_deref_mut() {
+            stats.merge(&gap_stats);
+        }
+        if i != last {
+            answer.push(anchors[i]);
+        }
+        outline.gaps.insert(gaps[i], matches);
+    }
+    Some(outline)
+}
+
+/// Find regions where consecutive matches increment on both sides.
+///
+/// Returns (start in a, start in b, length) triples.
+fn collapse_sequences(matches: &[(usize, usize)]) -> Vec<(usize, usize, usize)> {
+    let mut answer = Vec::new();
+    let mut current: Option<(usize, usize, usize)> = None;
+    for &(i_a, i_b) in matches {
+        if let Some((start_a, start_b, length)) = current {
+            if i_a == start_a + length && i_b == start_b + length {
+                current = Some((start_a, start_b, length + 1));
+                continue;
+            }
+            answer.push((start_a, start_b, length));
+        }
+        current = Some((i_a, i_b, 1));
+    }
+    if let Some(block) = current {
+        answer.push(block);
+    }
+    answer
+}
+
+/// Return the matching blocks of a and b, like get_matching_blocks().
+///
+/// The last block is always the dummy (len(a), len(b), 0).
+pub fn matching_blocks(a: &[u32], b: &[u32]) -> Vec<(usize, usize, usize)> {
+    matching_blocks_with_stats(a, b, &Options::default(), None, None).0
+}
+
+/// Return the matching blocks of a and b, recording what was done in stats.
+///
+/// If edits is given, the outline of the diff is kept in it, and the
+/// previous outline is brought up to date with the edit that has been
+/// made to b since, if any; an outline is not kept if matching was stopped
+/// by options. Also returns the number of bytes used by the intermediate
+/// matches.
+pub fn matching_blocks_with_stats(
+    a: &[u32],
+    b: &[u32],
+    options: &Options,
+    stats: Option<&mut Stats>,
+    edits: Option<(&mut Option<Outline>, Option<Edit>)>,
+) -> (Vec<(usize, usize, usize)>, usize) {
+    let mut matches = Vec::new();
+    match edits {
+        Some((outline, edit)) => {
+            // An outline is only of use along with the edit made since
+            let old = outline.take();
+            let previous = old.as_ref().zip(edit);
+            *outline = outline_matches(a, b, &mut matches, options, stats, previous)
+                .filter(|_| !options.stopped());
+        }
+        None => {
+            recurse_matches(
+                a,
+                b,
+                0,
+                0,
+                a.len(),
+                b.len(),
+                &mut matches,
+                MAX_RECURSION,
+                options,
+                stats,
+                0,
+            );
+        }
+    }
+    let mut blocks = collapse_sequences(&matches);
+    blocks.push((a.len(), b.len(), 0));
+    (
+        blocks,
+        matches.capacity() * std::mem::size_of::<(usize, usize)>(),
+    )
+}
+
+/// Generate the opcodes for matching blocks one at a time, like difflib's
+/// get_opcodes().
+pub struct Opcodes<B> {
+    blocks: B,
+    index: usize,
+    i: usize,
+    j: usize,
+    /// The equal opcode for the current block, if a change preceded it
+    pending: Option<Opcode>,
+}
+
+impl<B: AsRef<[(usize, usize, usize)]>> Opcodes<B> {
+    pub fn new(blocks: B) -> Self {
+        Self {
+            blocks,
+            index: 0,
+            i: 0,
+            j: 0,
+            pending: None,
+        }
+    }
+}
+
+impl<B: AsRef<[(usize, usize, usize)]>> Iterator for Opcodes<B> {
+    type Item = Opcode;
+
+    fn next(&mut self) -> Option<Opcode> {
+        if let Some(opcode) = self.pending.take() {
+            return Some(opcode);
+        }
+        while let Some(&(ai, bj, size)) = self.blocks.as_ref().get(self.index) {
+            self.index += 1;
+            let (i, j) = (self.i, self.j);
+            self.i = ai + size;
+            self.j = bj + size;
+            let equal = if size > 0 {
+                Some(Opcode::Equal(ai, ai + size, bj, bj + size))
+            } else {
+                None
+            };
+            let change = if i < ai && j < bj {
+                Some(Opcode::Replace(i, ai, j, bj))
+            } else if i < ai {
+                Some(Opcode::Delete(i, ai, j, bj))
+            } else if j < bj {
+                Some(Opcode::Insert(i, ai, j, bj))
+            } else {
+                None
+            };
+            match (change, equal) {
+                (Some(change), equal) => {
+                    self.pending = equal;
+                    return Some(change);
+                }
+                (None, Some(equal)) => return Some(equal),
+                (None, None) => continue,
+            }
+        }
+        None
+    }
+}
+
+/// Convert matching blocks to opcodes, like difflib's get_opcodes().
+pub fn opcodes(blocks: &[(usize, usize, usize)]) -> Vec<Opcode> {
+    Opcodes::new(blocks).collect()
+}
+
+/// Isolate change clusters with up to n lines of context, consuming the
+/// opcodes lazily.
+///
+/// This is difflib's get_grouped_opcodes(); every group is produced as
+/// soon as it is complete.
+pub struct GroupedOpcodes<I> {
+    codes: I,
+    n: usize,
+    /// The next opcode to place, read ahead to know whether it is the last
+    code: Option<Opcode>,
+    group: Vec<Opcode>,
+    /// The final group, once all opcodes have been placed
+    tail: Option<Vec<Opcode>>,
+}
+
+impl<I: Iterator<Item = Opcode>> GroupedOpcodes<I> {
+    pub fn new(mut codes: I, n: usize) -> Self {
+        let mut code = codes.next().unwrap_or(Opcode::Equal(0, 1, 0, 1));
+        // Fixup leading and trailing groups if they show no changes.
+        if code.is_equal() {
+            let (_, i1, i2, j1, j2) = code.parts();
+            code = code.with_bounds(
+                i1.max(i2.saturating_sub(n)),
+                i2,
+                j1.max(j2.saturating_sub(n)),
+                j2,
+            );
+        }
+        Self {
+            codes,
+            n,
+            code: Some(code),
+            group: Vec::new(),
+            tail: None,
+        }
+    }
+}
+
+impl<I: Iterator<Item = Opcode>> Iterator for GroupedOpcodes<I> {
+    type Item = Vec<Opcode>;
+
+    fn next(&mut self) -> Option<Vec<Opcode>> {
+        let n = self.n;
+        let nn = n + n;
+        while let Some(code) = self.code.take() {
+            self.code = self.codes.next();
+            let last = self.code.is_none();
+            let (_, mut i1, mut i2, mut j1, mut j2) = code.parts();
+            if last && code.is_equal() {
+                i2 = i2.min(i1 + n);
+                j2 = j2.min(j1 + n);
+            }
+            let mut finished = None;
+            // End the current group and start a new one whenever there is
+            // a large range with no changes.
+            if code.is_equal() && i2 - i1 > nn {
+                self.group
+                    .push(code.with_bounds(i1, i2.min(i1 + n), j1, j2.min(j1 + n)));
+                finished = Some(std::mem::take(&mut self.group));
+                i1 = i1.max(i2.saturating_sub(n));
+                j1 = j1.max(j2.saturating_sub(n));
+            }
+            self.group.push(code.with_bounds(i1, i2, j1, j2));
+            if last {
+                let group = std::mem::take(&mut self.group);
+                if !(group.len() == 1 && group[0].is_equal()) {
+                    self.tail = Some(group);
+                }
+            }
+            if finished.is_some() {
+                return finished;
+            }
+        }
+        self.tail.take()
+    }
+}
+
+/// Isolate change clusters with up to n lines of context.
+///
+/// This is difflib's get_grouped_opcodes().
+pub fn grouped_opcodes(codes: &[Opcode], n: usize) -> Vec<Vec<Opcode>> {
+    GroupedOpcodes::new(codes.iter().copied(), n).collect()
+}
+
+/// A region of a three-way merge, as (tag, base_start, base_end,
+/// this_start, this_end, other_start, other_end).
+///
+/// The tag is "unchanged", "same" (both sides made the same change),
+/// "this" or "other" (only that side changed) or "conflict".
+pub type MergeRegion = (&'static str, usize, usize, usize, usize, usize, usize);
+
+/// Return the regions of base that are unchanged on both sides.
+///
+/// Every region is (base_start, base_end, this_start, this_end,
+/// other_start, other_end); the last one is the empty region at the end
+/// of all three. Both diffs are computed concurrently.
+pub fn sync_regions(
+    base: &[u32],
+    this: &[u32],
+    other: &[u32],
+) -> Vec<(usize, usize, usize, usize, usize, usize)> {
+    let (this_blocks, other_blocks) = rayon::join(
+        || matching_blocks(base, this),
+        || matching_blocks(base, other),
+    );
+    let mut regions = Vec::new();
+    let (mut i, mut j) = (0, 0);
+    while i < this_blocks.len() && j < other_blocks.len() {
+        let (this_base, this_start, this_len) = this_blocks[i];
+        let (other_base, other_start, other_len) = other_blocks[j];
+        // The part of base matched on both sides
+        let start = this_base.max(other_base);
+        let end = (this_base + this_len).min(other_base + other_len);
+        if start < end {
+            let this_sub = this_start + (start - this_base);
+            let other_sub = other_start + (start - other_base);
+            regions.push((
+                start,
+                end,
+                this_sub,
+                this_sub + (end - start),
+                other_sub,
+                other_sub + (end - start),
+            ));
+        }
+        // Advance whichever block ends first in base
+        if this_base + this_len < other_base + other_len {
+            i += 1;
+        } else {
+            j += 1;
+        }
+    }
+    regions.push((
+        base.len(),
+        base.len(),
+        this.len(),
+        this.len(),
+        other.len(),
+        other.len(),
+    ));
+    regions
+}
+
+/// Return the regions of a three-way merge of this and other.
+pub fn merge_regions(base: &[u32], this: &[u32], other: &[u32]) -> Vec<MergeRegion> {
+    let mut regions = Vec::new();
+    let (mut iz, mut ia, mut ib) = (0, 0, 0);
+    for (zmatch, zend, amatch, aend, bmatch, bend) in sync_regions(base, this, other) {
+        if amatch > ia || bmatch > ib {
+            let changed_this = this[ia..amatch] != base[iz..zmatch];
+            let changed_other = other[ib..bmatch] != base[iz..zmatch];
+            let tag = if this[ia..amatch] == other[ib..bmatch] {
+                "same"
+            } else if changed_this && changed_other {
+                "conflict"
+            } else if changed_this {
+                "this"
+            } else {
+                "other"
+            };
+            regions.push((tag, iz, zmatch, ia, amatch, ib, bmatch));
+        }
+        if zend > zmatch {
+            regions.push(("unchanged", zmatch, zend, amatch, aend, bmatch, bend));
+        }
+        (iz, ia, ib) = (zend, aend, bend);
+    }
+    regions
+}
+
+/// The changed spans of a pair of lines, as (start, end) offsets into the
+/// line from a and into the line from b.
+pub type LineSpans = (Vec<(usize, usize)>, Vec<(usize, usize)>);
+
+/// The classes of the non-ASCII code points of some lines, for splitting
+/// them into words: 0 for word characters, 1 for whitespace and 2 for any
+/// other character.
+///
+/// The classes have to match those of Python's `re` for `\w` and `\s`,
+/// which follow `str.isalnum()` and `str.isspace()` rather than Rust's
+/// `char` predicates, so they are looked up by the caller.
+pub type CharClasses = HashMap<u32, u8>;
+
+/// Return the class of a code point for splitting lines into words.
+fn char_class(c: u32, classes: &CharClasses) -> u8 {
+    match c {
+        0x30..=0x39 | 0x41..=0x5a | 0x61..=0x7a | 0x5f => 0,
+        0x09..=0x0d | 0x1c..=0x20 => 1,
+        0..=0x7f => 2,
+        _ => classes.get(&c).copied().unwrap_or(2),
+    }
+}
+
+/// Return the offsets at which the tokens of a line start, plus its length.
+///
+/// With `words`, a token is a run of word characters, a run of whitespace
+/// or any other single character, as classified by `classes`; otherwise
+/// every code point is a token.
+pub fn token_bounds(line: &[u32], words: bool, classes: &CharClasses) -> Vec<usize> {
+    if !words {
+        return (0..=line.len()).collect();
+    }
+    let mut bounds = vec![0];
+    let mut i = 0;
+    while i < line.len() {
+        let class = char_class(line[i], classes);
+        i += 1;
+        if class != 2 {
+            while i < line.len() && char_class(line[i], classes) == class {
+                i += 1;
+            }
+        }
+        bounds.push(i);
+    }
+    bounds
+}
+
+/// Tokenize the parts of a line between bounds, so that equal parts get
+/// equal tokens.
+fn tokenize_parts<'a>(
+    table: &mut HashMap<&'a [u32], u32>,
+    line: &'a [u32],
+    bounds: &[usize],
+) -> Vec<u32> {
+    bounds
+        .windows(2)
+        .map(|w| {
+            let next = table.len() as u32;
+            *table.entry(&line[w[0]..w[1]]).or_insert(next)
+        })
+        .collect()
+}
+
+/// Return the spans of two lines that differ, by matching their tokens.
+pub fn changed_spans(a: &[u32], b: &[u32], words: bool, classes: &CharClasses) -> LineSpans {
+    let a_bounds = token_bounds(a, words, classes);
+    let b_bounds = token_bounds(b, words, classes);
+    let mut table = HashMap::new();
+    let a_tokens = tokenize_parts(&mut table, a, &a_bounds);
+    let b_tokens = tokenize_parts(&mut table, b, &b_bounds);
+    let (mut a_spans, mut b_spans) = (Vec::new(), Vec::new());
+    let (mut i, mut j) = (0, 0);
+    for (ai, bj, n) in matching_blocks(&a_tokens, &b_tokens) {
+        if ai > i {
+            a_spans.push((a_bounds[i], a_bounds[ai]));
+        }
+        if bj > j {
+            b_spans.push((b_bounds[j], b_bounds[bj]));
+        }
+        (i, j) = (ai + n, bj + n);
+    }
+    (a_spans, b_spans)
+}
+
+/// Return the changed spans of many pairs of lines.
+///
+/// The pairs are independent, so they are matched in parallel if there
+/// are enough of them.
+pub fn refine_pairs(
+    pairs: &[(Vec<u32>, Vec<u32>)],
+    words: bool,
+    classes: &CharClasses,
+) -> Vec<LineSpans> {
+    let size: usize = pairs.iter().map(|(a, b)| a.len() + b.len()).sum();
+    if size < PARALLEL_THRESHOLD {
+        return pairs
+            .iter()
+            .map(|(a, b)| changed_spans(a, b, words, classes))
+            .collect();
+    }
+    pairs
+        .par_iter()
+        .map(|(a, b)| changed_spans(a, b, words, classes))
+        .collect()
+}